@@ -0,0 +1,174 @@
+"""
+Disk I/O benchmark: many concurrent incoming transfers written to one disk.
+
+First, --transfers loopback senders stream a file each to one receiving peer at
+the same time. The receiver stores them once by writing every recv straight to
+the file, as Network.receive_file used to, and once through the disk engine.
+Both variants fsync each file when it is complete.
+
+Then the same number of downloads hand their chunks to a writer at once, in the
+order a pipelined download delivers them: each file's chunks shuffled within a
+window of --window outstanding requests. They are written once one chunk at a
+time as they arrive, and once through the disk engine, which preallocates the
+files and coalesces neighbouring chunks.
+
+The files are written under --directory, which should be on the disk to measure.
+
+Usage:
+    python benchmarks/bench_disk_io.py --transfers 32 --size 32 --directory /var/tmp
+"""
+import argparse
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.disk import DiskEngine
+from src.network import Network
+
+
+class DirectWriteNetwork(Network):
+    """Writes every recv to the file as it arrives, the way receive_file used to."""
+
+    def receive_file(self, destination_path, connection, size=None):
+        buffer = self.get_buffer()
+        with open(destination_path, 'wb', buffering=0) as file:
+            while True:
+                received = connection.recv_into(buffer)
+                if not received:
+                    break
+                file.write(memoryview(buffer)[:received])
+            os.fsync(file.fileno())
+        done = Future()
+        done.set_result(os.path.getsize(destination_path))
+        return done
+
+
+def receive_all(network_class, args, directory, payload):
+    """Stream the payload over --transfers connections at once and return the seconds until all are stored."""
+    network = network_class(0, 0, ip_address='127.0.0.1', buffer_size=args.buffer_size)
+    network.start_listening()
+    port = network.tcp_socket.getsockname()[1]
+
+    def receive(i):
+        connection, _ = network.tcp_socket.accept()
+        with connection:
+            saved = network.receive_file(os.path.join(directory, f'transfer{i}.bin'), connection, len(payload))
+        saved.result()
+
+    def send():
+        with socket.create_connection(('127.0.0.1', port)) as sender:
+            sender.sendall(payload)
+            sender.shutdown(socket.SHUT_WR)
+            sender.recv(1)  # Wait for the receiver to close the connection
+
+    receivers = [threading.Thread(target=receive, args=(i,)) for i in range(args.transfers)]
+    senders = [threading.Thread(target=send) for _ in range(args.transfers)]
+    start = time.perf_counter()
+    for thread in receivers + senders:
+        thread.start()
+    for thread in receivers + senders:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    network.close_connections()
+
+    for i in range(args.transfers):
+        path = os.path.join(directory, f'transfer{i}.bin')
+        if os.path.getsize(path) != len(payload):
+            raise RuntimeError(f"{path} has {os.path.getsize(path)} bytes, expected {len(payload)}")
+        os.remove(path)
+    return elapsed
+
+
+def delivery_order(paths, chunk_count, window):
+    """Return (path, chunk index) pairs as concurrent downloads with window outstanding requests deliver them."""
+    per_file = []
+    for path in paths:
+        indices = []
+        for start in range(0, chunk_count, window):
+            batch = list(range(start, min(start + window, chunk_count)))
+            random.shuffle(batch)
+            indices.extend(batch)
+        per_file.append([(path, index) for index in reversed(indices)])
+    order = []
+    while per_file:
+        queue = random.choice(per_file)
+        order.append(queue.pop())
+        if not queue:
+            per_file.remove(queue)
+    return order
+
+
+def write_chunks_directly(paths, chunks, order):
+    """Write each chunk as it arrives, opening the file for it."""
+    for path, index in order:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.pwrite(fd, chunks[index], index * len(chunks[0]))
+        finally:
+            os.close(fd)
+    for path in paths:
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def write_chunks_with_engine(paths, chunks, order):
+    """Hand each chunk to the disk engine, after preallocating the files."""
+    engine = DiskEngine()
+    size = sum(len(chunk) for chunk in chunks)
+    for path in paths:
+        engine.open(path, size)
+    for path, index in order:
+        engine.write(path, index * len(chunks[0]), chunks[index])
+    engine.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Disk I/O benchmark")
+    parser.add_argument('--transfers', type=int, default=32, help="Concurrent incoming transfers")
+    parser.add_argument('--size', type=int, default=32, help="Size of each transfer in MiB")
+    parser.add_argument('--buffer-size', type=int, default=4096, help="Initial receive buffer size in bytes")
+    parser.add_argument('--chunk-size', type=int, default=64, help="Chunk size of the out-of-order writes in KiB")
+    parser.add_argument('--window', type=int, default=8, help="Outstanding chunk requests per download")
+    parser.add_argument('--directory', default=None, help="Where to write the files (default: the temp directory)")
+    args = parser.parse_args()
+
+    logging.disable(logging.ERROR)
+    payload = os.urandom(args.size * 2**20)
+    total = args.transfers * args.size
+    with tempfile.TemporaryDirectory(dir=args.directory) as temp_dir:
+        print(f"{args.transfers} concurrent transfers of {args.size} MiB, {args.buffer_size} byte receive buffers")
+        for name, network_class in (('per recv', DirectWriteNetwork), ('engine', Network)):
+            elapsed = receive_all(network_class, args, temp_dir, payload)
+            print(f"{name:>10}: {elapsed:6.2f} s ({total / elapsed:7.1f} MiB/s)")
+
+        chunk_size = args.chunk_size * 1024
+        chunks = [payload[offset:offset + chunk_size] for offset in range(0, len(payload), chunk_size)]
+        paths = [os.path.join(temp_dir, f'download{i}.bin') for i in range(args.transfers)]
+        order = delivery_order(paths, len(chunks), args.window)
+        print(f"{args.transfers} downloads of {args.size} MiB in {args.chunk_size} KiB chunks, "
+              f"{args.window} outstanding per file")
+        for name, write in (('per chunk', write_chunks_directly), ('engine', write_chunks_with_engine)):
+            start = time.perf_counter()
+            write(paths, chunks, order)
+            elapsed = time.perf_counter() - start
+            for path in paths:
+                with open(path, 'rb') as f:
+                    if f.read() != payload:
+                        raise RuntimeError(f"{path} doesn't hold the payload")
+                os.remove(path)
+            print(f"{name:>10}: {elapsed:6.2f} s ({total / elapsed:7.1f} MiB/s)")
+
+
+if __name__ == '__main__':
+    main()
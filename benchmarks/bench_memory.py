@@ -0,0 +1,103 @@
+"""
+Memory benchmark for the Peer data model.
+
+Builds N peers sharing M files each and reports the memory held by the peer
+records, comparing the current slotted Peer, which keeps its shared files as a
+sorted array of 4-byte hash ids, against the previous dict-backed Peer with a
+list of shared files.
+
+Usage:
+    python benchmarks/bench_memory.py --peers 10000 --files 1000
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.peer import Peer
+
+
+class LegacyPeer:
+    """The Peer layout before slots: a per-instance __dict__ and a list of shared files."""
+
+    def __init__(self, peer_id, ip_address, port):
+        self.peer_id = peer_id
+        self.ip_address = ip_address
+        self.port = port
+        self.status = 'active'
+        self.last_seen = None
+        self.shared_files = []
+
+    def add_shared_file(self, file):
+        self.shared_files.append(file)
+
+    def remove_shared_file(self, file):
+        if file in self.shared_files:
+            self.shared_files.remove(file)
+
+
+def build_peers(peer_class, peer_count, files_per_peer, pool):
+    """Create peer_count peers, each sharing files_per_peer hashes drawn from pool."""
+    peers = []
+    pool_size = len(pool)
+    for i in range(peer_count):
+        peer = peer_class(str(i), f"10.0.{i // 256 % 256}.{i % 256}", 54321)
+        start = (i * 7919) % pool_size
+        for j in range(files_per_peer):
+            peer.add_shared_file(pool[(start + j) % pool_size])
+        peers.append(peer)
+    return peers
+
+
+def measure(peer_class, peer_count, files_per_peer, pool):
+    """Return (bytes held, build seconds, peers) for one peer layout."""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    peers = build_peers(peer_class, peer_count, files_per_peer, pool)
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current, elapsed, peers
+
+
+def time_removals(peers, pool, removals):
+    """Time removing `removals` random shared files spread over the peers."""
+    rng = random.Random(0)
+    start = time.perf_counter()
+    for _ in range(removals):
+        peer = peers[rng.randrange(len(peers))]
+        peer.remove_shared_file(pool[rng.randrange(len(pool))])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peer data model memory benchmark")
+    parser.add_argument('--peers', type=int, default=10000, help="Number of peers")
+    parser.add_argument('--files', type=int, default=1000, help="Shared files per peer")
+    parser.add_argument('--pool', type=int, default=50000, help="Distinct file hashes across the swarm")
+    parser.add_argument('--removals', type=int, default=10000, help="Random remove_shared_file calls to time")
+    args = parser.parse_args()
+
+    # The hash strings themselves are shared by every layout, so build them outside the measurement
+    pool = [f"{random.getrandbits(256):064x}" for _ in range(args.pool)]
+
+    print(f"{args.peers} peers x {args.files} files ({args.pool} distinct hashes)")
+    print(f"sizeof Peer instance: slotted={sys.getsizeof(Peer('0', '0.0.0.0', 0))} B, "
+          f"legacy={sys.getsizeof(LegacyPeer('0', '0.0.0.0', 0)) + sys.getsizeof(LegacyPeer('0', '0.0.0.0', 0).__dict__)} B")
+
+    for name, peer_class in (('legacy', LegacyPeer), ('slotted', Peer)):
+        held, build_time, peers = measure(peer_class, args.peers, args.files, pool)
+        removal_time = time_removals(peers, pool, args.removals)
+        print(f"{name:>8}: {held / 2**20:9.1f} MiB held, built in {build_time:6.2f}s, "
+              f"{args.removals} removals in {removal_time * 1000:9.2f} ms")
+        del peers
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+Peer selection benchmark: download completion times with peers of different speeds.
+
+First, starts one loopback seeder per rate, each throttling its uploads to that
+many MiB/s, and downloads a file from all of them twice: once choosing peers by
+measured throughput, RTT and failure rate, and once picking a random peer for
+each chunk as if nothing were known about them.
+
+Then runs a swarm: one seeder and several leechers, whose uploads are throttled
+to the leecher rates in turn, all download the file at once and trade the chunks
+they have. It runs once with as many upload slots as peers, so nobody is choked,
+and once with the default tit-for-tat choking.
+
+Usage:
+    python benchmarks/bench_peer_selection.py --rates 1 2 8 32 --file-size 32 --leechers 8
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.downloads import DownloadManager
+from src.index import ShareIndex
+from src.network import Network
+
+
+class ThrottledNetwork(Network):
+    """A seeder whose chunk reads are paced to a fixed upload rate."""
+
+    def __init__(self, rate, **kwargs):
+        super().__init__(**kwargs)
+        self.rate = rate
+        self._free_at = 0.0
+        self._throttle = threading.Lock()
+
+    def read_chunk(self, file_hash, offset, length):
+        data = super().read_chunk(file_hash, offset, length)
+        with self._throttle:
+            start = max(time.monotonic(), self._free_at)
+            self._free_at = start + length / self.rate
+            done_at = self._free_at
+        time.sleep(max(done_at - time.monotonic(), 0))
+        return data
+
+
+class UninformedDownloadManager(DownloadManager):
+    """Picks a random holder for each chunk, as if nothing were known about the peers."""
+
+    @staticmethod
+    def peer_cost(peer, queued_bytes, length):
+        return random.random(), 0
+
+
+def start_peer(rate, share_index=None, upload_slots=None):
+    """Start a throttled loopback peer that serves sessions."""
+    peer = ThrottledNetwork(rate * 2**20, discovery_port=0, tcp_port=0, ip_address='127.0.0.1',
+                            upload_slots=upload_slots)
+    peer.share_index = share_index
+    peer.start_listening()
+    threading.Thread(target=peer.accept_connections, daemon=True).start()
+    return peer
+
+
+def address(peer):
+    """Return the (ip, port) a peer serves on."""
+    return '127.0.0.1', peer.tcp_socket.getsockname()[1]
+
+
+def download(manager_class, file_hash, seeders, directory, depth):
+    """Download the file from the seeders and return the seconds it took."""
+    network = Network(0, 0, ip_address='127.0.0.1')
+    manager = manager_class(network, directory, os.path.join(directory, 'downloads.json'), max_chunks_per_file=depth)
+    peers = [address(seeder) for seeder in seeders]
+    start = time.perf_counter()
+    manager.add(file_hash, 'download.bin', peers=peers)
+    manager.start()
+    manager.wait()
+    elapsed = time.perf_counter() - start
+    state = manager.progress(file_hash)['state']
+    manager.stop()
+    network.close_connections()
+    if state != 'complete':
+        raise RuntimeError(f"Download ended as {state}")
+    return elapsed
+
+
+def swarm(file_hash, share_index, args, upload_slots, directory):
+    """Download the file to every leecher at once and return their completion times in seconds."""
+    peers = [start_peer(args.seed_rate, share_index, upload_slots)]
+    # Leechers share what they have downloaded so far, and the file once it is complete
+    peers += [start_peer(args.leecher_rates[i % len(args.leecher_rates)],
+                         ShareIndex(os.path.join(directory, f'index{i}.json')), upload_slots)
+              for i in range(args.leechers)]
+    managers = []
+    for i, leecher in enumerate(peers[1:]):
+        leecher_dir = os.path.join(directory, f'leecher{i}')
+        manager = DownloadManager(leecher, leecher_dir, os.path.join(leecher_dir, 'downloads.json'),
+                                  max_chunks_per_file=args.depth)
+        manager.add(file_hash, 'download.bin', peers=[address(peer) for peer in peers if peer is not leecher])
+        managers.append(manager)
+
+    times = [None] * len(managers)
+
+    def run(i, manager):
+        manager.start()
+        manager.wait()
+        if manager.progress(file_hash)['state'] == 'complete':
+            times[i] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run, args=(i, manager)) for i, manager in enumerate(managers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for manager in managers:
+        manager.stop()
+    for peer in peers:
+        peer.close_connections()
+    if None in times:
+        errors = [manager.progress(file_hash)['error'] for manager in managers]
+        raise RuntimeError(f"{times.count(None)} leechers failed to download the file: {errors}")
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peer selection benchmark")
+    parser.add_argument('--rates', type=float, nargs='+', default=[1, 2, 8, 32], help="Seeder upload rates in MiB/s")
+    parser.add_argument('--file-size', type=int, default=32, help="File size in MiB")
+    parser.add_argument('--depth', type=int, default=8, help="Outstanding chunk requests per file")
+    parser.add_argument('--leechers', type=int, default=8, help="Leechers in the swarm")
+    parser.add_argument('--seed-rate', type=float, default=8, help="Upload rate of the swarm's seeder in MiB/s")
+    parser.add_argument('--leecher-rates', type=float, nargs='+', default=[1, 2, 4, 8],
+                        help="Upload rates of the leechers in MiB/s, assigned in turn")
+    args = parser.parse_args()
+
+    logging.disable(logging.ERROR)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'shared.bin')
+        with open(file_path, 'wb') as f:
+            f.write(os.urandom(args.file_size * 2**20))
+        share_index = ShareIndex(os.path.join(temp_dir, 'index.json'))
+        file_hash = share_index.add(file_path).file_hash
+
+        seeders = [start_peer(rate, share_index) for rate in args.rates]
+
+        print(f"{args.file_size} MiB from seeders at {', '.join(f'{rate:g}' for rate in args.rates)} MiB/s, "
+              f"{args.depth} chunks outstanding")
+        try:
+            for name, manager_class in (('random', UninformedDownloadManager), ('measured', DownloadManager)):
+                directory = os.path.join(temp_dir, name.replace(' ', '_'))
+                elapsed = download(manager_class, file_hash, seeders, directory, args.depth)
+                print(f"{name:>10}: {elapsed:6.2f} s ({args.file_size / elapsed:6.1f} MiB/s)")
+        finally:
+            for seeder in seeders:
+                seeder.close_connections()
+
+        print(f"Swarm of a {args.seed_rate:g} MiB/s seeder and {args.leechers} leechers uploading at "
+              f"{', '.join(f'{rate:g}' for rate in args.leecher_rates)} MiB/s")
+        for name, upload_slots in (('no choking', args.leechers + 1), ('choking', None)):
+            directory = os.path.join(temp_dir, name.replace(' ', '_'))
+            times = sorted(swarm(file_hash, share_index, args, upload_slots, directory))
+            print(f"{name:>10}: first {times[0]:6.2f} s, mean {sum(times) / len(times):6.2f} s, "
+                  f"last {times[-1]:6.2f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Pipelining benchmark: session throughput against round-trip time and pipeline depth.
+
+A SessionServer answers chunk requests over loopback from a reader that waits
+one simulated RTT before returning each chunk, so every request costs one RTT
+of latency, as it would on a distant peer. Throughput is measured with the
+client keeping 1, 8 and 64 requests outstanding.
+
+Usage:
+    python benchmarks/bench_pipeline.py --rtts 0 5 20 50 --requests 256
+"""
+import argparse
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.session import SESSION_MAGIC, Session, SessionServer
+
+DEPTHS = [1, 8, 64]
+FILE_HASH = '00' * 32
+
+
+def run(rtt, depth, requests, chunk_size):
+    """Return the throughput in MiB/s of `requests` chunk requests at one RTT and pipeline depth."""
+    payload = bytes(chunk_size)
+
+    def read_chunk(file_hash, offset, length):
+        time.sleep(rtt)
+        return payload
+
+    client_socket, server_socket = socket.socketpair()
+    executor = ThreadPoolExecutor(max_workers=max(DEPTHS))
+    server = SessionServer(server_socket, read_chunk, executor)
+    session = Session(client_socket, max_outstanding=depth)
+    server_socket.recv(len(SESSION_MAGIC))
+    server_thread = threading.Thread(target=server.serve, daemon=True)
+    server_thread.start()
+
+    start = time.perf_counter()
+    futures = [session.request_chunk(FILE_HASH, i * chunk_size, chunk_size) for i in range(requests)]
+    received = sum(len(future.result()) for future in futures)
+    elapsed = time.perf_counter() - start
+
+    session.close()
+    server_thread.join()
+    server_socket.close()
+    executor.shutdown()
+    return received / elapsed / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Session pipelining throughput benchmark")
+    parser.add_argument('--rtts', type=float, nargs='+', default=[0, 5, 20, 50], help="Simulated RTTs in ms")
+    parser.add_argument('--requests', type=int, default=256, help="Chunk requests per run")
+    parser.add_argument('--chunk-size', type=int, default=64 * 1024, help="Chunk size in bytes")
+    args = parser.parse_args()
+
+    logging.disable(logging.ERROR)
+    print(f"{args.requests} requests of {args.chunk_size // 1024} KiB, throughput in MiB/s")
+    print("RTT ms " + "".join(f"{f'depth {depth}':>12}" for depth in DEPTHS))
+    for rtt in args.rtts:
+        results = [run(rtt / 1000, depth, args.requests, args.chunk_size) for depth in DEPTHS]
+        print(f"{rtt:6g} " + "".join(f"{result:12.1f}" for result in results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Socket I/O benchmark: file transfer throughput over loopback for several buffer sizes.
+
+Each run sends a temporary file with Network.send_file to a receiver thread
+that stores it with Network.receive_file. With --netem-delay, the runs are
+repeated with a `tc netem` delay on the loopback interface (requires root and
+the `tc` tool; the qdisc is removed afterwards).
+
+Usage:
+    python benchmarks/bench_socket_io.py --size 256 --netem-delay 20ms
+"""
+import argparse
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.network import Network
+
+BUFFER_SIZES = [4096, 64 * 1024, 1024 * 1024]
+
+
+def transfer(file_path, buffer_size, socket_buffer_size):
+    """Send a file over loopback and return the seconds until it was fully received."""
+    network = Network(0, 0, ip_address='127.0.0.1', buffer_size=buffer_size,
+                      socket_buffer_size=socket_buffer_size)
+    network.start_listening()
+    port = network.tcp_socket.getsockname()[1]
+
+    def receive():
+        connection, _ = network.tcp_socket.accept()
+        network.tune_socket(connection)
+        with connection:
+            network.receive_file(os.devnull, connection).result()
+
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+    start = time.perf_counter()
+    sender = socket.create_connection(('127.0.0.1', port))
+    network.tune_socket(sender)
+    with sender:
+        network.send_file(file_path, sender)
+        sender.shutdown(socket.SHUT_WR)
+        receiver.join()
+    elapsed = time.perf_counter() - start
+    network.close_connections()
+    return elapsed
+
+
+def run_all(label, file_path, size, socket_buffer_size):
+    print(label)
+    for buffer_size in BUFFER_SIZES:
+        elapsed = transfer(file_path, buffer_size, socket_buffer_size)
+        print(f"  buffer {buffer_size // 1024:5d} KiB: {size / elapsed / 2**20:9.1f} MiB/s ({elapsed:.3f}s)")
+
+
+def set_netem(delay):
+    """Add a netem delay to the loopback interface, returning False if that isn't possible."""
+    if not shutil.which('tc'):
+        print("tc not found, skipping the delayed runs")
+        return False
+    result = subprocess.run(['tc', 'qdisc', 'add', 'dev', 'lo', 'root', 'netem', 'delay', delay],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"Could not add netem qdisc, skipping the delayed runs: {result.stderr.strip()}")
+        return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback transfer throughput benchmark")
+    parser.add_argument('--size', type=int, default=256, help="Transfer size in MiB")
+    parser.add_argument('--socket-buffer', type=int, default=0,
+                        help="SO_SNDBUF/SO_RCVBUF in bytes (0 keeps kernel autotuning)")
+    parser.add_argument('--netem-delay', help="Also run with this loopback delay, e.g. 20ms")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    size = args.size * 2**20
+    with tempfile.NamedTemporaryFile() as temp_file:
+        block = os.urandom(2**20)
+        for _ in range(args.size):
+            temp_file.write(block)
+        temp_file.flush()
+
+        run_all("loopback", temp_file.name, size, args.socket_buffer)
+
+        if args.netem_delay and set_netem(args.netem_delay):
+            try:
+                run_all(f"loopback + {args.netem_delay} netem delay", temp_file.name, size, args.socket_buffer)
+            finally:
+                subprocess.run(['tc', 'qdisc', 'del', 'dev', 'lo', 'root'], capture_output=True)
+
+
+if __name__ == '__main__':
+    main()
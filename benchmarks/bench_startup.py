@@ -0,0 +1,115 @@
+"""
+Startup benchmark: time from process start to the first byte served.
+
+Launches `src/main.py share <file>` against a throwaway config and shared
+directory, connects to the TCP port as soon as it accepts and requests the
+first byte of file_0 over a session until it is served. The first run is cold
+(no config cache, no share index snapshot); later runs reuse both.
+
+Usage:
+    python benchmarks/bench_startup.py --runs 5 --files 200
+"""
+import argparse
+import hashlib
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from src.session import Session, SessionError
+
+
+def free_port(kind=socket.SOCK_STREAM):
+    """Ask the OS for a currently unused port."""
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def time_to_first_byte(config_path, tcp_port, shared_file, file_hash, snapshot_path, timeout=60.0):
+    """
+    Start a node and return (seconds until the listener accepts, seconds until the first byte is served).
+
+    The first byte is requested again while the node answers that the file isn't shared yet.
+
+    The node is only stopped once its share index snapshot exists, so later runs start warm.
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join('src', 'main.py'), 'share', shared_file,
+                                '--config', config_path],
+                               cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            if time.perf_counter() - start > timeout:
+                raise TimeoutError("Node did not start serving in time")
+            try:
+                connection = socket.create_connection(('127.0.0.1', tcp_port), timeout=timeout)
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.001)
+        connected = time.perf_counter() - start
+        session = Session(connection, max_outstanding=1)
+        try:
+            while True:
+                try:
+                    session.request_chunk(file_hash, 0, 1).result(timeout)
+                    break
+                except SessionError:
+                    if time.perf_counter() - start > timeout:
+                        raise TimeoutError("Node did not serve the file in time")
+                    time.sleep(0.001)
+        finally:
+            session.close()
+        first_byte = time.perf_counter() - start
+        while not os.path.exists(snapshot_path) and time.perf_counter() - start < timeout:
+            time.sleep(0.01)
+        return connected, first_byte
+    finally:
+        process.kill()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time-to-first-byte-served startup benchmark")
+    parser.add_argument('--runs', type=int, default=5, help="Number of node starts")
+    parser.add_argument('--files', type=int, default=200, help="Files in the shared directory")
+    parser.add_argument('--size', type=int, default=1 << 20, help="Size of each shared file in bytes")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        shared_dir = os.path.join(temp_dir, 'shared')
+        os.makedirs(shared_dir)
+        for i in range(args.files):
+            with open(os.path.join(shared_dir, f"file_{i}.bin"), 'wb') as f:
+                f.write(os.urandom(args.size))
+
+        tcp_port = free_port()
+        snapshot_path = os.path.join(temp_dir, 'index.json')
+        config_path = os.path.join(temp_dir, 'config.yaml')
+        with open(config_path, 'w') as f:
+            f.write(f"discovery_port: {free_port(socket.SOCK_DGRAM)}\n"
+                    f"tcp_port: {tcp_port}\n"
+                    f"peer_id: 'bench'\n"
+                    f"ip_address: '127.0.0.1'\n"
+                    f"log_file: '{os.path.join(temp_dir, 'app.log')}'\n"
+                    f"shared_dir: '{shared_dir}'\n"
+                    f"index_snapshot: '{snapshot_path}'\n")
+
+        shared_file = os.path.join(shared_dir, 'file_0.bin')
+        with open(shared_file, 'rb') as f:
+            file_hash = hashlib.sha256(f.read()).hexdigest()
+        print(f"{args.files} shared files of {args.size} bytes")
+        for run in range(args.runs):
+            connected, first_byte = time_to_first_byte(config_path, tcp_port, shared_file, file_hash, snapshot_path)
+            label = 'cold' if run == 0 else 'warm'
+            print(f"run {run} ({label}): listening after {connected * 1000:7.1f} ms, "
+                  f"first byte served after {first_byte * 1000:7.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Multi-process serving benchmark: upload throughput and connections/sec against worker count.
+
+Starts a Supervisor with 1, 2 and 4 serving workers on a loopback port and
+drives it from several client processes, first opening short echo connections
+as fast as possible, then pulling 1 MiB chunks of a shared file over pipelined
+sessions. Scaling requires as many free cores as workers plus clients.
+
+Usage:
+    python benchmarks/bench_workers.py --workers 1 2 4 --clients 4 --duration 3
+"""
+import argparse
+import hashlib
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.index import ShareIndex
+from src.session import Session, SessionError
+from src.workers import Supervisor
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def connection_client(port, duration, results):
+    """Open, use and close echo connections until the time is up."""
+    count = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        with socket.create_connection(('127.0.0.1', port)) as connection:
+            connection.sendall(b'ping')
+            connection.recv(64)
+        count += 1
+    results.put(count)
+
+
+def upload_client(port, file_hash, file_size, duration, results):
+    """Pull chunks over one pipelined session until the time is up."""
+    session = Session(socket.create_connection(('127.0.0.1', port)), max_outstanding=8)
+    received = 0
+    offsets = range(0, file_size - CHUNK_SIZE + 1, CHUNK_SIZE)
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        futures = [session.request_chunk(file_hash, offset, CHUNK_SIZE) for offset in offsets]
+        received += sum(len(future.result()) for future in futures)
+    session.close()
+    results.put(received)
+
+
+def drive(target, args, clients, duration):
+    """Run client processes and return the sum of their results."""
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=target, args=(*args, duration, results)) for _ in range(clients)]
+    for process in processes:
+        process.start()
+    total = sum(results.get() for _ in processes)
+    for process in processes:
+        process.join()
+    return total
+
+
+def wait_until_serving(port, file_hash, timeout=30):
+    """Wait until a worker accepts connections and has restored the share index."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            session = Session(socket.create_connection(('127.0.0.1', port)))
+            session.request_chunk(file_hash, 0, 1).result(5)
+            session.close()
+            return
+        except (ConnectionError, SessionError):
+            time.sleep(0.1)
+    raise TimeoutError("Workers did not start serving in time")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-process serving benchmark")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help="Worker counts to compare")
+    parser.add_argument('--clients', type=int, default=4, help="Client processes")
+    parser.add_argument('--duration', type=float, default=3.0, help="Seconds per measurement")
+    parser.add_argument('--file-size', type=int, default=64, help="Shared file size in MiB")
+    args = parser.parse_args()
+
+    logging.disable(logging.ERROR)
+    print(f"{os.cpu_count()} CPUs, {args.clients} client processes, {args.duration}s per measurement")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'shared.bin')
+        content = os.urandom(args.file_size * 2**20)
+        with open(file_path, 'wb') as f:
+            f.write(content)
+        file_hash = hashlib.sha256(content).hexdigest()
+        snapshot_path = os.path.join(temp_dir, 'index.json')
+        ShareIndex(snapshot_path).index_paths([file_path])
+
+        for worker_count in args.workers:
+            with socket.socket() as s:
+                s.bind(('127.0.0.1', 0))
+                port = s.getsockname()[1]
+            supervisor = Supervisor(worker_count, {
+                'discovery_port': 0,
+                'tcp_port': port,
+                'ip_address': '127.0.0.1',
+                'index_snapshot': snapshot_path,
+            })
+            supervisor.start()
+            try:
+                wait_until_serving(port, file_hash)
+                connections = drive(connection_client, (port,), args.clients, args.duration)
+                uploaded = drive(upload_client, (port, file_hash, len(content)), args.clients, args.duration)
+            finally:
+                supervisor.stop()
+            print(f"{worker_count} workers: {connections / args.duration:8.0f} connections/s, "
+                  f"{uploaded / args.duration / 2**20:8.1f} MiB/s uploaded")
+
+
+if __name__ == '__main__':
+    main()
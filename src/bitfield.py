@@ -0,0 +1,195 @@
+import heapq
+
+RAW = 0
+RLE = 1
+
+
+class Bitfield:
+
+    __slots__ = ('length', 'bits')
+
+    def __init__(self, length, bits=None):
+        """
+        Initialize a bitfield of chunk availability.
+
+        Args:
+            length (int): The number of chunks.
+            bits (bytes): The packed bits, most significant bit first. Defaults to all clear.
+
+        Raises:
+            ValueError: If bits has the wrong size or sets bits past the last chunk.
+        """
+        self.length = length
+        self.bits = bytearray(bits) if bits is not None else bytearray((length + 7) // 8)
+        if len(self.bits) != (length + 7) // 8:
+            raise ValueError(f"A bitfield of {length} chunks needs {(length + 7) // 8} bytes, got {len(self.bits)}")
+        if length % 8 and self.bits[-1] & (0xff >> (length % 8)):
+            raise ValueError(f"A bitfield of {length} chunks has padding bits set")
+
+    @classmethod
+    def full(cls, length):
+        """Return a bitfield with every chunk set."""
+        bits = bytearray(b'\xff' * ((length + 7) // 8))
+        if length % 8:
+            bits[-1] &= (0xff << (8 - length % 8)) & 0xff
+        return cls(length, bits)
+
+    def set(self, index):
+        """Mark a chunk as available. Returns True if it wasn't before."""
+        self._check(index)
+        mask = 0x80 >> (index & 7)
+        if self.bits[index >> 3] & mask:
+            return False
+        self.bits[index >> 3] |= mask
+        return True
+
+    def __contains__(self, index):
+        """Check whether a chunk is available."""
+        return 0 <= index < self.length and bool(self.bits[index >> 3] & (0x80 >> (index & 7)))
+
+    def __iter__(self):
+        """Iterate over the indices of available chunks."""
+        for byte_index, byte in enumerate(self.bits):
+            if byte:
+                for bit in range(8):
+                    if byte & (0x80 >> bit):
+                        yield byte_index * 8 + bit
+
+    def __eq__(self, other):
+        return isinstance(other, Bitfield) and self.length == other.length and self.bits == other.bits
+
+    def count(self):
+        """Return the number of available chunks."""
+        return sum(bin(byte).count('1') for byte in self.bits)
+
+    def complete(self):
+        """Check whether every chunk is available."""
+        return self.count() == self.length
+
+    def _check(self, index):
+        if not 0 <= index < self.length:
+            raise IndexError(f"Chunk {index} is outside a bitfield of {self.length} chunks")
+
+    def encode(self):
+        """
+        Encode the bitfield compactly: as run lengths when that is smaller, otherwise as raw bits.
+
+        Mostly-empty and mostly-complete bitfields, the common cases, encode to a few bytes.
+        """
+        runs = bytearray()
+        current, run = False, 0
+        for index in range(self.length):
+            bit = index in self
+            if bit != current:
+                _write_varint(runs, run)
+                current, run = bit, 0
+                if len(runs) >= len(self.bits):
+                    return bytes([RAW]) + bytes(self.bits)
+            run += 1
+        _write_varint(runs, run)
+        if len(runs) < len(self.bits):
+            return bytes([RLE]) + bytes(runs)
+        return bytes([RAW]) + bytes(self.bits)
+
+    @classmethod
+    def decode(cls, length, payload):
+        """
+        Decode a bitfield produced by encode().
+
+        Raises:
+            ValueError: If the payload is malformed.
+        """
+        if not payload:
+            raise ValueError("Empty bitfield payload")
+        if payload[0] == RAW:
+            return cls(length, payload[1:])
+        if payload[0] != RLE:
+            raise ValueError(f"Unknown bitfield encoding {payload[0]}")
+        bitfield = cls(length)
+        position, index, bit = 1, 0, False
+        while position < len(payload):
+            run, position = _read_varint(payload, position)
+            if index + run > length:
+                raise ValueError("Bitfield runs exceed its length")
+            if bit:
+                for chunk in range(index, index + run):
+                    bitfield.set(chunk)
+            index += run
+            bit = not bit
+        if index != length:
+            raise ValueError("Bitfield runs don't cover its length")
+        return bitfield
+
+
+def _write_varint(buffer, value):
+    """Append an unsigned LEB128 integer."""
+    while value >= 0x80:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varint(payload, position):
+    """Read an unsigned LEB128 integer, returning (value, next position)."""
+    value, shift = 0, 0
+    while True:
+        if position >= len(payload):
+            raise ValueError("Truncated bitfield run")
+        byte = payload[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+class Availability:
+    def __init__(self, length):
+        """
+        Initialize the swarm-wide availability count of each chunk of a file.
+
+        Args:
+            length (int): The number of chunks.
+        """
+        self.length = length
+        self.counts = [0] * length
+        self._heap = []  # (count, chunk index); entries whose count is outdated are skipped
+
+    def add_bitfield(self, bitfield):
+        """Count the chunks a peer has."""
+        for index in bitfield:
+            self.have(index)
+
+    def remove_bitfield(self, bitfield):
+        """Stop counting the chunks of a peer that left."""
+        for index in bitfield:
+            if self.counts[index] > 0:
+                self.counts[index] -= 1
+                heapq.heappush(self._heap, (self.counts[index], index))
+
+    def have(self, index):
+        """Count one more peer with a chunk."""
+        self.counts[index] += 1
+        heapq.heappush(self._heap, (self.counts[index], index))
+
+    def push(self, index):
+        """Make a chunk selectable again, e.g. after a failed request."""
+        heapq.heappush(self._heap, (self.counts[index], index))
+
+    def pick_rarest(self, wanted):
+        """
+        Take the available chunk held by the fewest peers, in O(log n) amortized time.
+
+        Args:
+            wanted (callable): Called with a chunk index; chunks it rejects are dropped
+                from selection until pushed again.
+
+        Returns:
+            int: The chunk index, or None if no wanted chunk is available.
+        """
+        while self._heap:
+            count, index = heapq.heappop(self._heap)
+            if count != self.counts[index] or count == 0 or not wanted(index):
+                continue
+            return index
+        return None
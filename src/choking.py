@@ -0,0 +1,165 @@
+import logging
+import random
+import threading
+import time
+
+
+class Choker:
+
+    INTERVAL = 10.0  # Seconds between choking rounds
+    OPTIMISTIC_ROUNDS = 3  # Rounds an optimistic unchoke lasts before it moves to another client
+    RATE_WEIGHT = 0.5  # Weight of the latest round in the upload rate averages
+
+    def __init__(self, upload_slots, download_rate=None):
+        """
+        Initialize the tit-for-tat choker that decides which session clients are uploaded to.
+
+        Every round the interested clients are ranked by how fast we download from them,
+        then by how fast they take our uploads, and the best upload_slots - 1 are unchoked.
+        The last slot goes to a randomly chosen other client, so newcomers get a chance to
+        prove themselves; it moves on every OPTIMISTIC_ROUNDS rounds.
+
+        Args:
+            upload_slots (int): The maximum number of clients uploaded to at the same time.
+            download_rate (callable): Called as download_rate(server) and returns the bytes/s we
+                download from that client's peer, or None if unknown.
+        """
+        self.upload_slots = upload_slots
+        self.download_rate = download_rate or (lambda server: None)
+        self.servers = set()
+        self.upload_rates = {}  # SessionServer -> averaged bytes/s uploaded per round
+        self.optimistic = None
+        self._uploaded = {}  # SessionServer -> bytes uploaded at the last round
+        self._requested = {}  # SessionServer -> requests received at the last round
+        self._round = 0
+        self._last_round = time.monotonic()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def add(self, server):
+        """Start choking a new session client; it is unchoked once it asks for data."""
+        server.choked = True
+        server.on_interested = self.interested
+        server.on_idle = self.idle
+        with self._lock:
+            self.servers.add(server)
+            self._uploaded[server] = server.uploaded
+            self._requested[server] = server.requests
+
+    def remove(self, server):
+        """Forget a client that disconnected, freeing its slot for a waiting client."""
+        changed = []
+        with self._lock:
+            self.servers.discard(server)
+            self.upload_rates.pop(server, None)
+            self._uploaded.pop(server, None)
+            self._requested.pop(server, None)
+            if self.optimistic is server:
+                self.optimistic = None
+            waiting = [other for other in self.servers if other.choked and other.waiting()]
+            if waiting and self._unchoked_count() < self.upload_slots:
+                self._set_choked(waiting[0], False, changed)
+        self._send(changed)
+
+    def interested(self, server):
+        """Unchoke a choked client that asked for data if an upload slot is free, or held by an idle client."""
+        changed = []
+        with self._lock:
+            if server not in self.servers or not server.choked:
+                return
+            if self._unchoked_count() >= self.upload_slots:
+                idle = [other for other in self.servers if not other.choked and not other.waiting()]
+                if not idle:
+                    return  # Wait for the next round
+                self._set_choked(idle[0], True, changed)
+            self._set_choked(server, False, changed)
+        self._send(changed)
+
+    def idle(self, server):
+        """Hand the slot of a client that has nothing left to receive to a client that is waiting."""
+        changed = []
+        with self._lock:
+            if server not in self.servers or server.choked or server.waiting():
+                return
+            waiting = [other for other in self.servers if other.choked and other.waiting()]
+            if waiting:
+                self._set_choked(server, True, changed)
+                self._set_choked(waiting[0], False, changed)
+        self._send(changed)
+
+    @staticmethod
+    def _set_choked(server, choked, changed):
+        """Change a client's choke state without telling it yet, collecting the clients to tell."""
+        if server.choke(send=False) if choked else server.unchoke(send=False):
+            changed.append(server)
+
+    @staticmethod
+    def _send(changed):
+        """
+        Tell clients their new choke state, after the lock is released.
+
+        Sending can wait behind a large DATA frame to a slow client, which mustn't hold up the other sessions.
+        """
+        for server in changed:
+            server.send_choke_state()
+
+    def _unchoked_count(self):
+        """Return the number of clients holding an upload slot."""
+        return sum(1 for server in self.servers if not server.choked)
+
+    def rechoke(self):
+        """Run one choking round."""
+        with self._lock:
+            self._round += 1
+            now = time.monotonic()
+            elapsed = max(now - self._last_round, 1e-3)
+            self._last_round = now
+            interested = []
+            for server in self.servers:
+                uploaded = server.uploaded - self._uploaded.get(server, 0)
+                requested = server.requests - self._requested.get(server, 0)
+                self._uploaded[server] = server.uploaded
+                self._requested[server] = server.requests
+                rate = uploaded / elapsed
+                previous = self.upload_rates.get(server)
+                self.upload_rates[server] = rate if previous is None else previous + self.RATE_WEIGHT * (rate - previous)
+                if requested or server.waiting():
+                    interested.append(server)
+
+            ranked = sorted(interested, key=lambda server: (self.download_rate(server) or 0.0,
+                                                            self.upload_rates[server]), reverse=True)
+            if len(ranked) <= self.upload_slots:
+                unchoked = set(ranked)
+            else:
+                unchoked = set(ranked[:self.upload_slots - 1])
+                others = [server for server in ranked if server not in unchoked]
+                if self.optimistic not in others or self._round % self.OPTIMISTIC_ROUNDS == 0:
+                    self.optimistic = random.choice(others)
+                unchoked.add(self.optimistic)
+
+            changed = []
+            for server in self.servers:
+                self._set_choked(server, server not in unchoked, changed)
+        self._send(changed)
+        logging.info(f"Choking round {self._round}: {len(unchoked)} of {len(interested)} interested clients unchoked")
+
+    def run(self, stopping):
+        """Run choking rounds until stopping is set."""
+        while not stopping.wait(self.INTERVAL):
+            self.rechoke()
+
+    def start(self):
+        """Start running choking rounds in the background, once."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping = threading.Event()
+            self._thread = threading.Thread(target=self.run, args=(self._stopping,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop running choking rounds."""
+        self._stopping.set()
+        with self._lock:
+            self._thread = None
@@ -0,0 +1,124 @@
+import json
+import logging
+import os
+from dataclasses import dataclass, fields, asdict
+
+
+@dataclass(frozen=True)
+class Config:
+    """Validated configuration settings for a node."""
+    discovery_port: int
+    tcp_port: int
+    peer_id: str
+    ip_address: str
+    log_file: str = os.path.join('logs', 'app.log')
+    shared_dir: str = os.path.join('data', 'shared_files')
+    index_snapshot: str = os.path.join('data', 'share_index.json')
+    buffer_size: int = 64 * 1024
+    socket_buffer_size: int = 0  # 0 leaves SO_SNDBUF/SO_RCVBUF to the kernel's autotuning
+    workers: int = 1  # More than one serves from that many processes sharing the TCP port
+    download_dir: str = os.path.join('data', 'received_files')
+    download_state: str = os.path.join('data', 'downloads.json')
+    max_active_downloads: int = 4
+    max_chunks_per_file: int = 8
+    upload_slots: int = 4  # Session clients uploaded to at the same time; the others are choked
+
+    def __post_init__(self):
+        """Validate the types and ranges of the settings."""
+        for field in fields(self):
+            value = getattr(self, field.name)
+            if not isinstance(value, field.type) or isinstance(value, bool):
+                raise ValueError(f"Config value '{field.name}' must be of type {field.type.__name__}, got {value!r}.")
+        for name in ('discovery_port', 'tcp_port'):
+            if not 0 <= getattr(self, name) <= 65535:
+                raise ValueError(f"Config value '{name}' must be a port number between 0 and 65535.")
+        if self.buffer_size <= 0:
+            raise ValueError("Config value 'buffer_size' must be positive.")
+        if self.socket_buffer_size < 0:
+            raise ValueError("Config value 'socket_buffer_size' must not be negative.")
+        for name in ('workers', 'max_active_downloads', 'max_chunks_per_file', 'upload_slots'):
+            if getattr(self, name) < 1:
+                raise ValueError(f"Config value '{name}' must be at least 1.")
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Build a Config from a parsed configuration mapping.
+
+        Args:
+            data (dict): The raw settings, e.g. as parsed from YAML.
+
+        Raises:
+            ValueError: If a required setting is missing, unknown, or invalid.
+        """
+        if not isinstance(data, dict):
+            raise ValueError("Configuration must be a mapping of settings.")
+        known = {field.name for field in fields(cls)}
+        unknown = set(data) - known
+        if unknown:
+            raise ValueError(f"Unknown config settings: {', '.join(sorted(unknown))}.")
+        try:
+            return cls(**data)
+        except TypeError as e:
+            raise ValueError(f"Invalid configuration: {e}") from e
+
+
+def configure_logging(log_file):
+    """Configure logging once for the whole process; worker processes call it too."""
+    directory = os.path.dirname(log_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        handlers=[
+                            logging.FileHandler(log_file),
+                            logging.StreamHandler()
+                        ])
+
+
+def default_cache_path(config_file):
+    """Return the path of the precomputed cache that sits next to a config file."""
+    directory, name = os.path.split(config_file)
+    return os.path.join(directory, f".{name}.cache.json")
+
+
+def load_config(config_file=os.path.join('config', 'config.yaml'), cache_file=None):
+    """
+    Load and validate configuration settings.
+
+    The validated settings are cached as JSON next to the config file, keyed by the
+    file's size and modification time, so restarts skip importing and running the
+    YAML parser unless the config has changed.
+
+    Args:
+        config_file (str): The path to the YAML configuration file.
+        cache_file (str): The path of the precomputed cache. Defaults to a hidden file next to config_file.
+
+    Returns:
+        Config: The validated configuration.
+    """
+    cache_file = cache_file or default_cache_path(config_file)
+    stat = os.stat(config_file)
+    source_key = [stat.st_size, stat.st_mtime_ns]
+
+    try:
+        with open(cache_file, 'r') as file:
+            cached = json.load(file)
+        if cached.get('source') == source_key:
+            return Config.from_dict(cached['config'])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass  # Missing or stale cache, fall back to parsing the YAML
+
+    import yaml
+    with open(config_file, 'r') as file:
+        config = Config.from_dict(yaml.safe_load(file))
+
+    try:
+        temp_path = f"{cache_file}.tmp"
+        with open(temp_path, 'w') as file:
+            json.dump({'source': source_key, 'config': asdict(config)}, file)
+        os.replace(temp_path, cache_file)
+    except OSError:
+        pass  # The cache is only an optimization
+
+    return config
@@ -0,0 +1,436 @@
+import errno
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+
+
+def preallocate(fd, size):
+    """
+    Reserve disk space for the first size bytes of a file.
+
+    The space is allocated in one go, so the file is laid out contiguously instead of growing
+    piece by piece, and a full disk is reported up front rather than in the middle of a download.
+    Where posix_fallocate isn't available, the file is only extended to size.
+
+    Raises:
+        OSError: If the space can't be reserved.
+    """
+    if size <= 0:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+        return
+    except AttributeError:
+        pass  # Not available on this platform
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+            raise
+    if os.fstat(fd).st_size < size:
+        os.ftruncate(fd, size)
+
+
+def write_vectored(fd, buffers, offset):
+    """
+    Write buffers back to back at offset, with as few pwritev calls as the system allows.
+
+    Short writes are resumed where they stopped.
+
+    Raises:
+        OSError: If a write fails.
+    """
+    views = deque(memoryview(buffer).cast('B') for buffer in buffers if len(buffer))
+    while views:
+        written = os.pwritev(fd, list(itertools.islice(views, IOV_MAX)), offset)
+        offset += written
+        while written:
+            if written >= len(views[0]):
+                written -= len(views.popleft())
+            else:
+                views[0] = views[0][written:]
+                written = 0
+
+
+def fsync(fd):
+    """
+    Flush a file's written data to the disk.
+
+    Files that can't be synced, like /dev/null, are skipped.
+
+    Raises:
+        OSError: If the data can't be synced.
+    """
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        if e.errno != errno.EINVAL:
+            raise
+
+
+class _OpenFile:
+
+    __slots__ = ('path', 'fd', 'pending', 'deadline', 'busy', 'dirty', 'last_sync', 'flushing', 'error',
+                 'closed', 'close_length', 'closing')
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None  # Set once the pool has opened the file
+        self.pending = {}  # offset -> (data, callbacks, time it was buffered)
+        self.deadline = None  # When the oldest pending piece has to be written
+        self.busy = 0  # Opens, writes, fsyncs and closes submitted to the pool and not finished
+        self.dirty = False  # Written since the last fsync
+        self.last_sync = time.monotonic()
+        self.flushing = 0  # Callers waiting for the buffered data to be written
+        self.error = None  # The first OSError opening, writing or syncing the file
+        self.closed = None  # Future of close_file(), once it was called
+        self.close_length = None
+        self.closing = False  # The final sync and close were submitted to the pool
+
+
+class DiskEngine:
+
+    ALIGNMENT = 4096  # Writes that don't finish a run end on a multiple of this, a file system block
+    WRITE_SIZE = 1024 * 1024  # A contiguous run this long is written without waiting for its neighbours
+    WRITE_DELAY = 0.05  # Seconds buffered data may wait for its neighbours before it is written anyway
+    FSYNC_INTERVAL = 1.0  # Seconds between fsyncs of a file that is being written
+
+    def __init__(self, max_buffered=64 * 1024 * 1024, workers=4):
+        """
+        Initialize the disk engine that stores received data off the network threads.
+
+        Data handed to write() is held in a write-behind buffer. Pieces that arrive out of order
+        are coalesced with their neighbours into contiguous runs, which a small thread pool writes
+        with one pwritev each once they are WRITE_SIZE long or have waited WRITE_DELAY seconds.
+        Files are fsynced in batches, at most once per FSYNC_INTERVAL while they are written,
+        instead of after every write. Opening, preallocating and the final sync and close run on
+        the pool too, so the only time a caller waits is when the buffer is full.
+
+        Args:
+            max_buffered (int): Bytes that may wait to be written before write() blocks.
+            workers (int): Threads doing the disk I/O.
+        """
+        self.max_buffered = max_buffered
+        self.buffered = 0  # Bytes accepted by write() and not written yet
+        self._files = {}  # path -> _OpenFile
+        self._retiring = set()  # Files passed to close_file() that aren't closed yet
+        self._changed = set()  # Files with pieces buffered since the dispatcher last looked at them
+        self._blocked = 0  # write() calls waiting for room in the buffer
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def open(self, path, size=None, truncate=False):
+        """
+        Open a file for writing in the background, reserving size bytes for it.
+
+        Files are also opened by their first write(); opening them first preallocates them.
+        Failures are raised by the following write(), flush() or close_file().
+
+        Returns:
+            Future: Resolves once the file is open and preallocated.
+        """
+        with self._condition:
+            file = self._files.get(path)
+            if file is None:
+                file = self._track(path)
+                return self._submit(file, self._open_file, file, truncate, size)
+            if size:
+                return self._submit(file, self._preallocate, file, size)
+            done = Future()
+            done.set_result(None)
+            return done
+
+    def _track(self, path):
+        """Start tracking a file and open it on the pool. Called with the condition held."""
+        file = self._files[path] = _OpenFile(path)
+        return file
+
+    def _submit(self, file, function, *args):
+        """Run a job for a file on the pool, counting it as busy. Called with the condition held."""
+        file.busy += 1
+        return self._pool.submit(self._run_job, file, function, *args)
+
+    def _run_job(self, file, function, *args):
+        """Run a pool job, recording an OSError as the file's error."""
+        try:
+            function(*args)
+        except OSError as e:
+            logging.error(f"Disk I/O on {file.path} failed: {e}")
+            with self._condition:
+                file.error = file.error or e
+            raise
+        finally:
+            with self._condition:
+                file.busy -= 1
+                self._condition.notify_all()
+
+    def _open_file(self, file, truncate, size):
+        """Open a file and reserve its space."""
+        flags = os.O_WRONLY | os.O_CREAT | (os.O_TRUNC if truncate else 0)
+        fd = os.open(file.path, flags, 0o644)
+        with self._condition:
+            file.fd = fd
+        if size:
+            preallocate(fd, size)
+
+    def _preallocate(self, file, size):
+        """Reserve space for a file once it is open."""
+        with self._condition:
+            while file.fd is None and file.error is None:
+                self._condition.wait()
+            fd = file.fd
+        if fd is not None:
+            preallocate(fd, size)
+
+    def write(self, path, offset, data, callback=None):
+        """
+        Buffer data for writing at offset; callback is called once it is written.
+
+        The data must not be changed until then. Data buffered for the same offset earlier and
+        not written yet is replaced, and both callbacks are called. write() only blocks while
+        the buffer is full.
+
+        Raises:
+            OSError: If opening, writing or syncing the file has failed.
+        """
+        with self._condition:
+            if self.buffered and self.buffered + len(data) > self.max_buffered:
+                # Holding data back for coalescing doesn't pay while writers wait for room
+                self._blocked += 1
+                self._condition.notify_all()
+                try:
+                    while self.buffered and self.buffered + len(data) > self.max_buffered:
+                        self._condition.wait()
+                finally:
+                    self._blocked -= 1
+            file = self._files.get(path)
+            if file is None:
+                file = self._track(path)
+                self._submit(file, self._open_file, file, False, None)
+            if file.error:
+                raise file.error
+            now = time.monotonic()
+            callbacks = [callback] if callback else []
+            previous = file.pending.get(offset)
+            if previous is not None:
+                self.buffered -= len(previous[0])
+                callbacks = previous[1] + callbacks
+                now = previous[2]
+            file.pending[offset] = (data, callbacks, now)
+            if file.deadline is None:
+                file.deadline = now + self.WRITE_DELAY
+            self.buffered += len(data)
+            self._changed.add(file)
+            self._condition.notify_all()
+
+    def flush(self, path=None):
+        """
+        Wait until the data buffered for a file, or for every file, has been written.
+
+        This blocks the calling thread; network threads use close_file() instead.
+
+        Raises:
+            OSError: If opening, writing or syncing one of the files has failed.
+        """
+        with self._condition:
+            if path is None:
+                files = list(self._files.values()) + list(self._retiring)
+            else:
+                files = [self._files[path]] if path in self._files else []
+            for file in files:
+                file.flushing += 1
+            self._condition.notify_all()
+            try:
+                while any(file.pending or file.busy for file in files):
+                    self._condition.wait()
+            finally:
+                for file in files:
+                    file.flushing -= 1
+            for file in files:
+                if file.error:
+                    raise file.error
+
+    def sync(self, path):
+        """
+        Fsync a file on the pool.
+
+        Returns:
+            Future: Resolves once everything written before the call is on the disk, or fails
+                with the OSError. Resolves right away for a file that isn't open.
+        """
+        with self._condition:
+            file = self._files.get(path)
+            if file is None or file.fd is None:
+                done = Future()
+                done.set_result(None)
+                return done
+            return self._submit(file, fsync, file.fd)
+
+    def close_file(self, path, length=None):
+        """
+        Write a file's buffered data, fsync it, and close it, all on the pool.
+
+        Args:
+            length (int): If given, the file is truncated to this length first.
+
+        Returns:
+            Future: Resolves once the file is closed, or fails with the OSError that lost its data.
+        """
+        with self._condition:
+            file = self._files.pop(path, None)
+            if file is None:
+                done = Future()
+                done.set_result(None)
+                return done
+            file.closed = Future()
+            file.close_length = length
+            self._retiring.add(file)
+            self._condition.notify_all()
+            return file.closed
+
+    def close(self):
+        """Write and close every file, then stop the I/O threads."""
+        with self._condition:
+            paths = list(self._files)
+        for path in paths:
+            self.close_file(path)
+        with self._condition:
+            closing = [file.closed for file in self._retiring]
+        for future in closing:
+            try:
+                future.result()
+            except OSError:
+                pass  # Logged by the job that failed
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        self._dispatcher.join()
+        self._pool.shutdown(wait=True)
+
+    def _dispatch(self):
+        """Hand coalesced runs, due fsyncs and closes to the pool as they become ready."""
+        with self._condition:
+            while not self._stopping:
+                now = time.monotonic()
+                deadlines = []
+                for file in list(self._files.values()) + list(self._retiring):
+                    if file.error and file.pending:
+                        # The file is lost, so drop its data rather than hold up the buffer
+                        self.buffered -= sum(len(data) for data, _, _ in file.pending.values())
+                        file.pending.clear()
+                        file.deadline = None
+                        self._condition.notify_all()
+                    if file.fd is None:
+                        if file.error and file.closed and not file.closing and not file.busy:
+                            file.closing = True
+                            self._pool.submit(self._close, file)
+                        continue  # Still opening, or failed to; the open job wakes us when it finishes
+                    force = bool(file.flushing or file.closed or self._blocked)
+                    if file.pending and (file in self._changed or force or file.deadline <= now):
+                        for offset, buffers, callbacks, size in self._take_runs(file, now, force):
+                            self._submit(file, self._write_run, file, offset, buffers, callbacks, size)
+                        file.deadline = min(item[2] for item in file.pending.values()) + self.WRITE_DELAY \
+                            if file.pending else None
+                    if file.deadline is not None:
+                        deadlines.append(file.deadline)
+                    if file.closed and not file.closing and not file.pending and not file.busy:
+                        file.closing = True
+                        self._pool.submit(self._close, file)
+                    elif file.dirty and not file.busy and not file.closed:
+                        if now - file.last_sync >= self.FSYNC_INTERVAL:
+                            file.dirty = False
+                            file.last_sync = now
+                            self._submit(file, fsync, file.fd)
+                        else:
+                            deadlines.append(file.last_sync + self.FSYNC_INTERVAL)
+                self._changed.clear()
+                timeout = max(min(deadlines) - time.monotonic(), 0.001) if deadlines else None
+                self._condition.wait(timeout)
+
+    def _take_runs(self, file, now, force=False):
+        """
+        Remove the runs of a file's buffered data that are ready to be written.
+
+        Adjacent pieces form a run. A run is written whole once its oldest piece has waited
+        WRITE_DELAY or force is set; before that, only a prefix of at least
+        WRITE_SIZE bytes ending on an ALIGNMENT boundary is taken, and the rest waits for
+        the pieces that follow it.
+
+        Returns:
+            list: (offset, buffers, callbacks, size) for each run to write.
+        """
+        if not file.pending:
+            return []
+        runs = []
+        offsets = sorted(file.pending)
+        start = 0
+        while start < len(offsets):
+            end = start + 1
+            position = offsets[start] + len(file.pending[offsets[start]][0])
+            while end < len(offsets) and offsets[end] == position:
+                position += len(file.pending[offsets[end]][0])
+                end += 1
+            run = offsets[start:end]
+            if force or min(file.pending[offset][2] for offset in run) + self.WRITE_DELAY <= now:
+                take = len(run)
+            else:
+                take = 0
+                for i, offset in enumerate(run):
+                    run_end = offset + len(file.pending[offset][0])
+                    if run_end - run[0] >= self.WRITE_SIZE and run_end % self.ALIGNMENT == 0:
+                        take = i + 1
+            if take:
+                items = [file.pending.pop(offset) for offset in run[:take]]
+                runs.append((run[0], [data for data, _, _ in items],
+                             [callback for _, callbacks, _ in items for callback in callbacks],
+                             sum(len(data) for data, _, _ in items)))
+            start = end
+        return runs
+
+    def _write_run(self, file, offset, buffers, callbacks, size):
+        """Write one contiguous run, then report the pieces in it as written."""
+        try:
+            write_vectored(file.fd, buffers, offset)
+        finally:
+            with self._condition:
+                self.buffered -= size
+                self._condition.notify_all()
+        with self._condition:
+            file.dirty = True
+        for callback in callbacks:
+            callback()
+
+    def _close(self, file):
+        """Truncate, sync and close a file passed to close_file(), then resolve its future."""
+        error = file.error
+        try:
+            if error is None:
+                if file.close_length is not None:
+                    os.ftruncate(file.fd, file.close_length)
+                if file.dirty or file.close_length is not None:
+                    fsync(file.fd)
+        except OSError as e:
+            logging.error(f"Disk I/O on {file.path} failed: {e}")
+            error = e
+        finally:
+            if file.fd is not None:
+                os.close(file.fd)
+            with self._condition:
+                self._retiring.discard(file)
+                self._condition.notify_all()
+        if error is None:
+            file.closed.set_result(None)
+        else:
+            file.closed.set_exception(error)
@@ -0,0 +1,601 @@
+import heapq
+import itertools
+import json
+import logging
+import os
+import queue
+import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    from .bitfield import Availability, Bitfield
+    from .disk import DiskEngine
+    from .file import File
+    from .session import SessionError
+except ImportError:
+    from bitfield import Availability, Bitfield
+    from disk import DiskEngine
+    from file import File
+    from session import SessionError
+
+QUEUED = 'queued'
+ACTIVE = 'active'
+COMPLETE = 'complete'
+FAILED = 'failed'
+
+
+class DownloadError(Exception):
+    """Raised when a download can't be completed."""
+
+
+class Download:
+
+    __slots__ = ('file_hash', 'file_name', 'priority', 'size', 'done', 'synced', 'state', 'error', 'peers',
+                 'sequence')
+
+    def __init__(self, file_hash, file_name, priority=0, peers=None):
+        """Initialize a download of the file with the given hash."""
+        self.file_hash = file_hash
+        self.file_name = file_name
+        self.priority = priority
+        self.size = None
+        self.done = set()  # Indices of chunks written to disk
+        self.synced = set()  # Indices of written chunks a completed fsync covers; only these are persisted
+        self.state = QUEUED
+        self.error = None
+        self.peers = peers or []  # (ip, port) pairs; empty means the network's known peers
+        self.sequence = 0  # Orders downloads of equal priority by when they were queued
+
+    def to_dict(self):
+        """Convert the download to its persisted form."""
+        return {
+            'file_name': self.file_name,
+            'priority': self.priority,
+            'size': self.size,
+            'done': sorted(self.synced),
+            'state': self.state,
+            'error': self.error,
+            'peers': [list(peer) for peer in self.peers],
+        }
+
+    @classmethod
+    def from_dict(cls, file_hash, data):
+        """Restore a download from its persisted form."""
+        download = cls(file_hash, data['file_name'], data.get('priority', 0),
+                       [tuple(peer) for peer in data.get('peers', [])])
+        download.size = data.get('size')
+        download.done = set(data.get('done', []))
+        download.synced = set(download.done)
+        download.state = data.get('state', QUEUED)
+        download.error = data.get('error')
+        return download
+
+
+class DownloadManager:
+
+    CHUNK_SIZE = 1024 * 1024
+    CHUNK_TIMEOUT = 30.0  # Seconds before an unanswered chunk request counts as failed
+    SAVE_INTERVAL = 1.0  # Minimum seconds between state saves triggered by chunk progress
+
+    def __init__(self, network, download_dir, state_path, max_active=4, max_chunks_per_file=8,
+                 max_retries=5, retry_delay=1.0):
+        """
+        Initialize the download manager.
+
+        Args:
+            network (Network): Provides sessions to peers and the list of known peers.
+            download_dir (str): The directory completed downloads are stored in.
+            state_path (str): The path of the persisted queue state.
+            max_active (int): The number of files downloaded at the same time.
+            max_chunks_per_file (int): Outstanding chunk requests per file.
+            max_retries (int): Failed attempts allowed per chunk before the download fails.
+            retry_delay (float): Seconds before the first retry of a chunk; doubled on each retry.
+        """
+        self.network = network
+        self.download_dir = download_dir
+        self.state_path = state_path
+        self.max_active = max_active
+        self.max_chunks_per_file = max_chunks_per_file
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.downloads = {}  # file hash -> Download
+        self.writer = DiskEngine()
+        self._queue = []  # Heap of (-priority, sequence, file hash)
+        self._sequence = itertools.count()
+        self._active = 0
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._last_save = 0.0
+        self._save_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_active)
+        self._scheduler = None
+        self._availability = {}  # file hash -> Availability of the chunks of an active download
+        # (file hash, chunk index) of written chunks to announce; None stops the publisher
+        self._written = queue.Queue()
+        self._publisher = threading.Thread(target=self._publish, daemon=True)
+        network.have_listeners.append(self._peer_have)
+        self.load_state()
+        self._publisher.start()
+
+    def add(self, file_hash, file_name=None, priority=0, peers=None):
+        """
+        Queue a file for download.
+
+        A hash that is already queued, downloading or downloaded is not downloaded again;
+        queueing it with a higher priority raises the priority of the queued download.
+
+        Returns:
+            bool: True if a new download was queued.
+
+        Raises:
+            ValueError: If file_hash isn't a SHA-256 hash as 64 hex digits.
+        """
+        if len(file_hash) != 64 or any(digit not in string.hexdigits for digit in file_hash):
+            raise ValueError(f"Not a SHA-256 hash: {file_hash!r}")
+        file_hash = file_hash.lower()
+        with self._condition:
+            download = self.downloads.get(file_hash)
+            if download is not None and download.state != FAILED:
+                if download.state == QUEUED and priority > download.priority:
+                    download.priority = priority
+                    self._push(download)
+                return False
+            download = Download(file_hash, os.path.basename(file_name or file_hash), priority, peers)
+            self.downloads[file_hash] = download
+            self._push(download)
+            self._condition.notify_all()
+        self.save_state()
+        logging.info(f"Queued download of {file_hash} with priority {priority}")
+        return True
+
+    def _push(self, download):
+        """Put a download on the queue. Entries left behind by priority changes are skipped when popped."""
+        download.sequence = next(self._sequence)
+        heapq.heappush(self._queue, (-download.priority, download.sequence, download.file_hash))
+
+    def progress(self, file_hash):
+        """
+        Return the progress of a download, or None if the hash was never queued.
+
+        Returns:
+            dict: The state, sizes in bytes and chunk counts of the download.
+        """
+        with self._condition:
+            download = self.downloads.get(file_hash)
+            if download is None:
+                return None
+            chunks_total = None
+            downloaded = 0
+            if download.size is not None:
+                chunks_total = -(-download.size // self.CHUNK_SIZE)
+                downloaded = sum(self.chunk_length(download, index) for index in download.done)
+            return {
+                'file_name': download.file_name,
+                'state': download.state,
+                'priority': download.priority,
+                'size': download.size,
+                'downloaded': downloaded,
+                'chunks_done': len(download.done),
+                'chunks_total': chunks_total,
+                'error': download.error,
+            }
+
+    def start(self):
+        """Start scheduling downloads."""
+        self._scheduler = threading.Thread(target=self._schedule, daemon=True)
+        self._scheduler.start()
+
+    def stop(self):
+        """Stop scheduling new downloads, wait for active ones, and save the queue state."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        self._executor.shutdown(wait=True)
+        self.writer.close()
+        self._written.put(None)
+        self._publisher.join()
+        self.save_state()
+
+    def wait(self, timeout=None):
+        """Wait until no download is queued or active. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while any(download.state in (QUEUED, ACTIVE) for download in self.downloads.values()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def _schedule(self):
+        """Start the highest-priority queued downloads whenever an active slot is free."""
+        while True:
+            with self._condition:
+                while not self._stopping and (not self._queue or self._active >= self.max_active):
+                    self._condition.wait()
+                if self._stopping:
+                    return
+                priority, sequence, file_hash = heapq.heappop(self._queue)
+                download = self.downloads[file_hash]
+                if download.state != QUEUED or download.sequence != sequence:
+                    continue  # Stale entry
+                download.state = ACTIVE
+                self._active += 1
+            self._executor.submit(self._run_download, download)
+
+    def _run_download(self, download):
+        """Run a download and record how it ended."""
+        try:
+            self._download(download)
+            state, error = COMPLETE, None
+            logging.info(f"Downloaded {download.file_hash} to {self.final_path(download)}")
+        except Exception as e:
+            # Downloads interrupted by stop() are resumed on the next start
+            state, error = (QUEUED, None) if self._stopping else (FAILED, str(e))
+            logging.error(f"Download of {download.file_hash} failed: {e}")
+        with self._condition:
+            download.state = state
+            download.error = error
+            self._active -= 1
+            self._condition.notify_all()
+        self.save_state()
+
+    def chunk_length(self, download, index):
+        """Return the length of a chunk; the last chunk of a file may be short."""
+        return min(self.CHUNK_SIZE, download.size - index * self.CHUNK_SIZE)
+
+    def part_path(self, download):
+        """Return the path a download is written to until it is complete; unique to its hash."""
+        return os.path.join(self.download_dir, f"{download.file_hash}.part")
+
+    def final_path(self, download):
+        """Return the path of a completed download."""
+        return os.path.join(self.download_dir, download.file_name)
+
+    def _store(self, download, part_path):
+        """
+        Move a verified download to its final path, renaming it if another file has that name.
+
+        Returns:
+            str: The final path.
+        """
+        stem, extension = os.path.splitext(download.file_name)
+        tagged = f"{stem}.{download.file_hash[:12]}"
+        names = itertools.chain([download.file_name, f"{tagged}{extension}"],
+                                (f"{tagged}.{number}{extension}" for number in itertools.count(1)))
+        with self._condition:
+            # Held while renaming, so two downloads of the same name can't both pick it
+            for name in names:
+                if not os.path.exists(os.path.join(self.download_dir, name)):
+                    break
+            if name != download.file_name:
+                logging.info(f"{self.final_path(download)} exists, storing {download.file_hash} as {name}")
+                download.file_name = name
+            final_path = self.final_path(download)
+            os.replace(part_path, final_path)
+        return final_path
+
+    def get_peers(self, download):
+        """Return the peers to download from."""
+        return download.peers or [(peer['ip'], peer['port']) for peer in self.network.peer_list]
+
+    def _stat(self, download, peers):
+        """Ask the peers for the file size until one answers."""
+        for peer in peers:
+            try:
+                return self.network.get_session(*peer).stat_file(download.file_hash).result(self.CHUNK_TIMEOUT)
+            except Exception as e:
+                logging.error(f"Peer {peer} couldn't provide the size of {download.file_hash}: {e}")
+        raise DownloadError("No peer provided the file size")
+
+    def _download(self, download):
+        """Fetch the missing chunks rarest first from the fastest peers, retrying with backoff, then verify the file."""
+        peers = self.get_peers(download)
+        if not peers:
+            raise DownloadError("No peers to download from")
+        if download.size is None:
+            download.size = self._stat(download, peers)
+        os.makedirs(self.download_dir, exist_ok=True)
+        part_path = self.part_path(download)
+
+        chunk_count = -(-download.size // self.CHUNK_SIZE)
+        local = Bitfield(chunk_count)
+        for index in download.done:
+            local.set(index)
+        self.network.register_partial(download.file_hash, part_path, download.size, self.CHUNK_SIZE, local)
+
+        availability = Availability(chunk_count)
+        with self._condition:
+            self._availability[download.file_hash] = availability
+        try:
+            holders = self._exchange_bitfields(download, peers, availability)
+            # Reserve the whole file up front so the out-of-order chunks don't fragment it
+            self.writer.open(part_path, download.size)
+            try:
+                self._fetch_chunks(download, part_path, chunk_count, holders, availability)
+            finally:
+                # Raises the OSError if the chunks couldn't be stored
+                self.writer.close_file(part_path).result()
+                with self._condition:
+                    download.synced = set(download.done)  # The close fsynced them
+            file_hash = File(part_path).file_hash
+            if file_hash != download.file_hash:
+                with self._condition:
+                    download.done.clear()
+                    download.synced.clear()
+                raise DownloadError(f"Downloaded data has hash {file_hash}")
+            final_path = self._store(download, part_path)
+            # Keep serving the chunks from their new place until the share index has the file
+            self.network.register_partial(download.file_hash, final_path, download.size, self.CHUNK_SIZE,
+                                          Bitfield.full(chunk_count))
+            share_index = self.network.share_index
+            if share_index is not None:
+                share_index.add(final_path, file_hash=file_hash)
+                # Persist it, so it is still shared after a restart and serving workers pick it up
+                try:
+                    share_index.save_snapshot()
+                except OSError as e:
+                    logging.error(f"Failed to save share index snapshot: {e}")
+        finally:
+            with self._condition:
+                self._availability.pop(download.file_hash, None)
+            self.network.unregister_partial(download.file_hash)
+
+    def _exchange_bitfields(self, download, peers, availability):
+        """
+        Fetch each peer's bitfield for the file, returning the Peers that answered.
+
+        A peer without the file stays subscribed to it, so the chunks it gets later are announced.
+        """
+        holders = []
+        for ip, port in peers:
+            peer = self.network.get_peer(ip, port)
+            requested = time.monotonic()
+            try:
+                bitfield = self.network.get_session(ip, port).request_bitfield(
+                    download.file_hash, self.CHUNK_SIZE).result(self.CHUNK_TIMEOUT)
+            except SessionError:
+                bitfield = Bitfield(availability.length)
+            except Exception as e:
+                logging.error(f"Peer {ip}:{port} couldn't provide chunks of {download.file_hash}: {e}")
+                with self._condition:
+                    peer.record_failure()
+                continue
+            if bitfield.length != availability.length:
+                logging.error(f"Peer {ip}:{port} sent a bitfield of the wrong length for {download.file_hash}")
+                continue
+            with self._condition:
+                peer.record_rtt(time.monotonic() - requested)
+                peer.set_bitfield(download.file_hash, bitfield)
+                availability.add_bitfield(bitfield)
+            holders.append(peer)
+        if not holders:
+            raise DownloadError("No peer could be reached")
+        return holders
+
+    def _peer_have(self, peer, file_hash, index):
+        """Count a chunk a peer announced towards the availability of an active download."""
+        with self._condition:
+            availability = self._availability.get(file_hash)
+            if availability is not None:
+                availability.have(index)
+                self._condition.notify_all()
+
+    def is_choked(self, peer):
+        """Check whether a peer currently holds back our chunk requests."""
+        session = self.network.active_connections.get((peer.ip_address, peer.port))
+        return getattr(session, 'choked', False)
+
+    @staticmethod
+    def peer_cost(peer, queued_bytes, length):
+        """
+        Rank a peer for one more chunk request of length bytes; lower is better.
+
+        Measured peers are ranked by when they would deliver the chunk behind the bytes already
+        queued on them. A peer that hasn't been measured gets one request at a time until it is,
+        so a slow peer can't be handed a large share of the file before anything is known.
+
+        Returns:
+            tuple: The sort key, or None if the peer shouldn't be given the chunk now.
+        """
+        expected = peer.expected_time(queued_bytes + length)
+        if expected is None:
+            return None if queued_bytes > 0 else (0.0, 0)
+        return expected, queued_bytes
+
+    def _fetch_chunks(self, download, part_path, chunk_count, holders, availability):
+        """Keep up to max_chunks_per_file requests outstanding until every chunk is written."""
+        outstanding = {}  # Future -> (chunk index, peer, session, time requested)
+        claimed = set(download.done)  # Chunks written, being written, requested or waiting for a retry
+        retries = []  # Heap of (time to retry, chunk index)
+        attempts = {}
+        queued = {}  # Peer -> bytes requested from it and not delivered yet
+        last_delivery = {}  # Peer -> when it last delivered a chunk
+
+        def failed(index, error, peer=None):
+            if peer is not None:
+                with self._condition:
+                    peer.record_failure()
+            attempts[index] = attempts.get(index, 0) + 1
+            if attempts[index] > self.max_retries:
+                raise DownloadError(f"Chunk {index} failed {attempts[index]} times, last error: {error}")
+            delay = self.retry_delay * 2 ** (attempts[index] - 1)
+            heapq.heappush(retries, (time.monotonic() + delay, index))
+
+        def pick_holder(index):
+            # The peer that would deliver the chunk soonest, preferring peers that don't choke us
+            candidates = [peer for peer in holders if peer.has_chunk(download.file_hash, index)]
+            candidates = [peer for peer in candidates if not self.is_choked(peer)] or candidates
+            length = self.chunk_length(download, index)
+            costs = [(self.peer_cost(peer, queued.get(peer, 0), length), position)
+                     for position, peer in enumerate(candidates)]
+            costs = [cost for cost in costs if cost[0] is not None]
+            return candidates[min(costs)[1]] if costs else None
+
+        try:
+            while len(claimed) < chunk_count or outstanding or retries:
+                if self._stopping:
+                    raise DownloadError("Download manager stopped")
+                now = time.monotonic()
+                picked = []
+                deferred = []
+                with self._condition:
+                    while retries and retries[0][0] <= now:
+                        index = heapq.heappop(retries)[1]
+                        claimed.discard(index)
+                        availability.push(index)
+                    while len(outstanding) + len(picked) < self.max_chunks_per_file:
+                        index = availability.pick_rarest(lambda index: index not in claimed)
+                        if index is None:
+                            break
+                        peer = pick_holder(index)
+                        if peer is None:
+                            deferred.append(index)  # Its holders are busy being measured
+                            continue
+                        claimed.add(index)
+                        picked.append((index, peer))
+                        queued[peer] = queued.get(peer, 0) + self.chunk_length(download, index)
+                    for index in deferred:
+                        availability.push(index)
+                    if not picked and not outstanding and not retries:
+                        # No peer has the remaining chunks yet; wait for a HAVE announcement
+                        if not self._condition.wait(self.CHUNK_TIMEOUT):
+                            raise DownloadError("No peer has the remaining chunks")
+                        continue
+
+                for index, peer in picked:
+                    try:
+                        session = self.network.get_session(peer.ip_address, peer.port)
+                        future = session.request_chunk(download.file_hash, index * self.CHUNK_SIZE,
+                                                       self.chunk_length(download, index))
+                    except ConnectionError as e:
+                        queued[peer] -= self.chunk_length(download, index)
+                        failed(index, e, peer)
+                        continue
+                    outstanding[future] = (index, peer, session, now)
+
+                timeout = self.CHUNK_TIMEOUT
+                if retries:
+                    timeout = min(timeout, max(retries[0][0] - now, 0))
+                if not outstanding:
+                    time.sleep(timeout)
+                    continue
+
+                finished, _ = wait(outstanding, timeout=timeout, return_when=FIRST_COMPLETED)
+                delivered = time.monotonic()
+                for future in finished:
+                    index, peer, _, requested = outstanding.pop(future)
+                    queued[peer] -= self.chunk_length(download, index)
+                    try:
+                        data = future.result()
+                    except (ConnectionError, SessionError) as e:
+                        failed(index, e, peer)
+                        continue
+                    if len(data) != self.chunk_length(download, index):
+                        failed(index, f"expected {self.chunk_length(download, index)} bytes, got {len(data)}", peer)
+                        continue
+                    # Pipelined chunks queue behind each other, so time each from the previous delivery
+                    with self._condition:
+                        peer.record_transfer(len(data), delivered - max(requested, last_delivery.get(peer, 0.0)))
+                    last_delivery[peer] = delivered
+                    self.writer.write(part_path, index * self.CHUNK_SIZE, data,
+                                      callback=lambda index=index: self._chunk_written(download, index))
+
+                now = time.monotonic()
+                for future, (index, peer, session, requested) in list(outstanding.items()):
+                    if now - requested > self.CHUNK_TIMEOUT and session.cancel(future):
+                        del outstanding[future]
+                        queued[peer] -= self.chunk_length(download, index)
+                        failed(index, "timed out", peer)
+        finally:
+            for future, (_, _, session, _) in outstanding.items():
+                session.cancel(future)
+
+    def _chunk_written(self, download, index):
+        """
+        Record a chunk that reached the disk and queue its announcement.
+
+        This runs on a disk engine thread, so the sends and state saves are left to the publisher.
+        """
+        with self._condition:
+            download.done.add(index)
+        self._written.put((download.file_hash, index))
+
+    def _publish(self):
+        """Announce written chunks to the peers and save the state at most every SAVE_INTERVAL."""
+        unsaved = False
+        while True:
+            timeout = None
+            if unsaved:
+                timeout = max(self._last_save + self.SAVE_INTERVAL - time.monotonic(), 0)
+            try:
+                written = self._written.get(timeout=timeout)
+            except queue.Empty:
+                written = ()
+            if written is None:
+                return
+            if written:
+                self.network.announce_have(*written)
+                unsaved = True
+            if unsaved and time.monotonic() - self._last_save >= self.SAVE_INTERVAL:
+                self._sync_written()
+                self.save_state()
+                unsaved = False
+
+    def _sync_written(self):
+        """
+        Fsync the part files of active downloads, so their written chunks can be persisted as done.
+
+        A chunk is only persisted once it is on the disk: after a crash, a chunk that was
+        persisted but lost would fail the final hash check and the whole file would be fetched again.
+        """
+        with self._condition:
+            unsynced = [(download, download.done - download.synced) for download in self.downloads.values()
+                        if download.state == ACTIVE and download.done - download.synced]
+        for download, written in unsynced:
+            try:
+                self.writer.sync(self.part_path(download)).result()
+            except OSError as e:
+                logging.error(f"Failed to sync {self.part_path(download)}: {e}")
+                continue
+            with self._condition:
+                download.synced |= written & download.done
+
+    def load_state(self):
+        """Restore the queue from the persisted state, requeueing downloads that were active."""
+        try:
+            with open(self.state_path, 'r') as file:
+                state = json.load(file)
+        except (OSError, ValueError) as e:
+            logging.info(f"No usable download state at {self.state_path}: {e}")
+            return
+        with self._condition:
+            for file_hash, data in state.items():
+                download = Download.from_dict(file_hash, data)
+                if download.state == ACTIVE:
+                    download.state = QUEUED
+                if download.done and not os.path.exists(self.part_path(download)):
+                    download.done.clear()
+                    download.synced.clear()
+                self.downloads[file_hash] = download
+                if download.state == QUEUED:
+                    self._push(download)
+
+    def save_state(self):
+        """Persist the queue state atomically."""
+        with self._save_lock:
+            self._last_save = time.monotonic()
+            with self._condition:
+                data = json.dumps({file_hash: download.to_dict() for file_hash, download in self.downloads.items()})
+            directory = os.path.dirname(self.state_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temp_path = f"{self.state_path}.tmp"
+            try:
+                with open(temp_path, 'w') as file:
+                    file.write(data)
+                os.replace(temp_path, self.state_path)
+            except OSError as e:
+                logging.error(f"Failed to save download state: {e}")
@@ -1,23 +1,31 @@
 import hashlib
 import os
 
+try:
+    from .disk import preallocate, write_vectored
+except ImportError:
+    from disk import preallocate, write_vectored
+
 class File:
     
-    BUFFER_SIZE = 1000
+    BUFFER_SIZE = 64 * 1024
+
+    __slots__ = ('file_path', 'file_name', 'file_size', 'file_type', 'file_hash', 'chunks', 'availability')
     
-    def __init__(self, file_path) -> None:
+    def __init__(self, file_path, file_hash=None) -> None:
         """
         Initialize the File object with the given file path.
 
         Args:
             file_path (str): The path to the file.
+            file_hash (str): A previously computed SHA-256 hash of the file. If omitted, the file is hashed.
         """
         self.validate_file(file_path)
         self.file_path = file_path
         self.file_name = self.get_file_name()
         self.file_size = self.get_file_size()
         self.file_type = self.get_file_type()
-        self.file_hash = self.calculate_hash()
+        self.file_hash = file_hash or self.calculate_hash()
         self.chunks = []
         self.availability = "available"
         
@@ -86,12 +94,14 @@ class File:
         """
         Combine chunks and write them to the specified output file.
 
+        The file's space is reserved first and the chunks go out in vectored writes, not one write each.
+
         Args:
             output_path (str): The path to the output file.
         """
-        with open(file=output_path, mode='wb') as f:
-            for chunk in self.chunks:
-                f.write(chunk)
+        with open(file=output_path, mode='wb', buffering=0) as f:
+            preallocate(f.fileno(), sum(len(chunk) for chunk in self.chunks))
+            write_vectored(f.fileno(), self.chunks, 0)
     
     def __str__(self) -> str:
         """Return a string representation of the File object."""
@@ -0,0 +1,146 @@
+import json
+import logging
+import os
+import threading
+
+try:
+    from .file import File
+except ImportError:
+    from file import File
+
+
+class ShareIndex:
+    def __init__(self, snapshot_path):
+        """
+        Initialize the index of shared files.
+
+        Args:
+            snapshot_path (str): The path of the persisted snapshot used to avoid rehashing unchanged files.
+        """
+        self.snapshot_path = snapshot_path
+        self.files = {}  # file hash -> File
+        self.snapshot = {}  # file path -> [size, mtime_ns, file hash]
+        self.ready = threading.Event()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+    @staticmethod
+    def discover(directory):
+        """Return the paths of all regular files below a directory, or an empty list if it doesn't exist."""
+        paths = []
+        for root, _, names in os.walk(directory):
+            paths.extend(os.path.join(root, name) for name in sorted(names))
+        return paths
+
+    def load_snapshot(self):
+        """Load the persisted snapshot, ignoring a missing or corrupt one."""
+        try:
+            with open(self.snapshot_path, 'r') as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError) as e:
+            logging.info(f"No usable share index snapshot at {self.snapshot_path}: {e}")
+            return
+        if isinstance(snapshot, dict):
+            with self._lock:
+                self.snapshot.update(snapshot)
+
+    def save_snapshot(self):
+        """Persist the snapshot atomically so a crash never leaves a truncated file behind."""
+        with self._save_lock:
+            with self._lock:
+                data = json.dumps(self.snapshot)
+            directory = os.path.dirname(self.snapshot_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temp_path = f"{self.snapshot_path}.tmp"
+            with open(temp_path, 'w') as file:
+                file.write(data)
+            os.replace(temp_path, self.snapshot_path)
+
+    def add(self, file_path, file_hash=None):
+        """
+        Index a file, reusing the snapshot hash if the file is unchanged.
+
+        Args:
+            file_path (str): The path to the file.
+            file_hash (str): The file's SHA-256 hash, if the caller has just computed it.
+
+        Returns:
+            File: The indexed file.
+        """
+        stat = os.stat(file_path)
+        with self._lock:
+            cached = self.snapshot.get(file_path)
+        if file_hash is None and cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            file_hash = cached[2]
+
+        file = File(file_path, file_hash=file_hash)
+        with self._lock:
+            self.files[file.file_hash] = file
+            self.snapshot[file_path] = [stat.st_size, stat.st_mtime_ns, file.file_hash]
+        return file
+
+    def index_paths(self, paths, on_indexed=None):
+        """
+        Index several files and persist the snapshot.
+
+        Args:
+            paths (list): The file paths to index.
+            on_indexed (callable): Called with each indexed File.
+        """
+        for path in paths:
+            try:
+                file = self.add(path)
+            except (OSError, ValueError) as e:
+                logging.error(f"Failed to index {path}: {e}")
+                continue
+            if on_indexed:
+                on_indexed(file)
+        try:
+            self.save_snapshot()
+        except OSError as e:
+            logging.error(f"Failed to save share index snapshot: {e}")
+        self.ready.set()
+
+    def start_background(self, paths, on_indexed=None):
+        """Index the paths in a daemon thread, returning the thread."""
+        def run():
+            self.index_paths(paths, on_indexed)
+            logging.info(f"Indexed {len(self.files)} shared files")
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def restore(self):
+        """
+        Rebuild the index from the persisted snapshot alone, without hashing anything.
+
+        Files that changed since the snapshot was written, and malformed entries, are left out.
+        This is how serving workers share the index that the main process maintains.
+
+        Returns:
+            int: The number of files restored.
+        """
+        self.load_snapshot()
+        with self._lock:
+            snapshot = dict(self.snapshot)
+        files = {}
+        for path, entry in snapshot.items():
+            try:
+                size, mtime_ns, file_hash = entry
+                stat = os.stat(path)
+                if stat.st_size != size or stat.st_mtime_ns != mtime_ns:
+                    continue
+                files[file_hash] = File(path, file_hash=file_hash)
+            except (OSError, ValueError, TypeError):
+                continue
+        with self._lock:
+            self.files = files
+        self.ready.set()
+        return len(files)
+
+    def lookup(self, file_hash):
+        """Return the indexed File with the given hash, or None if it isn't shared."""
+        with self._lock:
+            return self.files.get(file_hash)
@@ -1,69 +1,116 @@
+import time
+
+PROCESS_START = time.monotonic()
+
 import argparse
 import logging
 import os
-import time
+import threading
+from config import configure_logging, load_config
+from downloads import DownloadManager
+from index import ShareIndex
 from network import Network
 from peer import Peer
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, 
-                    format='%(asctime)s - %(levelname)s - %(message)s',
-                    handlers=[
-                        logging.FileHandler(os.path.join('logs', 'app.log')),
-                        logging.StreamHandler()
-                    ])
-
 
-def load_config(config_file='config/config.yaml'):
-    """Load configuration settings."""
-    import yaml
-    with open(config_file, 'r') as file:
-        config = yaml.safe_load(file)
-    return config
+def parse_args(argv=None):
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser(description="P2P File Sharing System")
+    parser.add_argument('action', choices=['share', 'request'], help="Action to perform: share or request")
+    parser.add_argument('files', nargs='+', help="File paths to share or SHA-256 hashes of files to request")
+    parser.add_argument('--priority', type=int, default=0, help="Priority of requested downloads; higher goes first")
+    parser.add_argument('--config', default=os.path.join('config', 'config.yaml'), help="Path to the configuration file")
+    parser.add_argument('--workers', type=int, help="Number of serving processes (overrides the config)")
+    return parser.parse_args(argv)
 
 def main():
     """Main function to handle command-line arguments and run the P2P system."""
-    config = load_config()
-    
-    # Initialize the network
-    network = Network(config['discovery_port'], config['tcp_port'])
-    
+    args = parse_args()
+    config = load_config(args.config)
+    configure_logging(config.log_file)
+
+    # Initialize the network and start serving before anything slow happens
+    network_settings = {
+        'discovery_port': config.discovery_port,
+        'tcp_port': config.tcp_port,
+        'ip_address': config.ip_address,
+        'buffer_size': config.buffer_size,
+        'socket_buffer_size': config.socket_buffer_size,
+        'upload_slots': config.upload_slots,
+    }
+    network = Network(**network_settings)
+    supervisor = None
+    workers = args.workers or config.workers
+    if workers > 1:
+        # Worker processes share the port and serve from the persisted share index snapshot;
+        # imported here so single-process runs don't load multiprocessing
+        from workers import Supervisor
+        supervisor = Supervisor(workers, dict(network_settings, index_snapshot=config.index_snapshot,
+                                              log_file=config.log_file))
+        supervisor.start()
+    else:
+        network.start_listening()
+        threading.Thread(target=network.accept_connections, daemon=True).start()
+    logging.info(f"Serving {(time.monotonic() - PROCESS_START) * 1000:.1f} ms after process start")
+
     # Initialize the peer
-    peer = Peer(config['peer_id'], config['ip_address'], config['tcp_port'])
-    
-    # Parse command-line arguments
-    parser = argparse.ArgumentParser(description="P2P File Sharing System")
-    parser.add_argument('action', choices=['share', 'request'], help="Action to perform: share or request")
-    parser.add_argument('file', help="File path to share or request")
-    args = parser.parse_args()
-    
-    if args.action == 'share':
-        share_file(peer, network, args.file)
-    elif args.action == 'request':
-        request_file(peer, network, args.file)
-    
+    peer = Peer(config.peer_id, config.ip_address, config.tcp_port)
+
+    # Serve the files from the snapshot that are unchanged right away, then index the shared
+    # directory in the background, reusing hashes from the snapshot
+    share_index = ShareIndex(config.index_snapshot)
+    restored = share_index.restore()
+    logging.info(f"Restored {restored} shared files from the snapshot")
+    network.share_index = share_index
+    share_index.start_background(ShareIndex.discover(config.shared_dir), on_indexed=peer.add_shared_file)
+
+    # Resume queued downloads from the persisted state
+    downloads = DownloadManager(network, config.download_dir, config.download_state,
+                                max_active=config.max_active_downloads,
+                                max_chunks_per_file=config.max_chunks_per_file)
+    downloads.start()
+
+    for file in args.files:
+        if args.action == 'share':
+            share_file(peer, network, share_index, file)
+        elif args.action == 'request':
+            request_file(downloads, file, args.priority)
+
     # Keep the program running
     try:
         while True:
             # Periodically broadcast presence
             network.broadcast_presence()
-            
+
             # Listen for incoming requests (you need to implement this method)
             network.listen_for_discovery()
-            
+
             time.sleep(5)  # Adjust the sleep duration as needed
     except KeyboardInterrupt:
         logging.info("Program terminated by user.")
+        downloads.stop()
+        if supervisor:
+            supervisor.stop()
 
-def share_file(peer, network, file_path):
+def share_file(peer, network, share_index, file_path):
     """Share a file with the network."""
-    peer.add_shared_file(file_path)
+    file = share_index.add(file_path)
+    share_index.save_snapshot()
+    peer.add_shared_file(file)
     logging.info(f"Sharing file: {file_path}")
     network.broadcast_presence()
 
-def request_file(peer, network, file_name):
-    """Request a file from the network."""
-    logging.info(f"Requesting file: {file_name}")
+def request_file(downloads, file_hash, priority=0):
+    """Queue a file for download from the network."""
+    try:
+        queued = downloads.add(file_hash, priority=priority)
+    except ValueError as e:
+        logging.error(f"Can't request {file_hash}: {e}")
+        return
+    if queued:
+        logging.info(f"Requesting file: {file_hash}")
+    else:
+        logging.info(f"File {file_hash} is already queued or downloaded: {downloads.progress(file_hash)['state']}")
 
 if __name__ == '__main__':
     main()
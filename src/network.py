@@ -1,26 +1,66 @@
 import socket
 import threading
 import logging
-import time
 import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+try:
+    from .bitfield import Bitfield
+    from .choking import Choker
+    from .disk import DiskEngine
+    from .peer import Peer
+    from .session import SESSION_MAGIC, Session, SessionServer
+except ImportError:
+    from bitfield import Bitfield
+    from choking import Choker
+    from disk import DiskEngine
+    from peer import Peer
+    from session import SESSION_MAGIC, Session, SessionServer
 
 class Network:
-    def __init__(self, discovery_port, tcp_port):
-        """Initialize the network settings and data structures."""
+
+    DEFAULT_BUFFER_SIZE = 64 * 1024
+    MAX_BUFFER_SIZE = 4 * 1024 * 1024
+    SESSION_WORKERS = 16  # Threads reading chunks from disk for session requests
+    PIPELINE_DEPTH = 64  # Outstanding chunk requests per session, as client and as server
+    LISTEN_BACKLOG = 128
+    UPLOAD_SLOTS = 4  # Session clients uploaded to at the same time
+    CONNECT_TIMEOUT = 10.0  # Seconds to wait for a peer to accept a connection
+
+    def __init__(self, discovery_port, tcp_port, ip_address=None, buffer_size=None, socket_buffer_size=None,
+                 upload_slots=None):
+        """
+        Initialize the network settings and data structures.
+
+        Args:
+            discovery_port (int): The UDP port used for peer discovery.
+            tcp_port (int): The TCP port to listen on.
+            ip_address (str): The address to bind and advertise. If omitted, it is probed with get_own_ip.
+            buffer_size (int): The initial size of I/O buffers. Receive buffers grow up to MAX_BUFFER_SIZE.
+            socket_buffer_size (int): SO_SNDBUF/SO_RCVBUF size. If omitted, the kernel autotunes them.
+            upload_slots (int): How many session clients are uploaded to at the same time; the
+                others are choked. Defaults to UPLOAD_SLOTS.
+        """
         self.peer_list = []
         self.udp_socket = None
         self.tcp_socket = None
         self.discovery_port = discovery_port
         self.tcp_port = tcp_port
+        self.ip_address = ip_address
+        self.buffer_size = buffer_size or self.DEFAULT_BUFFER_SIZE
+        self.socket_buffer_size = socket_buffer_size
         self.active_connections = {}
-
-        # Configure logging
-        logging.basicConfig(level=logging.INFO, 
-                    format='%(asctime)s - %(levelname)s - %(message)s',
-                    handlers=[
-                        logging.FileHandler(os.path.join('logs', 'app.log')),
-                        logging.StreamHandler()
-                    ])
+        self.share_index = None  # Resolves file hashes for session chunk requests
+        self.peers = {}  # (ip, port) -> Peer, for peers we hold sessions with
+        self.partial_files = {}  # file hash -> dict with the path, size, chunk size and bitfield of a partial download
+        self.have_listeners = []  # Called as listener(peer, file_hash, index) when a peer announces a chunk
+        self.session_servers = set()
+        self.choker = Choker(upload_slots or self.UPLOAD_SLOTS, download_rate=self.peer_download_rate)
+        self._buffers = threading.local()
+        self._executor = None
+        self._disk = None
+        self._lock = threading.Lock()
 
     # Peer Discovery Methods
     def broadcast_presence(self):
@@ -32,7 +72,7 @@ class Network:
         self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         
         # Prepare the message
-        message = f"Peer at {self.get_own_ip()}:{self.tcp_port}"
+        message = f"Peer at {self.ip_address or self.get_own_ip()}:{self.tcp_port}"
         
         # Encode the message to bytes
         message_bytes = message.encode('utf-8')
@@ -89,14 +129,29 @@ class Network:
             else:
                 logging.info(f"Peer {peer_ip}:{peer_port} is already in the peer list")
 
+    def open_connection(self, ip, port):
+        """
+        Open a tuned TCP connection to a peer, giving up after CONNECT_TIMEOUT seconds.
+
+        Raises:
+            OSError: If the peer can't be reached.
+        """
+        tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.tune_socket(tcp_socket)
+            tcp_socket.settimeout(self.CONNECT_TIMEOUT)
+            tcp_socket.connect((ip, port))
+            tcp_socket.settimeout(None)
+        except BaseException:
+            tcp_socket.close()
+            raise
+        return tcp_socket
+
     def connect_to_peer(self, ip, port):
         """Establish a TCP connection to a given peer."""
         try:
-            # Create a TCP socket
-            tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            
             # Connect to the peer's IP address and port
-            tcp_socket.connect((ip, port))
+            tcp_socket = self.open_connection(ip, port)
             
             # Add the connection to the active connections
             self.active_connections[(ip, port)] = tcp_socket
@@ -108,19 +163,37 @@ class Network:
             # Handle connection errors
             logging.error(f"Failed to connect to peer at {ip}:{port}. Error: {e}")
 
+    def start_listening(self, reuse_port=False):
+        """
+        Bind the TCP listening socket so connections queue up before accept_connections runs.
+
+        Args:
+            reuse_port (bool): Set SO_REUSEPORT so several processes can listen on the same port
+                and the kernel balances incoming connections between them.
+        """
+        # Create a TCP socket
+        self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        
+        # Accepted connections inherit the buffer sizes of the listening socket
+        self.tune_socket(self.tcp_socket, nodelay=False)
+        
+        # Bind the socket to the server's IP address and the TCP port
+        self.tcp_socket.bind((self.ip_address or self.get_own_ip(), self.tcp_port))
+        
+        # Listen for incoming connections
+        self.tcp_socket.listen(self.LISTEN_BACKLOG)  # The argument specifies the number of unaccepted connections that the system will allow before refusing new connections
+        
+        logging.info(f"Listening for incoming connections on port {self.tcp_port}")
+        self.choker.start()
+
     def accept_connections(self):
         """Accept incoming TCP connections and handle them."""
         try:
-            # Create a TCP socket
-            self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            
-            # Bind the socket to the server's IP address and the TCP port
-            self.tcp_socket.bind((self.get_own_ip(), self.tcp_port))
-            
-            # Listen for incoming connections
-            self.tcp_socket.listen(5)  # The argument specifies the number of unaccepted connections that the system will allow before refusing new connections
-            
-            logging.info(f"Listening for incoming connections on port {self.tcp_port}")
+            if self.tcp_socket is None:
+                self.start_listening()
             
             while True:
                 # Accept a new connection
@@ -136,10 +209,12 @@ class Network:
             # Close the socket if needed
             if self.tcp_socket:
                 self.tcp_socket.close()
+                self.tcp_socket = None
 
     def handle_new_connection(self, connection, address):
         """Handle a new connection, possibly creating a new thread or task."""
         logging.info(f"Handling new connection from {address}")
+        self.tune_socket(connection)
         # Create a new thread to handle the connection
         connection_thread = threading.Thread(target=self.connection_handler, args=(connection, address))
         connection_thread.start()
@@ -147,9 +222,28 @@ class Network:
     def connection_handler(self, connection, address):
         """Handle communication with the connected peer."""
         try:
+            # Clients that open with SESSION_MAGIC speak the multiplexed session protocol
+            data = connection.recv(self.buffer_size)
+            while data and len(data) < len(SESSION_MAGIC) and SESSION_MAGIC.startswith(data):
+                more = connection.recv(self.buffer_size)
+                if not more:
+                    break
+                data += more
+            if data.startswith(SESSION_MAGIC):
+                logging.info(f"Serving session for {address}")
+                server = SessionServer(connection, self.read_chunk, self.get_executor(),
+                                       file_size=self.file_size, bitfield=self.local_bitfield, address=address,
+                                       max_inflight=self.PIPELINE_DEPTH)
+                self.session_servers.add(server)
+                self.choker.add(server)
+                try:
+                    server.serve(initial=data[len(SESSION_MAGIC):])
+                finally:
+                    self.session_servers.discard(server)
+                    self.choker.remove(server)
+                return
+
             while True:
-                # Example: Receiving data from the connection
-                data = connection.recv(4096)
                 if not data:
                     break  # Connection closed by the peer
                 # Process the received data (e.g., save it, forward it, etc.)
@@ -158,6 +252,9 @@ class Network:
                 # Example: Sending a response (if needed)
                 response = f"Echo: {data.decode('utf-8')}"
                 connection.sendall(response.encode('utf-8'))
+
+                # Example: Receiving data from the connection
+                data = connection.recv(self.buffer_size)
         
         except Exception as e:
             logging.error(f"Error handling connection from {address}: {e}")
@@ -167,16 +264,206 @@ class Network:
             connection.close()
             logging.info(f"Connection from {address} closed")
 
+    # Session Methods
+    def get_session(self, ip, port):
+        """
+        Return the multiplexed session to a peer, connecting if there is none yet.
+
+        Sessions live in active_connections, so each peer gets one session shared by all requests.
+
+        Raises:
+            ConnectionError: If the peer can't be reached.
+        """
+        with self._lock:
+            connection = self.active_connections.get((ip, port))
+            if isinstance(connection, Session) and not connection.closed:
+                return connection
+            if connection is not None and not isinstance(connection, Session):
+                # Take over a plain connection made with connect_to_peer
+                return self._start_session(ip, port, connection)
+
+        # Connect without holding the lock, so an unreachable peer doesn't hold up everything else
+        try:
+            connection = self.open_connection(ip, port)
+        except OSError as e:
+            raise ConnectionError(f"Failed to connect to peer at {ip}:{port}: {e}") from e
+        logging.info(f"Connected to peer at {ip}:{port}")
+
+        with self._lock:
+            existing = self.active_connections.get((ip, port))
+            if isinstance(existing, Session) and not existing.closed:
+                connection.close()  # Another thread connected first
+                return existing
+            return self._start_session(ip, port, connection)
+
+    def _start_session(self, ip, port, connection):
+        """Start a session on a connection and register it. Called with the lock held."""
+        session = Session(connection, max_outstanding=self.PIPELINE_DEPTH)
+        if self.tcp_socket is not None:
+            session.hello(self.tcp_socket.getsockname()[1])
+        peer = self.get_peer(ip, port)
+        session.on_have = lambda file_hash, index: self.handle_have(peer, file_hash, index)
+        self.active_connections[(ip, port)] = session
+        return session
+
+    def get_peer(self, ip, port):
+        """Return the Peer record for an address, creating it on first use."""
+        peer = self.peers.get((ip, port))
+        if peer is None:
+            peer = self.peers.setdefault((ip, port), Peer(f"{ip}:{port}", ip, port))
+        return peer
+
+    def peer_download_rate(self, server):
+        """Return the bytes/s we download from the peer behind a session client, or None if unknown."""
+        if server.address is None or server.peer_port is None:
+            return None
+        peer = self.peers.get((server.address[0], server.peer_port))
+        return peer.throughput if peer else None
+
+    def handle_have(self, peer, file_hash, index):
+        """Record a chunk a peer announced and pass it on to the listeners."""
+        bitfield = peer.chunk_bitfields.get(file_hash)
+        if bitfield is not None and not 0 <= index < bitfield.length:
+            logging.error(f"Peer {peer.ip_address}:{peer.port} announced chunk {index} of {file_hash}, "
+                          f"which has {bitfield.length} chunks")
+            return
+        if peer.have_chunk(file_hash, index):
+            for listener in self.have_listeners:
+                listener(peer, file_hash, index)
+
+    # Partial File Methods
+    def register_partial(self, file_hash, path, size, chunk_size, bitfield):
+        """
+        Serve the chunks of a partial download that are already on disk.
+
+        Only this Network serves them. With serving worker processes, which share only the
+        share index snapshot, a download is served once it is complete and in the snapshot.
+        """
+        self.partial_files[file_hash] = {'path': path, 'size': size, 'chunk_size': chunk_size, 'bitfield': bitfield}
+
+    def unregister_partial(self, file_hash):
+        """Stop serving a partial download."""
+        self.partial_files.pop(file_hash, None)
+
+    def announce_have(self, file_hash, index):
+        """Record a newly written chunk of a partial download and announce it to subscribed clients."""
+        partial = self.partial_files.get(file_hash)
+        if partial is not None:
+            partial['bitfield'].set(index)
+        for server in list(self.session_servers):
+            server.send_have(file_hash, index)
+
+    def local_bitfield(self, file_hash, chunk_size):
+        """
+        Return the chunks of a file this node can serve, for a session BITFIELD request.
+
+        Raises:
+            ValueError: If the file is neither shared nor partially downloaded in that chunk size.
+        """
+        file = self.share_index.lookup(file_hash) if self.share_index else None
+        if file is not None:
+            return Bitfield.full(-(-file.file_size // chunk_size))
+        partial = self.partial_files.get(file_hash)
+        if partial is not None and partial['chunk_size'] == chunk_size:
+            bitfield = partial['bitfield']
+            return Bitfield(bitfield.length, bitfield.bits)
+        raise ValueError(f"File {file_hash} is not shared")
+
+    def get_executor(self):
+        """Return the thread pool that serves session chunk reads, creating it on first use."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.SESSION_WORKERS)
+            return self._executor
+
+    def get_disk(self):
+        """Return the disk engine that stores received files, creating it on first use."""
+        with self._lock:
+            if self._disk is None:
+                self._disk = DiskEngine()
+            return self._disk
+
+    def file_size(self, file_hash):
+        """
+        Return the size of a shared file for a session STAT request.
+
+        Raises:
+            ValueError: If the file isn't shared.
+        """
+        file = self.share_index.lookup(file_hash) if self.share_index else None
+        if file is not None:
+            return file.file_size
+        partial = self.partial_files.get(file_hash)
+        if partial is not None:
+            return partial['size']
+        raise ValueError(f"File {file_hash} is not shared")
+
+    def read_chunk(self, file_hash, offset, length):
+        """
+        Read a byte range of a shared file for a session request.
+
+        Raises:
+            ValueError: If the file isn't shared or the range is invalid.
+        """
+        file = self.share_index.lookup(file_hash) if self.share_index else None
+        if file is not None:
+            path, size = file.file_path, file.file_size
+        else:
+            partial = self.partial_files.get(file_hash)
+            if partial is None:
+                raise ValueError(f"File {file_hash} is not shared")
+            path, size = partial['path'], partial['size']
+            chunk_size = partial['chunk_size']
+            last = (offset + length - 1) // chunk_size if length else offset // chunk_size
+            if any(index not in partial['bitfield'] for index in range(offset // chunk_size, last + 1)):
+                raise ValueError(f"Range {offset}+{length} of {file_hash} is not downloaded yet")
+        if offset < 0 or length < 0 or offset + length > size:
+            raise ValueError(f"Range {offset}+{length} is outside file {file_hash}")
+        with open(path, 'rb', buffering=0) as f:
+            return os.pread(f.fileno(), length, offset)
+
     # Data Transmission Methods
+    def tune_socket(self, connection, nodelay=True):
+        """
+        Apply socket options to a TCP connection.
+
+        Args:
+            connection (socket.socket): The connection to tune.
+            nodelay (bool): Disable Nagle's algorithm so small control messages go out immediately.
+        """
+        try:
+            if self.socket_buffer_size:
+                # Fixed buffers disable the kernel's autotuning, so only set them when configured
+                connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.socket_buffer_size)
+                connection.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.socket_buffer_size)
+            if nodelay:
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError as e:
+            logging.error(f"Failed to tune socket options: {e}")
+
+    def get_buffer(self):
+        """Return this thread's reusable receive buffer, allocating it on first use."""
+        buffer = getattr(self._buffers, 'buffer', None)
+        if buffer is None:
+            buffer = self._buffers.buffer = bytearray(self.buffer_size)
+        return buffer
+
+    def grow_buffer(self, buffer):
+        """Double this thread's receive buffer, up to MAX_BUFFER_SIZE, after a read filled it completely."""
+        if len(buffer) >= self.MAX_BUFFER_SIZE:
+            return buffer
+        buffer = self._buffers.buffer = bytearray(min(len(buffer) * 2, self.MAX_BUFFER_SIZE))
+        return buffer
+
     def send_data(self, connection, data):
         """Send data (e.g., file chunks, messages) over a TCP connection."""
-        buffer_size = 4096  # Size of each chunk to be sent
         try:
             # Ensure data is in bytes
             if isinstance(data, str):
                 data = data.encode('utf-8')  # Convert string to bytes
-            for i in range(0, len(data), buffer_size):
-                connection.sendall(data[i:i+buffer_size])
+            view = memoryview(data)
+            for i in range(0, len(view), self.buffer_size):
+                connection.sendall(view[i:i+self.buffer_size])
             logging.info(f"Data sent to {connection} successfully")
         
         except Exception as e:
@@ -184,17 +471,19 @@ class Network:
 
     def receive_data(self, connection):
         """Receive data from a TCP connection."""
-        buffer_size = 4096 
         data_buffer = bytearray()  # Initialize a buffer to store incoming data
+        buffer = self.get_buffer()
 
         try:
             while True:
-                # Receive data in chunks
-                chunk = connection.recv(buffer_size)
-                if not chunk:
-                    # If chunk is empty, the connection is closed
+                # Receive data into the reusable buffer
+                received = connection.recv_into(buffer)
+                if not received:
+                    # If nothing was received, the connection is closed
                     break
-                data_buffer.extend(chunk)
+                data_buffer += memoryview(buffer)[:received]
+                if received == len(buffer):
+                    buffer = self.grow_buffer(buffer)
         except Exception as e:
             logging.error(f"An error occurred while receiving data: {e}")
 
@@ -203,49 +492,84 @@ class Network:
 
     def send_file(self, file_path, connection):
         """Send a file over a TCP connection, splitting it into chunks if necessary."""
-        buffer_size = 4096  # Size of each chunk to be sent
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
 
         try:
-            # Open the file in binary read mode
-            with open(file_path, 'rb') as file:
+            # Open the file in binary read mode without Python-level buffering
+            with open(file_path, 'rb', buffering=0) as file:
                 while True:
                     # Read a chunk of data from the file
-                    data_chunk = file.read(buffer_size)
+                    read = file.readinto(buffer)
                     
-                    # If the chunk is empty, end of file is reached
-                    if not data_chunk:
+                    # If nothing was read, end of file is reached
+                    if not read:
                         break
                     
                     # Send the chunk over the connection
-                    connection.sendall(data_chunk)
+                    connection.sendall(view[:read])
                     
             logging.info(f"File {file_path} sent successfully.")
 
         except Exception as e:
             logging.error(f"An error occurred while sending the file: {e}")
 
-    def receive_file(self, destination_path, connection):
-        """Receive a file over a TCP connection and save it to the specified path."""
-        buffer_size = 4096  # Size of each chunk to be received
+    def receive_file(self, destination_path, connection, size=None):
+        """
+        Receive a file over a TCP connection and save it to the specified path.
+
+        The received data goes through the disk engine, which writes it in large coalesced
+        writes on its own threads, so the receiving thread goes straight back to the socket.
+
+        Args:
+            destination_path (str): Where to save the file.
+            connection (socket.socket): The connection the file arrives on, until it is closed.
+            size (int): The expected size, if known, to reserve the file's space up front.
+
+        Returns:
+            Future: Resolves to the number of bytes saved once they are on disk, or fails with
+                the error that stopped the file from being received or saved.
+        """
+        disk = self.get_disk()
+        buffer = self.get_buffer()
+        offset = 0
+        error = None
 
         try:
-            # Open the destination file in binary write mode
-            with open(destination_path, 'wb') as file:
-                while True:
-                    # Receive a chunk of data from the connection
-                    data_chunk = connection.recv(buffer_size)
-                    
-                    # If the chunk is empty, the connection is closed
-                    if not data_chunk:
-                        break
-                    
-                    # Write the chunk to the file
-                    file.write(data_chunk)
-                    
-            logging.info(f"File received successfully and saved to {destination_path}.")
+            disk.open(destination_path, size, truncate=True)
+            while True:
+                # Receive a chunk of data into the reusable buffer
+                received = connection.recv_into(buffer)
+                
+                # If nothing was received, the connection is closed
+                if not received:
+                    break
+                
+                # The engine holds on to the data until it is written, so it gets a copy of just what arrived
+                disk.write(destination_path, offset, bytes(memoryview(buffer)[:received]))
+                offset += received
+                if received == len(buffer):
+                    buffer = self.grow_buffer(buffer)
 
         except Exception as e:
-            logging.error(f"An error occurred while receiving the file: {e}")
+            error = e
+
+        # Trim the space reserved beyond what arrived
+        trim = error is not None or (size is not None and offset != size)
+        closed = disk.close_file(destination_path, length=offset if trim else None)
+        result = Future()
+
+        def saved(closed):
+            failure = error or closed.exception()
+            if failure is not None:
+                logging.error(f"An error occurred while receiving the file: {failure}")
+                result.set_exception(failure)
+            else:
+                logging.info(f"File received successfully and saved to {destination_path}.")
+                result.set_result(offset)
+
+        closed.add_done_callback(saved)
+        return result
 
     def handle_network_error(self, error):
         """Handle network-related errors or exceptions."""
@@ -317,6 +641,15 @@ class Network:
         # Clear the active connections dictionary
         self.active_connections.clear()
 
+        # Stop choking rounds and the threads serving session chunk reads
+        self.choker.stop()
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._disk:
+            self._disk.close()
+            self._disk = None
+
         # Close the UDP socket if it exists
         if self.udp_socket:
             try:
@@ -326,10 +659,16 @@ class Network:
 
         # Close the TCP socket if it exists
         if self.tcp_socket:
+            try:
+                # Wake a thread blocked in accept(); closing alone leaves the socket listening until it returns
+                self.tcp_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             try:
                 self.tcp_socket.close()
             except Exception as e:
                 logging.error(f"Error closing TCP socket: {e}")
+            self.tcp_socket = None
 
         logging.info("All connections and sockets closed.")
 
@@ -1,4 +1,97 @@
+import bisect
+import threading
+from array import array
+
+
+class FileIds:
+
+    def __init__(self):
+        """
+        Initialize the registry that numbers every distinct file hash once, for all peers.
+
+        Ids are reference counted by the peers sharing the file. Once none does, the hash is
+        forgotten and its id reused, so the registry only grows with the files shared at once.
+        """
+        self._ids = {}  # file hash -> id
+        self._hashes = []  # id -> file hash, or None while the id is free
+        self._counts = array('I')  # id -> number of peers sharing the file
+        self._free = []  # Released ids, reused before new ones are numbered
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Return the number of file hashes currently numbered."""
+        return len(self._ids)
+
+    def get(self, file_hash):
+        """Return the id of a file hash, or None if no peer shares it."""
+        return self._ids.get(file_hash)
+
+    def acquire(self, file_hash):
+        """Return the id of a file hash for one more peer sharing it, numbering the hash if it is new."""
+        with self._lock:
+            file_id = self._ids.get(file_hash)
+            if file_id is None:
+                if self._free:
+                    file_id = self._free.pop()
+                    self._hashes[file_id] = file_hash
+                else:
+                    file_id = len(self._hashes)
+                    self._hashes.append(file_hash)
+                    self._counts.append(0)
+                self._ids[file_hash] = file_id
+            self._counts[file_id] += 1
+            return file_id
+
+    def release(self, file_id):
+        """Drop a peer's reference to an id, forgetting its hash once no peer shares the file."""
+        with self._lock:
+            self._counts[file_id] -= 1
+            if not self._counts[file_id]:
+                del self._ids[self._hashes[file_id]]
+                self._hashes[file_id] = None
+                self._free.append(file_id)
+
+    def hash(self, file_id):
+        """Return the file hash with the given id."""
+        return self._hashes[file_id]
+
+
+class SharedFiles:
+
+    __slots__ = ('_peer',)
+
+    def __init__(self, peer):
+        """
+        Initialize a live, read-only view of a peer's shared file hashes.
+
+        The view keeps the peer alive, so the ids it reads stay referenced.
+        """
+        self._peer = peer
+
+    def __contains__(self, file_hash):
+        ids = self._peer._shared_ids
+        file_id = Peer.file_ids.get(file_hash)
+        if file_id is None:
+            return False
+        position = bisect.bisect_left(ids, file_id)
+        return position < len(ids) and ids[position] == file_id
+
+    def __iter__(self):
+        return (Peer.file_ids.hash(file_id) for file_id in self._peer._shared_ids)
+
+    def __len__(self):
+        return len(self._peer._shared_ids)
+
+
 class Peer:
+
+    __slots__ = ('peer_id', 'ip_address', 'port', 'status', 'last_seen', '_shared_ids', 'chunk_bitfields',
+                 'throughput', 'rtt', 'failure_rate')
+
+    file_ids = FileIds()  # Shared by all peers, so each hash string is held once however many peers share it
+
+    EWMA_WEIGHT = 0.3  # Weight of the newest sample in the moving averages of performance
+
     def __init__(self, peer_id, ip_address, port):
         """Initialize the peer with an ID, IP address, and port."""
         self.peer_id = peer_id
@@ -6,25 +99,105 @@ class Peer:
         self.port = port
         self.status = 'active'
         self.last_seen = None
-        self.shared_files = []
+        # Sorted ids of the shared files' hashes; the File objects are resolved through the ShareIndex
+        self._shared_ids = array('I')
+        # Chunk availability of files the peer has in part or in full, keyed by file hash
+        self.chunk_bitfields = {}
+        # Exponentially weighted moving averages of measured performance; None until measured
+        self.throughput = None  # Bytes per second delivered
+        self.rtt = None  # Seconds for a request without payload to be answered
+        self.failure_rate = 0.0  # Share of requests that failed
+
+    @staticmethod
+    def file_key(file):
+        """Return the key a file is stored under: its hash when it has one, otherwise the value itself."""
+        return getattr(file, 'file_hash', file)
 
     def update_status(self, status):
         """Update the status of the peer."""
         self.status = status
 
+    @property
+    def shared_files(self):
+        """A live view of the hashes of the shared files."""
+        return SharedFiles(self)
+
     def add_shared_file(self, file):
-        """Add a file to the peer's shared files list."""
-        self.shared_files.append(file)
+        """Add a file to the peer's shared files."""
+        file_id = self.file_ids.acquire(self.file_key(file))
+        position = bisect.bisect_left(self._shared_ids, file_id)
+        if position == len(self._shared_ids) or self._shared_ids[position] != file_id:
+            self._shared_ids.insert(position, file_id)
+        else:
+            self.file_ids.release(file_id)  # Already shared; the peer holds one reference per file
 
     def remove_shared_file(self, file):
-        """Remove a file from the peer's shared files list."""
-        if file in self.shared_files:
-            self.shared_files.remove(file)
+        """Remove a file from the peer's shared files."""
+        file_id = self.file_ids.get(self.file_key(file))
+        if file_id is None:
+            return
+        position = bisect.bisect_left(self._shared_ids, file_id)
+        if position < len(self._shared_ids) and self._shared_ids[position] == file_id:
+            del self._shared_ids[position]
+            self.file_ids.release(file_id)
+
+    def __del__(self):
+        """Release the ids of the files the peer still shares."""
+        for file_id in getattr(self, '_shared_ids', ()):
+            self.file_ids.release(file_id)
+
+    def has_shared_file(self, file_hash):
+        """Check whether the peer shares the file with the given hash."""
+        return file_hash in self.shared_files
 
     def get_shared_files(self):
-        """Retrieve the list of shared files."""
+        """Retrieve a live view of the hashes of the shared files."""
         return self.shared_files
 
+    def set_bitfield(self, file_hash, bitfield):
+        """Record which chunks of a file the peer has."""
+        self.chunk_bitfields[file_hash] = bitfield
+
+    def have_chunk(self, file_hash, index):
+        """Record a chunk the peer announced. Returns True if it wasn't known before."""
+        bitfield = self.chunk_bitfields.get(file_hash)
+        return bitfield is not None and bitfield.set(index)
+
+    def has_chunk(self, file_hash, index):
+        """Check whether the peer has a chunk of a file."""
+        bitfield = self.chunk_bitfields.get(file_hash)
+        return bitfield is not None and index in bitfield
+
+    @classmethod
+    def _average(cls, average, sample):
+        """Fold a sample into an exponentially weighted moving average."""
+        return sample if average is None else average + cls.EWMA_WEIGHT * (sample - average)
+
+    def record_transfer(self, size, seconds):
+        """Record a request that delivered size bytes in the given seconds."""
+        self.throughput = self._average(self.throughput, size / max(seconds, 1e-6))
+        self.failure_rate = self._average(self.failure_rate, 0.0)
+
+    def record_rtt(self, seconds):
+        """Record the round-trip time of a request without payload."""
+        self.rtt = self._average(self.rtt, seconds)
+
+    def record_failure(self):
+        """Record a request that failed or timed out."""
+        self.failure_rate = self._average(self.failure_rate, 1.0)
+
+    def expected_time(self, size):
+        """
+        Estimate how long the peer takes to deliver size bytes, counting the retries its failures cause.
+
+        Returns:
+            float: The seconds, or None if the peer's throughput hasn't been measured yet.
+        """
+        if self.throughput is None:
+            return None
+        seconds = (self.rtt or 0.0) + size / self.throughput
+        return seconds / max(1.0 - self.failure_rate, 0.1)
+
     def update_last_seen(self, timestamp):
         """Update the last seen timestamp."""
         self.last_seen = timestamp
@@ -37,5 +210,8 @@ class Peer:
             'port': self.port,
             'status': self.status,
             'last_seen': self.last_seen,
+            'throughput': self.throughput,
+            'rtt': self.rtt,
+            'failure_rate': self.failure_rate,
             'shared_files': self.shared_files
         }
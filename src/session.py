@@ -0,0 +1,527 @@
+import itertools
+import logging
+import queue
+import socket
+import struct
+import threading
+from concurrent.futures import Future
+
+try:
+    from .bitfield import Bitfield
+except ImportError:
+    from bitfield import Bitfield
+
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)  # Linux only
+
+# Sent by the client as the first bytes of a connection to switch it to the session protocol
+SESSION_MAGIC = b'P2PS\x01'
+
+# Every frame starts with a header: frame type, request id, payload length
+FRAME_HEADER = struct.Struct('!BII')
+# REQUEST payload: raw SHA-256 file hash, offset, length
+REQUEST_PAYLOAD = struct.Struct('!32sQI')
+# STAT payload: raw SHA-256 file hash; answered with the file size
+STAT_PAYLOAD = struct.Struct('!32s')
+SIZE_PAYLOAD = struct.Struct('!Q')
+# BITFIELD payload: raw SHA-256 file hash, chunk size; answered with the chunk count and encoded bitfield
+BITFIELD_PAYLOAD = struct.Struct('!32sI')
+BITFIELD_HEADER = struct.Struct('!I')
+# HAVE payload: raw SHA-256 file hash, chunk index; sent unsolicited with request id 0
+HAVE_PAYLOAD = struct.Struct('!32sI')
+# HELLO payload: the TCP port the client serves on, so the server can tell which peer it is
+HELLO_PAYLOAD = struct.Struct('!H')
+
+REQUEST = 1
+DATA = 2
+CANCEL = 3
+ERROR = 4
+STAT = 5
+BITFIELD = 6
+HAVE = 7
+HELLO = 8
+CHOKE = 9  # The server queues further chunk requests until it sends UNCHOKE
+UNCHOKE = 10
+
+MAX_PAYLOAD_SIZE = 64 * 1024 * 1024
+# The longest chunk a server reads for one request: the download manager's chunk size
+MAX_CHUNK_LENGTH = 1024 * 1024
+
+
+class SessionError(Exception):
+    """Raised for a request the remote peer answered with an error."""
+
+
+class FrameReader:
+    def __init__(self, connection, initial=b''):
+        """
+        Initialize a reader of session frames.
+
+        Args:
+            connection (socket.socket): The connection to read from.
+            initial (bytes): Bytes already received from the connection.
+        """
+        self.connection = connection
+        self.pending = bytearray(initial)
+
+    def read_exactly(self, size):
+        """Read exactly size bytes, or return None if the connection closes first."""
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        filled = min(size, len(self.pending))
+        view[:filled] = self.pending[:filled]
+        del self.pending[:filled]
+        while filled < size:
+            received = self.connection.recv_into(view[filled:])
+            if not received:
+                return None
+            filled += received
+        return buffer
+
+    def read_frame(self):
+        """Read one frame as (frame type, request id, payload), or return None at end of stream."""
+        header = self.read_exactly(FRAME_HEADER.size)
+        if header is None:
+            return None
+        frame_type, request_id, length = FRAME_HEADER.unpack(header)
+        if length > MAX_PAYLOAD_SIZE:
+            raise SessionError(f"Frame payload of {length} bytes exceeds the limit")
+        payload = self.read_exactly(length)
+        if payload is None:
+            return None
+        return frame_type, request_id, payload
+
+
+def send_chunk(connection, header, payload):
+    """
+    Send a header together with its payload.
+
+    MSG_MORE (where available) holds the header back so it leaves in the same segment as the payload.
+    """
+    connection.sendall(header, MSG_MORE)
+    connection.sendall(payload)
+
+
+def send_frame(connection, frame_type, request_id, payload=b''):
+    """Send one frame; a payload goes out in the same segment as the header."""
+    header = FRAME_HEADER.pack(frame_type, request_id, len(payload))
+    if payload:
+        send_chunk(connection, header, payload)
+    else:
+        connection.sendall(header)
+
+
+class Session:
+    def __init__(self, connection, max_outstanding=64):
+        """
+        Initialize the client side of a multiplexed session on a connected socket.
+
+        Args:
+            connection (socket.socket): A connection to a peer's TCP port.
+            max_outstanding (int): The pipeline depth: how many requests may be in flight at once.
+        """
+        self.connection = connection
+        self.closed = False
+        self.on_have = None  # Called as on_have(file_hash, index) when the peer announces a new chunk
+        self.choked = False  # Whether the peer said it holds back our chunk requests
+        self._pending = {}  # request id -> (Future, decoder of the DATA payload)
+        self._request_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_outstanding)
+
+        connection.sendall(SESSION_MAGIC)
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def request_chunk(self, file_hash, offset, length):
+        """
+        Request a byte range of a shared file, blocking while the pipeline is full.
+
+        Args:
+            file_hash (str): The SHA-256 hash of the file, as a hex string.
+            offset (int): The offset of the first byte.
+            length (int): The number of bytes.
+
+        Returns:
+            Future: Resolves to the chunk as a bytearray, or fails with SessionError or ConnectionError.
+        """
+        return self._request(REQUEST, REQUEST_PAYLOAD.pack(bytes.fromhex(file_hash), offset, length))
+
+    def stat_file(self, file_hash):
+        """
+        Ask for the size of a shared file.
+
+        Returns:
+            Future: Resolves to the size in bytes, or fails with SessionError or ConnectionError.
+        """
+        return self._request(STAT, STAT_PAYLOAD.pack(bytes.fromhex(file_hash)),
+                             decode=lambda payload: SIZE_PAYLOAD.unpack(payload)[0])
+
+    def request_bitfield(self, file_hash, chunk_size):
+        """
+        Ask which chunks of a file the peer has, and subscribe to its HAVE announcements for the file.
+
+        Args:
+            file_hash (str): The SHA-256 hash of the file, as a hex string.
+            chunk_size (int): The chunk size the bitfield is expressed in.
+
+        Returns:
+            Future: Resolves to a Bitfield, or fails with SessionError or ConnectionError.
+        """
+        def decode(payload):
+            length, = BITFIELD_HEADER.unpack_from(payload)
+            try:
+                return Bitfield.decode(length, bytes(payload[BITFIELD_HEADER.size:]))
+            except ValueError as e:
+                raise struct.error(str(e))
+
+        return self._request(BITFIELD, BITFIELD_PAYLOAD.pack(bytes.fromhex(file_hash), chunk_size), decode=decode)
+
+    def hello(self, port):
+        """Tell the peer which TCP port we serve on, so it can credit our uploads to it when choking."""
+        try:
+            with self._send_lock:
+                send_frame(self.connection, HELLO, 0, HELLO_PAYLOAD.pack(port))
+        except OSError as e:
+            logging.error(f"Failed to send hello: {e}")
+
+    def _request(self, frame_type, payload, decode=None):
+        """Send a request frame, blocking while the pipeline is full, and return its Future."""
+        self._slots.acquire()
+        future = Future()
+        with self._lock:
+            if self.closed:
+                self._slots.release()
+                raise ConnectionError("Session is closed")
+            request_id = next(self._request_ids)
+            future.request_id = request_id
+            self._pending[request_id] = (future, decode)
+
+        try:
+            with self._send_lock:
+                send_frame(self.connection, frame_type, request_id, payload)
+        except OSError as e:
+            self._finish(request_id, error=ConnectionError(f"Failed to send request: {e}"))
+        return future
+
+    def cancel(self, future):
+        """Cancel an outstanding request. Returns False if it already completed."""
+        if not self._finish(future.request_id, cancel=True):
+            return False
+        try:
+            with self._send_lock:
+                send_frame(self.connection, CANCEL, future.request_id)
+        except OSError as e:
+            logging.error(f"Failed to send cancellation: {e}")
+        return True
+
+    def outstanding(self):
+        """Return the number of requests in flight."""
+        with self._lock:
+            return len(self._pending)
+
+    def _finish(self, request_id, result=None, error=None, cancel=False):
+        """Resolve a pending request and free its pipeline slot. Returns False if it wasn't pending."""
+        with self._lock:
+            pending = self._pending.pop(request_id, None)
+        if pending is None:
+            return False
+        self._slots.release()
+        future, decode = pending
+        if error is None and not cancel and decode is not None:
+            try:
+                result = decode(result)
+            except struct.error as e:
+                error = SessionError(f"Malformed response: {e}")
+        if cancel or future.cancelled():
+            future.cancel()
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+        return True
+
+    def _read_loop(self):
+        """Dispatch responses, in whatever order they arrive, to their pending requests."""
+        reader = FrameReader(self.connection)
+        error = ConnectionError("Session closed by peer")
+        try:
+            while True:
+                frame = reader.read_frame()
+                if frame is None:
+                    break
+                frame_type, request_id, payload = frame
+                if frame_type == DATA:
+                    self._finish(request_id, result=payload)
+                elif frame_type == ERROR:
+                    self._finish(request_id, error=SessionError(payload.decode('utf-8', 'replace')))
+                elif frame_type == HAVE:
+                    raw_hash, index = HAVE_PAYLOAD.unpack(payload)
+                    if self.on_have:
+                        self.on_have(raw_hash.hex(), index)
+                elif frame_type == CHOKE:
+                    self.choked = True
+                elif frame_type == UNCHOKE:
+                    self.choked = False
+                else:
+                    logging.error(f"Unexpected session frame type {frame_type}")
+        except (OSError, SessionError, struct.error) as e:
+            if not self.closed:
+                error = ConnectionError(f"Session failed: {e}")
+        finally:
+            with self._lock:
+                self.closed = True
+                request_ids = list(self._pending)
+            for request_id in request_ids:
+                self._finish(request_id, error=error)
+
+    def close(self):
+        """Close the session, failing any outstanding requests."""
+        with self._lock:
+            self.closed = True
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.connection.close()
+
+
+class SessionServer:
+    def __init__(self, connection, read_chunk, executor, file_size=None, bitfield=None, address=None,
+                 max_inflight=64):
+        """
+        Initialize the serving side of a multiplexed session.
+
+        Args:
+            connection (socket.socket): The accepted connection.
+            read_chunk (callable): Called as read_chunk(file_hash, offset, length) and returns the bytes.
+            executor (concurrent.futures.Executor): Runs the reads so they complete, and are answered, out of order.
+            file_size (callable): Called as file_size(file_hash) to answer STAT requests.
+            bitfield (callable): Called as bitfield(file_hash, chunk_size) to answer BITFIELD requests.
+            address (tuple): The client's (ip, port).
+            max_inflight (int): How many chunk requests are read or wait to be sent at once; further
+                requests wait unread. Bounds the executor threads and the memory one client takes.
+        """
+        self.connection = connection
+        self.read_chunk = read_chunk
+        self.file_size = file_size
+        self.bitfield = bitfield
+        self.executor = executor
+        self.address = address
+        self.max_inflight = max_inflight
+        self.subscriptions = set()  # Hashes of files the client receives HAVE announcements for
+        self.peer_port = None  # The port the client serves on, once it said hello
+        self.choked = False  # While choked, chunk requests wait instead of being read
+        self.on_interested = None  # Called as on_interested(server) when a choked client requests a chunk
+        self.on_idle = None  # Called as on_idle(server) when the last outstanding request has been answered
+        self.requests = 0  # Chunk requests received
+        self.uploaded = 0  # Bytes of chunk data sent
+        self._inflight = {}  # request id -> Future (None until submitted) of a request being read or sent
+        self._waiting = {}  # request id -> arguments of a chunk request held back while choked or at the limit
+        self._outgoing = queue.Queue()  # (frame type, request id, payload, is an answer); None stops the writer
+        self._lock = threading.Lock()
+
+    def serve(self, initial=b''):
+        """Serve requests until the client disconnects."""
+        writer = threading.Thread(target=self._write_loop, daemon=True)
+        writer.start()
+        reader = FrameReader(self.connection, initial)
+        try:
+            while True:
+                frame = reader.read_frame()
+                if frame is None:
+                    break
+                frame_type, request_id, payload = frame
+                if frame_type == REQUEST:
+                    raw_hash, offset, length = REQUEST_PAYLOAD.unpack(payload)
+                    self._request_chunk(request_id, raw_hash.hex(), offset, length)
+                elif frame_type == STAT:
+                    raw_hash, = STAT_PAYLOAD.unpack(payload)
+                    self._submit(request_id, self._stat, raw_hash.hex())
+                elif frame_type == BITFIELD:
+                    raw_hash, chunk_size = BITFIELD_PAYLOAD.unpack(payload)
+                    self.subscriptions.add(raw_hash.hex())
+                    self._submit(request_id, self._bitfield, raw_hash.hex(), chunk_size)
+                elif frame_type == HELLO:
+                    self.peer_port, = HELLO_PAYLOAD.unpack(payload)
+                elif frame_type == CANCEL:
+                    with self._lock:
+                        future = self._inflight.pop(request_id, None)
+                        self._waiting.pop(request_id, None)
+                    if future is not None:
+                        future.cancel()
+                    self._start_waiting()  # The cancelled request may have freed a slot
+                else:
+                    logging.error(f"Unexpected session frame type {frame_type}")
+        except (OSError, SessionError, struct.error) as e:
+            logging.error(f"Session ended with an error: {e}")
+        finally:
+            with self._lock:
+                futures = [future for future in self._inflight.values() if future is not None]
+                self._inflight.clear()
+                self._waiting.clear()
+            for future in futures:
+                future.cancel()
+            self._outgoing.put(None)
+
+    def _submit(self, request_id, produce, *args):
+        """Answer a request on the executor."""
+        with self._lock:
+            self._inflight[request_id] = None
+        self._start(request_id, produce, *args)
+
+    def _start(self, request_id, produce, *args):
+        """Run a request whose slot in _inflight is reserved on the executor."""
+        future = self.executor.submit(self._answer, request_id, produce, *args)
+        with self._lock:
+            if request_id in self._inflight:  # Otherwise it was cancelled, or already answered
+                self._inflight[request_id] = future
+
+    def _request_chunk(self, request_id, file_hash, offset, length):
+        """Read and send a chunk, or hold the request back while the client is choked or at the limit."""
+        if length > MAX_CHUNK_LENGTH:
+            # Refused without reading it, so no client can make us hold more than a chunk per request
+            self._send_error(request_id, f"Chunk of {length} bytes exceeds the limit of {MAX_CHUNK_LENGTH}")
+            return
+        with self._lock:
+            self.requests += 1
+            choked = self.choked
+            start = not choked and len(self._inflight) < self.max_inflight
+            if start:
+                self._inflight[request_id] = None
+            else:
+                self._waiting[request_id] = (file_hash, offset, length)
+        if start:
+            self._start(request_id, self.read_chunk, file_hash, offset, length)
+        elif choked and self.on_interested:
+            self.on_interested(self)
+
+    def _start_waiting(self):
+        """Start the chunk requests that waited, as far as the client is unchoked and below the limit."""
+        with self._lock:
+            started = []
+            while self._waiting and not self.choked and len(self._inflight) < self.max_inflight:
+                request_id = next(iter(self._waiting))
+                started.append((request_id, self._waiting.pop(request_id)))
+                self._inflight[request_id] = None
+        for request_id, args in started:
+            self._start(request_id, self.read_chunk, *args)
+
+    def waiting(self):
+        """Return the number of chunk requests held back or being answered."""
+        with self._lock:
+            return len(self._waiting) + len(self._inflight)
+
+    def choke(self, send=True):
+        """
+        Stop reading chunks for the client; its further requests wait until unchoke().
+
+        Args:
+            send (bool): Tell the client now. If False, only the state changes, and the caller
+                sends it with send_choke_state() later, e.g. after releasing its own locks.
+
+        Returns:
+            bool: True if the client wasn't choked before.
+        """
+        with self._lock:
+            if self.choked:
+                return False
+            self.choked = True
+        if send:
+            self.send_choke_state()
+        return True
+
+    def unchoke(self, send=True):
+        """
+        Resume reading chunks for the client, starting with the requests that waited.
+
+        Args:
+            send (bool): As for choke(); the waiting requests are read once the state is sent.
+
+        Returns:
+            bool: True if the client was choked before.
+        """
+        with self._lock:
+            if not self.choked:
+                return False
+            self.choked = False
+        if send:
+            self.send_choke_state()
+        return True
+
+    def send_choke_state(self):
+        """Tell the client whether it is choked and, if it isn't, read the requests that waited."""
+        with self._lock:
+            choked = self.choked
+        self._outgoing.put((CHOKE if choked else UNCHOKE, 0, b'', False))
+        if not choked:
+            self._start_waiting()
+
+    def _send_error(self, request_id, message):
+        """Answer a request with an ERROR frame without running it."""
+        self._outgoing.put((ERROR, request_id, message.encode('utf-8'), False))
+
+    def _stat(self, file_hash):
+        """Produce the answer to a STAT request."""
+        if self.file_size is None:
+            raise ValueError("File sizes are not served")
+        return SIZE_PAYLOAD.pack(self.file_size(file_hash))
+
+    def _bitfield(self, file_hash, chunk_size):
+        """Produce the answer to a BITFIELD request."""
+        if self.bitfield is None:
+            raise ValueError("Bitfields are not served")
+        bitfield = self.bitfield(file_hash, chunk_size)
+        return BITFIELD_HEADER.pack(bitfield.length) + bitfield.encode()
+
+    def send_have(self, file_hash, index):
+        """Announce a newly available chunk if the client subscribed to the file. Doesn't block."""
+        if file_hash not in self.subscriptions:
+            return
+        self._outgoing.put((HAVE, 0, HAVE_PAYLOAD.pack(bytes.fromhex(file_hash), index), False))
+
+    def _answer(self, request_id, produce, *args):
+        """Produce a response and queue it for the writer, unless the request was cancelled meanwhile."""
+        with self._lock:
+            if request_id not in self._inflight:
+                return  # Cancelled
+        try:
+            frame_type, payload = DATA, produce(*args)
+        except Exception as e:
+            frame_type, payload = ERROR, str(e).encode('utf-8')
+        self._outgoing.put((frame_type, request_id, payload, True))
+
+    def _write_loop(self):
+        """
+        Send the queued frames in order.
+
+        Only this thread writes to the client, so a slow client holds up its own writer rather than
+        the executor threads every session shares.
+        """
+        while True:
+            frame = self._outgoing.get()
+            if frame is None:
+                return
+            frame_type, request_id, payload, answer = frame
+            if answer:
+                with self._lock:
+                    if request_id not in self._inflight:
+                        continue  # Cancelled
+                    del self._inflight[request_id]
+                    idle = not self._inflight and not self._waiting
+                    if frame_type == DATA:
+                        self.uploaded += len(payload)
+            try:
+                send_frame(self.connection, frame_type, request_id, payload)
+            except OSError as e:
+                logging.error(f"Failed to send session frame type {frame_type}: {e}")
+                try:
+                    # Ends serve(), which stops waiting for requests nobody can be answered
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return
+            if answer:
+                self._start_waiting()
+                if idle and self.on_idle:
+                    self.on_idle(self)
@@ -0,0 +1,137 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+try:
+    from .config import configure_logging
+    from .index import ShareIndex
+    from .network import Network
+except ImportError:
+    from config import configure_logging
+    from index import ShareIndex
+    from network import Network
+
+INDEX_POLL_INTERVAL = 2.0  # Seconds between checks for a newer share index snapshot
+
+
+def watch_snapshot(share_index, interval=INDEX_POLL_INTERVAL):
+    """Restore the share index whenever its snapshot file is rewritten."""
+    last_mtime = None
+    while True:
+        try:
+            mtime = os.stat(share_index.snapshot_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != last_mtime:
+            last_mtime = mtime
+            try:
+                count = share_index.restore()
+                logging.info(f"Worker {os.getpid()} restored {count} shared files from the snapshot")
+            except Exception as e:
+                # Keep watching: the next snapshot the main process writes may well be usable
+                logging.error(f"Worker {os.getpid()} failed to restore the share index: {e}")
+        time.sleep(interval)
+
+
+def serve_worker(settings):
+    """
+    Run one serving worker process.
+
+    The worker listens on the shared port with SO_REUSEPORT and serves from a read-only
+    share index restored from the snapshot that the main process maintains.
+
+    Args:
+        settings (dict): Keyword arguments for Network plus 'index_snapshot' and, optionally,
+            'log_file', which the worker logs to like the main process does.
+    """
+    settings = dict(settings)
+    log_file = settings.pop('log_file', None)
+    if log_file:
+        configure_logging(log_file)
+    share_index = ShareIndex(settings.pop('index_snapshot'))
+    network = Network(**settings)
+    network.share_index = share_index
+    network.start_listening(reuse_port=True)
+    threading.Thread(target=watch_snapshot, args=(share_index,), daemon=True).start()
+    network.accept_connections()
+
+
+class Supervisor:
+
+    RESTART_DELAY = 1.0  # Initial delay before restarting a worker that died
+    MAX_RESTART_DELAY = 30.0
+    HEALTH_INTERVAL = 1.0  # Seconds between worker health checks
+
+    def __init__(self, worker_count, settings):
+        """
+        Initialize the supervisor of serving worker processes.
+
+        Args:
+            worker_count (int): The number of worker processes.
+            settings (dict): Passed to serve_worker: Network keyword arguments plus 'index_snapshot'
+                and optionally 'log_file'.
+        """
+        self.worker_count = worker_count
+        self.settings = settings
+        self.workers = [None] * worker_count
+        self.restarts = [0] * worker_count
+        self._next_start = [0.0] * worker_count
+        self._started_at = [0.0] * worker_count
+        self._context = multiprocessing.get_context('spawn')
+        self._stopping = threading.Event()
+        self._monitor = None
+
+    def start(self):
+        """Start the workers and a thread that keeps them running."""
+        for slot in range(self.worker_count):
+            self._start_worker(slot)
+        self._monitor = threading.Thread(target=self.monitor, daemon=True)
+        self._monitor.start()
+
+    def _start_worker(self, slot):
+        """Start the worker process for a slot."""
+        process = self._context.Process(target=serve_worker, args=(self.settings,), daemon=True)
+        process.start()
+        self.workers[slot] = process
+        self._started_at[slot] = time.monotonic()
+        logging.info(f"Started serving worker {slot} (pid {process.pid})")
+
+    def check_workers(self):
+        """Restart workers that have exited, backing off for workers that keep dying."""
+        now = time.monotonic()
+        for slot, process in enumerate(self.workers):
+            if process.is_alive() or self._stopping.is_set():
+                continue
+            if self._next_start[slot] == 0.0:
+                if now - self._started_at[slot] > self.MAX_RESTART_DELAY:
+                    self.restarts[slot] = 0  # It ran fine for a while, so don't keep backing off
+                delay = min(self.RESTART_DELAY * 2 ** self.restarts[slot], self.MAX_RESTART_DELAY)
+                self._next_start[slot] = now + delay
+                logging.error(f"Serving worker {slot} (pid {process.pid}) exited with code {process.exitcode}, "
+                              f"restarting in {delay:.1f}s")
+            if now >= self._next_start[slot]:
+                self._next_start[slot] = 0.0
+                self.restarts[slot] += 1
+                self._start_worker(slot)
+
+    def monitor(self):
+        """Check worker health until the supervisor is stopped."""
+        while not self._stopping.wait(self.HEALTH_INTERVAL):
+            self.check_workers()
+
+    def alive(self):
+        """Return the number of workers currently running."""
+        return sum(1 for process in self.workers if process is not None and process.is_alive())
+
+    def stop(self, timeout=5.0):
+        """Stop the workers."""
+        self._stopping.set()
+        for process in self.workers:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.workers:
+            if process is not None:
+                process.join(timeout)
+        logging.info("All serving workers stopped.")
@@ -0,0 +1,101 @@
+import unittest
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.bitfield import Availability, Bitfield, RAW, RLE
+
+class TestBitfield(unittest.TestCase):
+
+    def test_set_and_contains(self):
+        """Test marking chunks as available."""
+        bitfield = Bitfield(10)
+        self.assertTrue(bitfield.set(3))
+        self.assertFalse(bitfield.set(3))
+        self.assertIn(3, bitfield)
+        self.assertNotIn(4, bitfield)
+        self.assertNotIn(10, bitfield)
+        self.assertEqual(list(bitfield), [3])
+        with self.assertRaises(IndexError):
+            bitfield.set(10)
+
+    def test_full(self):
+        """Test a bitfield with every chunk set."""
+        bitfield = Bitfield.full(11)
+        self.assertTrue(bitfield.complete())
+        self.assertEqual(bitfield.count(), 11)
+        self.assertEqual(bytes(bitfield.bits), b'\xff\xe0')
+
+    def test_wrong_size(self):
+        """Test that packed bits must match the length."""
+        with self.assertRaises(ValueError):
+            Bitfield(10, b'\x00')
+
+    def test_run_length_encoding(self):
+        """Test that empty and complete bitfields encode to a few bytes."""
+        for bitfield in (Bitfield(100000), Bitfield.full(100000)):
+            payload = bitfield.encode()
+            self.assertEqual(payload[0], RLE)
+            self.assertLess(len(payload), 8)
+            self.assertEqual(Bitfield.decode(100000, payload), bitfield)
+
+    def test_raw_encoding(self):
+        """Test that scattered chunks fall back to raw bits."""
+        bitfield = Bitfield(64)
+        for index in range(0, 64, 2):
+            bitfield.set(index)
+        payload = bitfield.encode()
+        self.assertEqual(payload[0], RAW)
+        self.assertEqual(Bitfield.decode(64, payload), bitfield)
+
+    def test_decode_malformed(self):
+        """Test that malformed payloads are rejected."""
+        for payload in (b'', b'\x07', bytes([RLE, 5]), bytes([RLE, 0x80]), bytes([RAW, 0])):
+            with self.assertRaises(ValueError):
+                Bitfield.decode(10, payload)
+
+    def test_padding_bits_rejected(self):
+        """Test that raw bits past the last chunk are rejected."""
+        with self.assertRaises(ValueError):
+            Bitfield.decode(9, bytes([RAW, 0, 0x7f]))
+        with self.assertRaises(ValueError):
+            Bitfield(9, b'\x00\x01')
+        self.assertEqual(list(Bitfield.decode(9, bytes([RAW, 0, 0x80]))), [8])
+
+class TestAvailability(unittest.TestCase):
+
+    def test_pick_rarest(self):
+        """Test that chunks held by fewer peers are picked first."""
+        availability = Availability(4)
+        availability.add_bitfield(Bitfield.full(4))
+        partial = Bitfield(4)
+        partial.set(0)
+        partial.set(2)
+        availability.add_bitfield(partial)
+        self.assertEqual(availability.counts, [2, 1, 2, 1])
+        picked = [availability.pick_rarest(lambda index: True) for _ in range(4)]
+        self.assertEqual(picked[:2], [1, 3])
+        self.assertEqual(sorted(picked[2:]), [0, 2])
+        self.assertIsNone(availability.pick_rarest(lambda index: True))
+
+    def test_unavailable_and_unwanted(self):
+        """Test that chunks nobody has, or that aren't wanted, are skipped until pushed again."""
+        availability = Availability(3)
+        availability.have(1)
+        availability.have(2)
+        self.assertEqual(availability.pick_rarest(lambda index: index != 1), 2)
+        self.assertIsNone(availability.pick_rarest(lambda index: True))
+        availability.push(1)
+        self.assertEqual(availability.pick_rarest(lambda index: True), 1)
+
+    def test_remove_bitfield(self):
+        """Test that a departed peer's chunks stop counting."""
+        availability = Availability(2)
+        bitfield = Bitfield.full(2)
+        availability.add_bitfield(bitfield)
+        availability.remove_bitfield(bitfield)
+        self.assertEqual(availability.counts, [0, 0])
+        self.assertIsNone(availability.pick_rarest(lambda index: True))
+
+if __name__ == '__main__':
+    unittest.main()
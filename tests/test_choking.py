@@ -0,0 +1,153 @@
+import unittest
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.choking import Choker
+
+class FakeServer:
+    """Tracks choke state and the counters the choker reads from a SessionServer."""
+
+    def __init__(self, address):
+        self.address = address
+        self.choked = False
+        self.on_interested = None
+        self.on_idle = None
+        self.requests = 0
+        self.uploaded = 0
+        self.pending = 0
+        self.sent = []  # Choke states sent to the client
+
+    def waiting(self):
+        return self.pending
+
+    def choke(self, send=True):
+        changed, self.choked = not self.choked, True
+        if changed and send:
+            self.send_choke_state()
+        return changed
+
+    def unchoke(self, send=True):
+        changed, self.choked = self.choked, False
+        if changed and send:
+            self.send_choke_state()
+        return changed
+
+    def send_choke_state(self):
+        self.sent.append(self.choked)
+
+    def request(self):
+        self.requests += 1
+        self.pending += 1
+        if self.choked:
+            self.on_interested(self)
+
+class TestChoker(unittest.TestCase):
+
+    def setUp(self):
+        self.rates = {}
+        self.choker = Choker(3, download_rate=lambda server: self.rates.get(server.address))
+        self.servers = [FakeServer(('127.0.0.1', port)) for port in range(6)]
+        for server in self.servers:
+            self.choker.add(server)
+
+    def unchoked(self):
+        return [server.address[1] for server in self.servers if not server.choked]
+
+    def test_new_clients_start_choked(self):
+        """Test that clients are choked until they ask for data."""
+        self.assertEqual(self.unchoked(), [])
+        self.servers[0].request()
+        self.assertEqual(self.unchoked(), [0])
+
+    def test_slots_capped(self):
+        """Test that no more clients than slots are unchoked."""
+        for server in self.servers:
+            server.request()
+        self.assertEqual(self.unchoked(), [0, 1, 2])
+        # A slot held by a client with nothing left to send goes to a waiting client
+        self.servers[1].pending = 0
+        self.servers[3].request()
+        self.assertEqual(self.unchoked(), [0, 2, 3])
+
+    def test_idle_client_hands_over_slot(self):
+        """Test that a client with nothing left to receive gives its slot to a waiting client."""
+        for server in self.servers[:4]:
+            server.request()
+        self.servers[0].pending = 0
+        self.servers[0].on_idle(self.servers[0])
+        self.assertEqual(self.unchoked(), [1, 2, 3])
+
+    def test_rechoke_reciprocates(self):
+        """Test that the clients we download fastest from keep their slots."""
+        for server in self.servers:
+            server.request()
+        self.rates = {('127.0.0.1', 5): 1000.0, ('127.0.0.1', 4): 500.0}
+        self.choker.rechoke()
+        unchoked = self.unchoked()
+        self.assertEqual(len(unchoked), 3)
+        self.assertIn(5, unchoked)
+        self.assertIn(4, unchoked)
+        self.assertIs(self.choker.optimistic, self.servers[unchoked[0]])
+
+    def test_seeding_ranks_by_upload_rate(self):
+        """Test that without downloads, the clients taking uploads fastest keep their slots."""
+        for server in self.servers:
+            server.request()
+        self.servers[3].uploaded = 10000
+        self.servers[4].uploaded = 5000
+        self.choker.rechoke()
+        self.assertIn(3, self.unchoked())
+        self.assertIn(4, self.unchoked())
+
+    def test_optimistic_unchoke_rotates(self):
+        """Test that the optimistic unchoke moves between the other clients."""
+        for server in self.servers:
+            server.request()
+        self.rates = {('127.0.0.1', 0): 2.0, ('127.0.0.1', 1): 1.0}
+        chosen = set()
+        for _ in range(30):
+            self.choker.rechoke()
+            self.assertEqual(len(self.unchoked()), 3)
+            chosen.add(self.choker.optimistic.address[1])
+        self.assertGreater(len(chosen), 1)
+        self.assertFalse(chosen & {0, 1})
+
+    def test_uninterested_choked(self):
+        """Test that clients without requests are choked each round."""
+        self.servers[0].request()
+        self.servers[0].pending = 0
+        self.choker.rechoke()
+        self.choker.rechoke()
+        self.assertEqual(self.unchoked(), [])
+
+    def test_remove_frees_slot(self):
+        """Test that a disconnecting client's slot goes to a waiting client."""
+        for server in self.servers[:4]:
+            server.request()
+        self.assertTrue(self.servers[3].choked)
+        self.choker.remove(self.servers[0])
+        self.assertFalse(self.servers[3].choked)
+        self.assertNotIn(self.servers[0], self.choker.servers)
+
+    def test_frames_sent_outside_lock(self):
+        """Test that clients are told their choke state after the choker's lock is released."""
+        held = []
+        for server in self.servers:
+            def send_choke_state(server=server):
+                free = self.choker._lock.acquire(blocking=False)
+                if free:
+                    self.choker._lock.release()
+                held.append(not free)
+                server.sent.append(server.choked)
+            server.send_choke_state = send_choke_state
+        for server in self.servers:
+            server.request()
+        self.servers[1].pending = 0
+        self.servers[1].on_idle(self.servers[1])
+        self.choker.rechoke()
+        self.assertTrue(held)
+        self.assertNotIn(True, held)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+import os
+import sys
+import json
+import tempfile
+from unittest.mock import patch
+
+# Add project root to sys.path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.config import Config, load_config, default_cache_path
+
+CONFIG_YAML = """discovery_port: 12345
+tcp_port: 54321
+peer_id: '1234'
+ip_address: '127.0.0.1'
+"""
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.config_path = os.path.join(self.temp_dir.name, 'config.yaml')
+        with open(self.config_path, 'w') as f:
+            f.write(CONFIG_YAML)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_load_config(self):
+        config = load_config(self.config_path)
+        self.assertEqual(config.discovery_port, 12345)
+        self.assertEqual(config.tcp_port, 54321)
+        self.assertEqual(config.peer_id, '1234')
+        self.assertEqual(config.ip_address, '127.0.0.1')
+        self.assertEqual(config.log_file, os.path.join('logs', 'app.log'))
+
+    def test_load_config_writes_cache(self):
+        load_config(self.config_path)
+        with open(default_cache_path(self.config_path)) as f:
+            cached = json.load(f)
+        self.assertEqual(cached['config']['tcp_port'], 54321)
+
+    def test_load_config_uses_cache_without_yaml(self):
+        expected = load_config(self.config_path)
+        with patch.dict(sys.modules, {'yaml': None}):
+            self.assertEqual(load_config(self.config_path), expected)
+
+    def test_load_config_reparses_changed_file(self):
+        load_config(self.config_path)
+        with open(self.config_path, 'w') as f:
+            f.write(CONFIG_YAML.replace('54321', '54322') + "\n")
+        self.assertEqual(load_config(self.config_path).tcp_port, 54322)
+
+    def test_invalid_type(self):
+        with self.assertRaises(ValueError):
+            Config.from_dict({'discovery_port': '12345', 'tcp_port': 54321, 'peer_id': '1', 'ip_address': ''})
+
+    def test_invalid_port(self):
+        with self.assertRaises(ValueError):
+            Config.from_dict({'discovery_port': 70000, 'tcp_port': 54321, 'peer_id': '1', 'ip_address': ''})
+
+    def test_missing_and_unknown_settings(self):
+        with self.assertRaises(ValueError):
+            Config.from_dict({'discovery_port': 12345, 'tcp_port': 54321})
+        with self.assertRaises(ValueError):
+            Config.from_dict({'discovery_port': 12345, 'tcp_port': 54321, 'peer_id': '1', 'ip_address': '', 'extra': 1})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+import unittest
+import os
+import sys
+import tempfile
+import threading
+from unittest.mock import patch
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.disk import DiskEngine, preallocate, write_vectored
+
+class TestDiskEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, 'out.bin')
+        self.engine = DiskEngine()
+
+    def tearDown(self):
+        self.engine.close()
+        self.temp_dir.cleanup()
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_out_of_order_writes(self):
+        """Test that pieces written out of order end up in place and are reported."""
+        written = []
+        for index in (3, 1, 0, 2, 5, 4):
+            self.engine.write(self.path, index * 2, bytes([index]) * 2, callback=lambda index=index: written.append(index))
+        self.engine.flush()
+        self.assertEqual(self.read(), b''.join(bytes([index]) * 2 for index in range(6)))
+        self.assertEqual(sorted(written), list(range(6)))
+        self.assertEqual(self.engine.buffered, 0)
+
+    def test_adjacent_pieces_coalesced(self):
+        """Test that adjacent pieces buffered together go out in a single write."""
+        self.engine.WRITE_DELAY = 60
+        for index in (7, 2, 0, 5, 1, 6, 3, 4):
+            self.engine.write(self.path, index * 10, bytes([index]) * 10)
+        with patch('os.pwritev', wraps=os.pwritev) as pwritev:
+            self.engine.flush()
+        self.assertEqual(pwritev.call_count, 1)
+        self.assertEqual(self.read(), b''.join(bytes([index]) * 10 for index in range(8)))
+
+    def test_aligned_prefix_taken(self):
+        """Test that a long run is cut at a block boundary and its tail waits for more data."""
+        self.engine.WRITE_DELAY = 60
+        self.engine.WRITE_SIZE = 8192
+        self.engine.open(self.path)
+        file = self.engine._files[self.path]
+        with self.engine._condition:
+            for offset, length in ((0, 4096), (4096, 5000), (9096, 3192), (12288, 100)):
+                file.pending[offset] = (b'x' * length, [], 0.0)
+            runs = self.engine._take_runs(file, 1.0)
+            file.pending.clear()
+        self.assertEqual([(offset, size) for offset, _, _, size in runs], [(0, 12288)])
+
+    def test_rewrite_replaces_pending_piece(self):
+        """Test that writing the same offset again replaces the buffered data and keeps both callbacks."""
+        self.engine.WRITE_DELAY = 60
+        written = []
+        self.engine.write(self.path, 0, b'a' * 40, callback=lambda: written.append('first'))
+        self.engine.write(self.path, 0, b'b' * 40, callback=lambda: written.append('second'))
+        self.assertEqual(self.engine.buffered, 40)
+        self.engine.flush()
+        self.assertEqual(self.engine.buffered, 0)
+        self.assertEqual(self.read(), b'b' * 40)
+        self.assertEqual(written, ['first', 'second'])
+
+    def test_write_error_reported(self):
+        """Test that a failed write is raised by flush, close_file and later writes, and frees its buffer."""
+        with patch('os.pwritev', side_effect=OSError(28, 'No space left on device')):
+            self.engine.write(self.path, 0, b'x' * 100)
+            with self.assertRaises(OSError):
+                self.engine.flush(self.path)
+        self.assertEqual(self.engine.buffered, 0)
+        with self.assertRaises(OSError):
+            self.engine.write(self.path, 100, b'y')
+        with self.assertRaises(OSError):
+            self.engine.close_file(self.path).result(5)
+
+    def test_open_failure_reported(self):
+        """Test that a file that can't be opened fails its close_file future."""
+        path = os.path.join(self.temp_dir.name, 'missing', 'out.bin')
+        self.engine.open(path, 100)
+        with self.assertRaises(OSError):
+            self.engine.close_file(path).result(5)
+
+    def test_close_file_runs_in_background(self):
+        """Test that close_file returns before the final sync has run."""
+        release = threading.Event()
+        real_fsync = os.fsync
+
+        def slow_fsync(fd):
+            release.wait(5)
+            real_fsync(fd)
+
+        self.engine.write(self.path, 0, b'abc')
+        with patch('os.fsync', side_effect=slow_fsync):
+            closed = self.engine.close_file(self.path)
+            self.assertFalse(closed.done())
+            release.set()
+            closed.result(5)
+        self.assertEqual(self.read(), b'abc')
+
+    def test_preallocate_and_trim(self):
+        """Test that open reserves the file's size and close_file trims it to what was written."""
+        self.engine.open(self.path, 1000, truncate=True).result(5)
+        self.assertEqual(os.path.getsize(self.path), 1000)
+        self.engine.write(self.path, 0, b'abc')
+        self.engine.close_file(self.path, length=3).result(5)
+        self.assertEqual(self.read(), b'abc')
+
+    def test_fsync_batched(self):
+        """Test that a file written many times is synced once when it is closed."""
+        with patch('os.fsync') as fsync:
+            for index in range(20):
+                self.engine.write(self.path, index, b'x')
+                self.engine.flush()
+            self.engine.close_file(self.path).result(5)
+        self.assertEqual(fsync.call_count, 1)
+
+    def test_sync(self):
+        """Test that sync fsyncs an open file on the pool and is a no-op for other paths."""
+        self.engine.write(self.path, 0, b'abc')
+        self.engine.flush(self.path)
+        with patch('os.fsync') as fsync:
+            self.engine.sync(self.path).result(5)
+            self.engine.sync(os.path.join(self.temp_dir.name, 'other.bin')).result(5)
+        self.assertEqual(fsync.call_count, 1)
+        with patch('os.fsync', side_effect=OSError(5, 'Input/output error')):
+            with self.assertRaises(OSError):
+                self.engine.sync(self.path).result(5)
+
+    def test_write_blocks_when_buffer_full(self):
+        """Test that the buffered bytes never exceed the limit."""
+        engine = DiskEngine(max_buffered=100)
+        path = os.path.join(self.temp_dir.name, 'small.bin')
+        highest = []
+        for index in range(20):
+            engine.write(path, index * 50, b'y' * 50)
+            highest.append(engine.buffered)
+        engine.close()
+        self.assertLessEqual(max(highest), 100)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'y' * 1000)
+
+class TestDiskHelpers(unittest.TestCase):
+
+    def test_write_vectored_resumes_short_writes(self):
+        """Test that short pwritev calls are continued where they stopped."""
+        real_pwritev = os.pwritev
+        with tempfile.TemporaryFile() as f:
+            with patch('os.pwritev', side_effect=lambda fd, buffers, offset: real_pwritev(fd, [buffers[0][:3]], offset)):
+                write_vectored(f.fileno(), [b'hello', b'', b' world'], 2)
+            f.seek(0)
+            self.assertEqual(f.read(), b'\0\0hello world')
+
+    def test_preallocate(self):
+        """Test that preallocation extends a file without touching its data."""
+        with tempfile.TemporaryFile() as f:
+            f.write(b'data')
+            f.flush()
+            preallocate(f.fileno(), 4096)
+            f.seek(0)
+            content = f.read()
+        self.assertEqual(len(content), 4096)
+        self.assertTrue(content.startswith(b'data'))
+
+if __name__ == '__main__':
+    unittest.main()
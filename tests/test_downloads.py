@@ -0,0 +1,321 @@
+import unittest
+import os
+import sys
+import hashlib
+import json
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from unittest.mock import patch
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.bitfield import Bitfield
+from src.downloads import DownloadManager, COMPLETE, FAILED, QUEUED
+from src.file import File
+from src.index import ShareIndex
+from src.network import Network
+from src.session import SessionError
+
+CONTENT = bytes(range(256)) * 4 + b'tail'
+CONTENT_HASH = hashlib.sha256(CONTENT).hexdigest()
+
+class FakeSession:
+    """Answers chunk requests from CONTENT, failing the first requests for chosen offsets."""
+
+    def __init__(self, failures, chunks=None):
+        self.failures = failures
+        self.chunks = chunks  # Indices of the 100-byte chunks the peer has; None means all, 'none' no file
+        self.requests = []
+        self.closed = False
+
+    def request_chunk(self, file_hash, offset, length):
+        self.requests.append(offset)
+        future = Future()
+        if self.failures.get(offset, 0) > 0:
+            self.failures[offset] -= 1
+            future.set_exception(SessionError("flaky"))
+        else:
+            future.set_result(CONTENT[offset:offset + length])
+        return future
+
+    def stat_file(self, file_hash):
+        future = Future()
+        future.set_result(len(CONTENT))
+        return future
+
+    def request_bitfield(self, file_hash, chunk_size):
+        future = Future()
+        if self.chunks == 'none':
+            future.set_exception(SessionError("not shared"))
+            return future
+        length = -(-len(CONTENT) // chunk_size)
+        bitfield = Bitfield.full(length) if self.chunks is None else Bitfield(length)
+        for index in self.chunks or ():
+            bitfield.set(index)
+        future.set_result(bitfield)
+        return future
+
+    def cancel(self, future):
+        return False
+
+class FakeNetwork(Network):
+    """A network whose peers are FakeSessions, one per port."""
+
+    def __init__(self, failures=None, peer_chunks=None):
+        super().__init__(0, 0, '127.0.0.1')
+        peer_chunks = peer_chunks or [None]
+        self.peer_list = [{'ip': '127.0.0.1', 'port': port} for port in range(1, len(peer_chunks) + 1)]
+        self.sessions = {port: FakeSession(failures or {}, chunks) for port, chunks in enumerate(peer_chunks, 1)}
+        self.session = self.sessions[1]
+
+    def get_session(self, ip, port):
+        return self.sessions[port]
+
+class TestDownloadManager(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.download_dir = os.path.join(self.temp_dir.name, 'received')
+        self.state_path = os.path.join(self.temp_dir.name, 'downloads.json')
+        self.managers = []
+
+    def tearDown(self):
+        for manager in self.managers:
+            manager.stop()
+        self.temp_dir.cleanup()
+
+    def make_manager(self, network, **kwargs):
+        manager = DownloadManager(network, self.download_dir, self.state_path, retry_delay=0.01, **kwargs)
+        manager.CHUNK_SIZE = 100
+        self.managers.append(manager)
+        return manager
+
+    def test_download(self):
+        """Test downloading a file in chunks."""
+        manager = self.make_manager(FakeNetwork())
+        self.assertTrue(manager.add(CONTENT_HASH, 'data.bin'))
+        manager.start()
+        self.assertTrue(manager.wait(10))
+
+        with open(os.path.join(self.download_dir, 'data.bin'), 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        progress = manager.progress(CONTENT_HASH)
+        self.assertEqual(progress['state'], COMPLETE)
+        self.assertEqual(progress['downloaded'], len(CONTENT))
+        self.assertEqual(progress['chunks_done'], progress['chunks_total'])
+        self.assertIsNone(manager.progress('unknown'))
+
+    def test_completed_download_shared(self):
+        """Test that a completed download is added to the share index and its snapshot without rehashing."""
+        network = FakeNetwork()
+        network.share_index = ShareIndex(os.path.join(self.temp_dir.name, 'index.json'))
+        manager = self.make_manager(network)
+        manager.add(CONTENT_HASH, 'data.bin')
+        with patch.object(File, 'calculate_hash', wraps=lambda: CONTENT_HASH) as calculate_hash:
+            manager.start()
+            self.assertTrue(manager.wait(10))
+        self.assertEqual(calculate_hash.call_count, 1)  # Only the verification
+
+        restarted = ShareIndex(network.share_index.snapshot_path)
+        self.assertEqual(restarted.restore(), 1)
+        self.assertEqual(restarted.lookup(CONTENT_HASH).file_path, os.path.join(self.download_dir, 'data.bin'))
+
+    def test_slow_announcements_dont_stall_writes(self):
+        """Test that a HAVE announcement stuck behind a slow peer doesn't hold up the disk writes."""
+        network = FakeNetwork()
+        release = threading.Event()
+        network.announce_have = lambda file_hash, index: release.wait(10)
+        manager = self.make_manager(network)
+        manager.add(CONTENT_HASH, 'data.bin')
+        manager.start()
+        try:
+            self.assertTrue(manager.wait(5))
+            self.assertEqual(manager.progress(CONTENT_HASH)['state'], COMPLETE)
+        finally:
+            release.set()
+
+    def test_duplicate_hash(self):
+        """Test that a hash queued twice is downloaded once."""
+        manager = self.make_manager(FakeNetwork())
+        self.assertTrue(manager.add(CONTENT_HASH))
+        self.assertFalse(manager.add(CONTENT_HASH, priority=5))
+        self.assertEqual(manager.progress(CONTENT_HASH)['priority'], 5)
+        manager.start()
+        self.assertTrue(manager.wait(10))
+        self.assertFalse(manager.add(CONTENT_HASH))
+
+    def test_invalid_hash_rejected(self):
+        """Test that only 64 hex digit hashes are queued, so no padded hash is ever requested."""
+        manager = self.make_manager(FakeNetwork())
+        for file_hash in ('abc', 'zz' * 32, CONTENT_HASH + '00'):
+            with self.assertRaises(ValueError):
+                manager.add(file_hash)
+        self.assertTrue(manager.add(CONTENT_HASH.upper()))
+        self.assertIsNotNone(manager.progress(CONTENT_HASH))
+
+    def test_same_name_downloads_kept_apart(self):
+        """Test that two files queued under one name use separate part files and don't overwrite each other."""
+        other = b'other content'
+        other_hash = hashlib.sha256(other).hexdigest()
+        network = FakeNetwork()
+        manager = self.make_manager(network)
+        manager.add(CONTENT_HASH, 'data.bin')
+        manager.add(other_hash, 'data.bin')
+        self.assertNotEqual(manager.part_path(manager.downloads[CONTENT_HASH]),
+                            manager.part_path(manager.downloads[other_hash]))
+        os.makedirs(self.download_dir)
+        with open(os.path.join(self.download_dir, 'data.bin'), 'wb') as f:
+            f.write(other)
+
+        manager.start()
+        self.assertTrue(manager.wait(10))
+        self.assertEqual(manager.progress(CONTENT_HASH)['state'], COMPLETE)
+        stored = manager.final_path(manager.downloads[CONTENT_HASH])
+        self.assertNotEqual(stored, os.path.join(self.download_dir, 'data.bin'))
+        with open(stored, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        with open(os.path.join(self.download_dir, 'data.bin'), 'rb') as f:
+            self.assertEqual(f.read(), other)
+
+    def test_priority_order(self):
+        """Test that higher priorities start first."""
+        manager = self.make_manager(FakeNetwork(), max_active=1)
+        started = []
+        manager._download = lambda download: started.append(download.file_hash)
+        manager.add('aa' * 32, priority=0)
+        manager.add('bb' * 32, priority=10)
+        manager.add('cc' * 32, priority=5)
+        manager.start()
+        self.assertTrue(manager.wait(10))
+        self.assertEqual(started, ['bb' * 32, 'cc' * 32, 'aa' * 32])
+
+    def test_retry_with_backoff(self):
+        """Test that failed chunks are retried."""
+        network = FakeNetwork(failures={200: 2})
+        manager = self.make_manager(network)
+        manager.add(CONTENT_HASH)
+        manager.start()
+        self.assertTrue(manager.wait(10))
+        self.assertEqual(manager.progress(CONTENT_HASH)['state'], COMPLETE)
+        self.assertEqual(network.session.requests.count(200), 3)
+
+    def test_too_many_failures(self):
+        """Test that a download fails once a chunk exhausts its retries."""
+        manager = self.make_manager(FakeNetwork(failures={0: 10}), max_retries=2)
+        manager.add(CONTENT_HASH)
+        manager.start()
+        self.assertTrue(manager.wait(10))
+        progress = manager.progress(CONTENT_HASH)
+        self.assertEqual(progress['state'], FAILED)
+        self.assertIn('flaky', progress['error'])
+        self.assertTrue(manager.add(CONTENT_HASH))
+
+    def test_state_survives_restart(self):
+        """Test that queued and completed downloads are restored."""
+        manager = self.make_manager(FakeNetwork())
+        manager.add(CONTENT_HASH, 'data.bin')
+        manager.start()
+        self.assertTrue(manager.wait(10))
+        manager.stop()
+        self.managers.remove(manager)
+
+        # Queue another download without starting it
+        manager = self.make_manager(FakeNetwork())
+        manager.add('aa' * 32, priority=3)
+        manager.stop()
+        self.managers.remove(manager)
+
+        restarted = self.make_manager(FakeNetwork())
+        self.assertEqual(restarted.progress(CONTENT_HASH)['state'], COMPLETE)
+        self.assertFalse(restarted.add(CONTENT_HASH))
+        self.assertEqual(restarted.progress('aa' * 32)['state'], QUEUED)
+        self.assertEqual(restarted.progress('aa' * 32)['priority'], 3)
+
+    def test_resume_skips_written_chunks(self):
+        """Test that a resumed download only fetches missing chunks."""
+        os.makedirs(self.download_dir)
+        with open(os.path.join(self.download_dir, f'{CONTENT_HASH}.part'), 'wb') as f:
+            f.write(CONTENT[:300])
+        with open(self.state_path, 'w') as f:
+            json.dump({CONTENT_HASH: {'file_name': 'data.bin', 'size': len(CONTENT), 'done': [0, 1, 2],
+                                      'state': 'active'}}, f)
+
+        network = FakeNetwork()
+        manager = self.make_manager(network)
+        manager.start()
+        self.assertTrue(manager.wait(10))
+        self.assertEqual(manager.progress(CONTENT_HASH)['state'], COMPLETE)
+        self.assertEqual(sorted(network.session.requests), [300, 400, 500, 600, 700, 800, 900, 1000])
+
+    def test_only_synced_chunks_persisted(self):
+        """Test that written chunks are persisted as done only once an fsync covers them."""
+        network = FakeNetwork(peer_chunks=[[0, 1, 2, 3, 4], 'none'])
+        manager = self.make_manager(network)
+        manager.SAVE_INTERVAL = 0.01
+        synced = Future()
+        manager.writer.sync = lambda path: synced
+
+        def persisted():
+            with open(self.state_path) as f:
+                return json.load(f)[CONTENT_HASH]['done']
+
+        manager.add(CONTENT_HASH)
+        manager.start()
+        self.assertFalse(manager.wait(0.3))
+        self.assertEqual(manager.progress(CONTENT_HASH)['chunks_done'], 5)
+        self.assertEqual(persisted(), [])
+        synced.set_result(None)
+        deadline = time.monotonic() + 5
+        while persisted() != [0, 1, 2, 3, 4] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(persisted(), [0, 1, 2, 3, 4])
+
+    def test_rarest_chunks_first(self):
+        """Test that chunks held by fewer peers are requested first."""
+        network = FakeNetwork(peer_chunks=[None, [0, 1, 2, 3]])
+        manager = self.make_manager(network, max_chunks_per_file=1)
+        manager.add(CONTENT_HASH)
+        manager.start()
+        self.assertTrue(manager.wait(10))
+        self.assertEqual(manager.progress(CONTENT_HASH)['state'], COMPLETE)
+        requests = network.sessions[1].requests + network.sessions[2].requests
+        self.assertEqual(sorted(network.sessions[1].requests[:7]), [400, 500, 600, 700, 800, 900, 1000])
+        self.assertEqual(sorted(requests), list(range(0, len(CONTENT), 100)))
+
+    def test_fastest_peer_preferred(self):
+        """Test that chunks are requested from the peer measured to be fastest."""
+        network = FakeNetwork(peer_chunks=[None, None])
+        network.get_peer('127.0.0.1', 1).record_transfer(100, 10.0)
+        network.get_peer('127.0.0.1', 2).record_transfer(100, 0.001)
+        manager = self.make_manager(network, max_chunks_per_file=2)
+        manager.add(CONTENT_HASH)
+        manager.start()
+        self.assertTrue(manager.wait(10))
+        self.assertEqual(manager.progress(CONTENT_HASH)['state'], COMPLETE)
+        self.assertEqual(network.sessions[1].requests, [])
+        self.assertEqual(len(network.sessions[2].requests), 11)
+        self.assertIsNotNone(network.get_peer('127.0.0.1', 2).rtt)
+
+    def test_waits_for_have(self):
+        """Test that chunks no peer has are fetched once a peer announces them."""
+        network = FakeNetwork(peer_chunks=[[0, 1, 2, 3, 4], 'none'])
+        manager = self.make_manager(network)
+        manager.add(CONTENT_HASH)
+        manager.start()
+        self.assertFalse(manager.wait(0.2))
+        self.assertEqual(manager.progress(CONTENT_HASH)['chunks_done'], 5)
+        # Only the written chunks of the partial download are served meanwhile
+        self.assertEqual(network.local_bitfield(CONTENT_HASH, 100).count(), 5)
+
+        # The peer that didn't have the file yet announces the rest
+        peer = network.get_peer('127.0.0.1', 2)
+        for index in range(5, 11):
+            network.handle_have(peer, CONTENT_HASH, index)
+        self.assertTrue(manager.wait(10))
+        self.assertEqual(manager.progress(CONTENT_HASH)['state'], COMPLETE)
+        self.assertNotIn(CONTENT_HASH, network.partial_files)
+        self.assertEqual(sorted(network.sessions[2].requests), list(range(500, len(CONTENT), 100)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+import os
+import sys
+import hashlib
+import json
+import tempfile
+from unittest.mock import patch
+
+# Add project root to sys.path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.file import File
+from src.index import ShareIndex
+
+class TestShareIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.shared_dir = os.path.join(self.temp_dir.name, 'shared')
+        os.makedirs(self.shared_dir)
+        self.file_path = os.path.join(self.shared_dir, 'a.txt')
+        with open(self.file_path, 'wb') as f:
+            f.write(b'shared content')
+        self.snapshot_path = os.path.join(self.temp_dir.name, 'index.json')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_discover(self):
+        self.assertEqual(ShareIndex.discover(self.shared_dir), [self.file_path])
+        self.assertEqual(ShareIndex.discover(os.path.join(self.temp_dir.name, 'missing')), [])
+
+    def test_add_and_lookup(self):
+        index = ShareIndex(self.snapshot_path)
+        file = index.add(self.file_path)
+        self.assertEqual(file.file_hash, hashlib.sha256(b'shared content').hexdigest())
+        self.assertIs(index.lookup(file.file_hash), file)
+        self.assertIsNone(index.lookup('missing'))
+
+    def test_snapshot_skips_rehash(self):
+        index = ShareIndex(self.snapshot_path)
+        index.index_paths([self.file_path])
+        self.assertTrue(index.ready.is_set())
+
+        restarted = ShareIndex(self.snapshot_path)
+        restarted.load_snapshot()
+        with patch.object(File, 'calculate_hash') as calculate_hash:
+            file = restarted.add(self.file_path)
+        calculate_hash.assert_not_called()
+        self.assertEqual(file.file_hash, hashlib.sha256(b'shared content').hexdigest())
+
+    def test_snapshot_rehashes_changed_file(self):
+        index = ShareIndex(self.snapshot_path)
+        index.index_paths([self.file_path])
+        with open(self.file_path, 'wb') as f:
+            f.write(b'changed content!')
+
+        restarted = ShareIndex(self.snapshot_path)
+        restarted.load_snapshot()
+        file = restarted.add(self.file_path)
+        self.assertEqual(file.file_hash, hashlib.sha256(b'changed content!').hexdigest())
+
+    def test_corrupt_snapshot_is_ignored(self):
+        with open(self.snapshot_path, 'w') as f:
+            f.write('{not json')
+        index = ShareIndex(self.snapshot_path)
+        index.load_snapshot()
+        self.assertEqual(index.snapshot, {})
+
+    def test_restore_skips_malformed_entries(self):
+        index = ShareIndex(self.snapshot_path)
+        index.index_paths([self.file_path])
+        with open(self.snapshot_path) as f:
+            snapshot = json.load(f)
+        snapshot['/elsewhere/short.bin'] = [1, 2]
+        snapshot['/elsewhere/none.bin'] = None
+        with open(self.snapshot_path, 'w') as f:
+            json.dump(snapshot, f)
+
+        restarted = ShareIndex(self.snapshot_path)
+        self.assertEqual(restarted.restore(), 1)
+        self.assertIsNotNone(restarted.lookup(hashlib.sha256(b'shared content').hexdigest()))
+
+    def test_start_background(self):
+        indexed = []
+        index = ShareIndex(self.snapshot_path)
+        index.start_background([self.file_path], on_indexed=indexed.append).join(5)
+        self.assertTrue(index.ready.is_set())
+        self.assertEqual(len(indexed), 1)
+        self.assertTrue(os.path.exists(self.snapshot_path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,10 +2,14 @@ import unittest
 import socket
 import threading, sys
 import os
+import tempfile
 from unittest.mock import patch, MagicMock
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from src.network import Network
+from src.bitfield import Bitfield
+from src.index import ShareIndex
+from src.session import Session, SessionError
 
 class TestNetwork(unittest.TestCase):
 
@@ -101,15 +105,64 @@ class TestNetwork(unittest.TestCase):
 
         connection.sendall.assert_called()
 
+    @staticmethod
+    def fake_recv_into(chunks):
+        """Return a recv_into side effect that copies the given chunks into the caller's buffer."""
+        chunks = list(chunks)
+
+        def recv_into(buffer):
+            chunk = chunks.pop(0)
+            buffer[:len(chunk)] = chunk
+            return len(chunk)
+
+        return recv_into
+
     def test_receive_data(self):
         """Test receiving data."""
         connection = MagicMock()
-        connection.recv.side_effect = [b'Hello', b', World!', b'']
+        connection.recv_into.side_effect = self.fake_recv_into([b'Hello', b', World!', b''])
 
         result = self.network.receive_data(connection)
 
         self.assertEqual(result, b'Hello, World!')
 
+    def test_receive_buffer_is_reused_and_grows(self):
+        """Test that the receive buffer is reused and grows after full reads."""
+        network = Network(self.discovery_port, self.tcp_port, buffer_size=4)
+        buffer = network.get_buffer()
+        self.assertIs(network.get_buffer(), buffer)
+
+        connection = MagicMock()
+        connection.recv_into.side_effect = self.fake_recv_into([b'abcd', b'efgh', b''])
+
+        self.assertEqual(network.receive_data(connection), b'abcdefgh')
+        self.assertEqual(len(network.get_buffer()), 8)
+
+    def test_grow_buffer_is_capped(self):
+        """Test that the receive buffer never grows past MAX_BUFFER_SIZE."""
+        network = Network(self.discovery_port, self.tcp_port, buffer_size=Network.MAX_BUFFER_SIZE)
+        buffer = network.get_buffer()
+        self.assertIs(network.grow_buffer(buffer), buffer)
+
+    def test_tune_socket(self):
+        """Test socket options applied to connections."""
+        network = Network(self.discovery_port, self.tcp_port, socket_buffer_size=1 << 20)
+        connection = MagicMock()
+
+        network.tune_socket(connection)
+
+        connection.setsockopt.assert_any_call(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+        connection.setsockopt.assert_any_call(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        connection.setsockopt.assert_any_call(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def test_tune_socket_defaults_to_autotuning(self):
+        """Test that buffer sizes are left to the kernel unless configured."""
+        connection = MagicMock()
+
+        self.network.tune_socket(connection, nodelay=False)
+
+        connection.setsockopt.assert_not_called()
+
     def test_send_file(self):
         """Test sending a file."""
         connection = MagicMock()
@@ -126,10 +179,10 @@ class TestNetwork(unittest.TestCase):
     def test_receive_file(self):
         """Test receiving a file."""
         connection = MagicMock()
-        connection.recv.side_effect = [b'This is ', b'a test file.', b'']
+        connection.recv_into.side_effect = self.fake_recv_into([b'This is ', b'a test file.', b''])
         destination_path = 'received_test_file.txt'
 
-        self.network.receive_file(destination_path, connection)
+        self.assertEqual(self.network.receive_file(destination_path, connection).result(5), 20)
 
         with open(destination_path, 'rb') as f:
             content = f.read()
@@ -137,5 +190,152 @@ class TestNetwork(unittest.TestCase):
         self.assertEqual(content, b'This is a test file.')
         os.remove(destination_path)
 
+    def test_receive_file_write_failure(self):
+        """Test that a file that couldn't be written is reported as failed, not received."""
+        connection = MagicMock()
+        connection.recv_into.side_effect = self.fake_recv_into([b'x' * 5000, b''])
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with patch('os.pwritev', side_effect=OSError(28, 'No space left on device')), \
+                    self.assertLogs(level='INFO') as logs:
+                saved = self.network.receive_file(os.path.join(temp_dir, 'full.bin'), connection, 5000)
+                with self.assertRaises(OSError):
+                    saved.result(5)
+        self.assertFalse(any('successfully' in line for line in logs.output))
+
+class TestNetworkSessions(unittest.TestCase):
+
+    def setUp(self):
+        """Serve a shared file on a loopback listener."""
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.temp_dir.name, 'shared.bin')
+        self.content = bytes(range(256)) * 64
+        with open(self.file_path, 'wb') as f:
+            f.write(self.content)
+        self.share_index = ShareIndex(os.path.join(self.temp_dir.name, 'index.json'))
+        self.file_hash = self.share_index.add(self.file_path).file_hash
+
+        self.server = Network(0, 0, ip_address='127.0.0.1')
+        self.server.share_index = self.share_index
+        self.server.start_listening()
+        self.port = self.server.tcp_socket.getsockname()[1]
+        threading.Thread(target=self.server.accept_connections, daemon=True).start()
+        self.client = Network(0, 0, ip_address='127.0.0.1')
+
+    def tearDown(self):
+        self.client.close_connections()
+        self.server.close_connections()
+        self.temp_dir.cleanup()
+
+    def test_read_chunk(self):
+        """Test reading byte ranges of shared files."""
+        self.assertEqual(self.server.read_chunk(self.file_hash, 10, 5), self.content[10:15])
+        with self.assertRaises(ValueError):
+            self.server.read_chunk('00' * 32, 0, 1)
+        with self.assertRaises(ValueError):
+            self.server.read_chunk(self.file_hash, len(self.content), 1)
+
+    def test_get_session_reuses_connection(self):
+        """Test that each peer gets a single session."""
+        session = self.client.get_session('127.0.0.1', self.port)
+        self.assertIsInstance(session, Session)
+        self.assertIs(self.client.get_session('127.0.0.1', self.port), session)
+        self.assertIs(self.client.active_connections[('127.0.0.1', self.port)], session)
+
+    def test_pipelined_requests(self):
+        """Test many outstanding chunk requests on one session."""
+        session = self.client.get_session('127.0.0.1', self.port)
+        futures = [session.request_chunk(self.file_hash, offset, 1024) for offset in range(0, len(self.content), 1024)]
+        self.assertEqual(b''.join(future.result(5) for future in futures), self.content)
+        with self.assertRaises(SessionError):
+            session.request_chunk('00' * 32, 0, 1).result(5)
+        self.assertEqual(session.stat_file(self.file_hash).result(5), len(self.content))
+
+    def test_partial_file_served_and_announced(self):
+        """Test serving the written chunks of a partial download and announcing new ones."""
+        partial_hash = '11' * 32
+        bitfield = Bitfield(len(self.content) // 1024)
+        bitfield.set(0)
+        self.server.register_partial(partial_hash, self.file_path, len(self.content), 1024, bitfield)
+        announced = threading.Event()
+        self.client.have_listeners.append(lambda peer, file_hash, index: announced.set())
+
+        session = self.client.get_session('127.0.0.1', self.port)
+        peer_bitfield = session.request_bitfield(partial_hash, 1024).result(5)
+        self.assertEqual(list(peer_bitfield), [0])
+        self.client.get_peer('127.0.0.1', self.port).set_bitfield(partial_hash, peer_bitfield)
+        self.assertEqual(session.request_chunk(partial_hash, 0, 1024).result(5), self.content[:1024])
+        with self.assertRaises(SessionError):
+            session.request_chunk(partial_hash, 1024, 1024).result(5)
+
+        self.server.announce_have(partial_hash, 1)
+        self.assertTrue(announced.wait(5))
+        self.assertTrue(self.client.get_peer('127.0.0.1', self.port).has_chunk(partial_hash, 1))
+        self.assertEqual(session.request_chunk(partial_hash, 1024, 1024).result(5), self.content[1024:2048])
+        self.assertTrue(session.request_bitfield(self.file_hash, 1024).result(5).complete())
+
+        self.server.unregister_partial(partial_hash)
+        with self.assertRaises(SessionError):
+            session.request_chunk(partial_hash, 0, 1).result(5)
+
+    def test_have_out_of_range_ignored(self):
+        """Test that a HAVE for a chunk past the end of the file is dropped and the session keeps working."""
+        partial_hash = '11' * 32
+        self.server.register_partial(partial_hash, self.file_path, len(self.content), 1024,
+                                     Bitfield(len(self.content) // 1024))
+        announced = []
+        self.client.have_listeners.append(lambda peer, file_hash, index: announced.append(index))
+        session = self.client.get_session('127.0.0.1', self.port)
+        peer_bitfield = session.request_bitfield(partial_hash, 1024).result(5)
+        self.client.get_peer('127.0.0.1', self.port).set_bitfield(partial_hash, peer_bitfield)
+
+        for server in list(self.server.session_servers):
+            server.send_have(partial_hash, peer_bitfield.length)
+        # Answered after the HAVE was read, by the same reader thread
+        self.assertEqual(session.stat_file(self.file_hash).result(5), len(self.content))
+        self.assertEqual(announced, [])
+
+    def test_echo_still_served(self):
+        """Test that plain connections are still echoed."""
+        with socket.create_connection(('127.0.0.1', self.port)) as connection:
+            connection.sendall(b'hello')
+            self.assertEqual(connection.recv(64), b'Echo: hello')
+
+    def test_get_session_unreachable(self):
+        """Test that an unreachable peer raises ConnectionError."""
+        self.server.close_connections()
+        with self.assertRaises(ConnectionError):
+            self.client.get_session('127.0.0.1', self.port)
+
+    def test_get_session_connects_without_lock(self):
+        """Test that a slow connect doesn't block other users of the network's lock."""
+        connecting = threading.Event()
+        release = threading.Event()
+
+        def open_connection(ip, port):
+            connecting.set()
+            release.wait(5)
+            raise OSError("timed out")
+
+        errors = []
+
+        def get_session():
+            try:
+                self.client.get_session('127.0.0.1', 1)
+            except ConnectionError as e:
+                errors.append(e)
+
+        with patch.object(self.client, 'open_connection', side_effect=open_connection):
+            thread = threading.Thread(target=get_session)
+            thread.start()
+            self.assertTrue(connecting.wait(5))
+            acquired = self.client._lock.acquire(timeout=1)
+            if acquired:
+                self.client._lock.release()
+            release.set()
+            thread.join(5)
+        self.assertTrue(acquired)
+        self.assertEqual(len(errors), 1)
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,6 +2,7 @@ import unittest, sys, os
 from datetime import datetime
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+from src.bitfield import Bitfield
 from src.peer import Peer
 
 class TestPeer(unittest.TestCase):
@@ -17,7 +18,7 @@ class TestPeer(unittest.TestCase):
         self.assertEqual(self.peer.port, 54321)
         self.assertEqual(self.peer.status, "active")
         self.assertIsNone(self.peer.last_seen)
-        self.assertEqual(self.peer.shared_files, [])
+        self.assertEqual(len(self.peer.shared_files), 0)
 
     def test_update_status(self):
         """Test updating the peer's status."""
@@ -35,6 +36,48 @@ class TestPeer(unittest.TestCase):
         self.peer.remove_shared_file("file1.txt")
         self.assertNotIn("file1.txt", self.peer.shared_files)
 
+    def test_remove_missing_shared_file(self):
+        """Test removing a file that is not shared is a no-op."""
+        self.peer.add_shared_file("file1.txt")
+        self.peer.remove_shared_file("file2.txt")
+        self.assertIn("file1.txt", self.peer.shared_files)
+
+    def test_shared_files_keyed_by_hash(self):
+        """Test that file objects are stored as their hash."""
+        class FakeFile:
+            file_hash = "abc123"
+
+        shared = FakeFile()
+        self.peer.add_shared_file(shared)
+        self.peer.add_shared_file(shared)
+        self.assertEqual(len(self.peer.shared_files), 1)
+        self.assertTrue(self.peer.has_shared_file("abc123"))
+        self.assertEqual(list(self.peer.get_shared_files()), ["abc123"])
+        self.peer.remove_shared_file(shared)
+        self.assertFalse(self.peer.has_shared_file("abc123"))
+
+    def test_file_ids_released(self):
+        """Test that a hash no peer shares any more is forgotten and its id reused."""
+        other = Peer(peer_id="67890", ip_address="192.168.1.3", port=54321)
+        numbered = len(Peer.file_ids)
+        self.peer.add_shared_file("churned")
+        other.add_shared_file("churned")
+        file_id = Peer.file_ids.get("churned")
+        self.assertEqual(len(Peer.file_ids), numbered + 1)
+        self.peer.remove_shared_file("churned")
+        self.assertEqual(Peer.file_ids.get("churned"), file_id)
+        del other
+        self.assertIsNone(Peer.file_ids.get("churned"))
+        self.assertEqual(len(Peer.file_ids), numbered)
+        self.peer.add_shared_file("next")
+        self.assertEqual(Peer.file_ids.get("next"), file_id)
+
+    def test_slots(self):
+        """Test that peers do not carry a per-instance __dict__."""
+        self.assertFalse(hasattr(self.peer, '__dict__'))
+        with self.assertRaises(AttributeError):
+            self.peer.unknown_attribute = 1
+
     def test_get_shared_files(self):
         """Test retrieving the list of shared files."""
         self.peer.add_shared_file("file1.txt")
@@ -43,6 +86,30 @@ class TestPeer(unittest.TestCase):
         self.assertIn("file1.txt", shared_files)
         self.assertIn("file2.txt", shared_files)
 
+    def test_chunk_bitfields(self):
+        """Test tracking the chunks the peer has of a file."""
+        self.assertFalse(self.peer.has_chunk("abc123", 0))
+        self.assertFalse(self.peer.have_chunk("abc123", 0))
+        self.peer.set_bitfield("abc123", Bitfield(4))
+        self.assertTrue(self.peer.have_chunk("abc123", 2))
+        self.assertFalse(self.peer.have_chunk("abc123", 2))
+        self.assertTrue(self.peer.has_chunk("abc123", 2))
+        self.assertFalse(self.peer.has_chunk("abc123", 1))
+
+    def test_performance_averages(self):
+        """Test the moving averages of throughput, round-trip time and failures."""
+        self.assertIsNone(self.peer.expected_time(100))
+        self.peer.record_transfer(1000, 1.0)
+        self.assertEqual(self.peer.throughput, 1000)
+        self.peer.record_transfer(2000, 1.0)
+        self.assertAlmostEqual(self.peer.throughput, 1300)
+        self.peer.record_rtt(0.5)
+        self.assertEqual(self.peer.rtt, 0.5)
+        self.assertAlmostEqual(self.peer.expected_time(1300), 1.5)
+        self.peer.record_failure()
+        self.assertAlmostEqual(self.peer.failure_rate, 0.3)
+        self.assertAlmostEqual(self.peer.expected_time(1300), 1.5 / 0.7)
+
     def test_update_last_seen(self):
         """Test updating the last seen timestamp."""
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -62,5 +129,11 @@ class TestPeer(unittest.TestCase):
         self.assertEqual(peer_dict["last_seen"], timestamp)
         self.assertIn("file1.txt", peer_dict["shared_files"])
 
+    def test_to_dict_shared_files_is_live_view(self):
+        """Test that to_dict exposes the shared files without copying them."""
+        peer_dict = self.peer.to_dict()
+        self.peer.add_shared_file("file1.txt")
+        self.assertIn("file1.txt", peer_dict["shared_files"])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,223 @@
+import unittest
+import socket
+import threading
+import sys
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.bitfield import Bitfield
+from src.session import (Session, SessionServer, SessionError, FrameReader, send_chunk, send_frame, DATA, REQUEST,
+                         REQUEST_PAYLOAD, MSG_MORE, MAX_CHUNK_LENGTH)
+
+FILE_HASH = 'ab' * 32
+
+class TestSession(unittest.TestCase):
+
+    def setUp(self):
+        """Connect a session to a server over a socket pair."""
+        self.client_socket, self.server_socket = socket.socketpair()
+        self.executor = ThreadPoolExecutor(max_workers=8)
+        self.release_first = threading.Event()
+        self.reads = []
+
+        def read_chunk(file_hash, offset, length):
+            self.reads.append((file_hash, offset, length))
+            if offset == 0:
+                self.release_first.wait(5)
+            if file_hash != FILE_HASH:
+                raise ValueError("not shared")
+            return bytes([offset % 256]) * length
+
+        def file_size(file_hash):
+            if file_hash != FILE_HASH:
+                raise ValueError("not shared")
+            return 1234
+
+        def bitfield(file_hash, chunk_size):
+            if file_hash != FILE_HASH:
+                raise ValueError("not shared")
+            partial = Bitfield(-(-1234 // chunk_size))
+            partial.set(1)
+            return partial
+
+        self.server = SessionServer(self.server_socket, read_chunk, self.executor, file_size=file_size,
+                                    bitfield=bitfield)
+        self.server_thread = threading.Thread(target=self.server.serve, daemon=True)
+        self.session = Session(self.client_socket, max_outstanding=4)
+        # The server expects the magic to have been consumed, as Network.connection_handler does
+        self.server_socket.recv(5)
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.release_first.set()
+        self.session.close()
+        self.server_socket.close()
+        self.executor.shutdown(wait=True)
+
+    def test_request_chunk(self):
+        """Test requesting a single chunk."""
+        self.release_first.set()
+        future = self.session.request_chunk(FILE_HASH, 0, 10)
+        self.assertEqual(future.result(5), b'\x00' * 10)
+        self.assertEqual(self.reads, [(FILE_HASH, 0, 10)])
+
+    def test_out_of_order_responses(self):
+        """Test that a slow read doesn't hold back later responses."""
+        slow = self.session.request_chunk(FILE_HASH, 0, 4)
+        fast = self.session.request_chunk(FILE_HASH, 1, 4)
+        self.assertEqual(fast.result(5), b'\x01' * 4)
+        self.assertFalse(slow.done())
+        self.release_first.set()
+        self.assertEqual(slow.result(5), b'\x00' * 4)
+        self.assertEqual(self.session.outstanding(), 0)
+
+    def test_cancel(self):
+        """Test cancelling an outstanding request."""
+        future = self.session.request_chunk(FILE_HASH, 0, 4)
+        self.assertTrue(self.session.cancel(future))
+        self.assertTrue(future.cancelled())
+        self.assertEqual(self.session.outstanding(), 0)
+        self.release_first.set()
+        self.assertEqual(self.session.request_chunk(FILE_HASH, 2, 1).result(5), b'\x02')
+        self.assertFalse(self.session.cancel(future))
+
+    def test_error_response(self):
+        """Test that a failed read is reported to the requester."""
+        future = self.session.request_chunk('cd' * 32, 1, 4)
+        with self.assertRaises(SessionError):
+            future.result(5)
+
+    def test_oversized_request_rejected(self):
+        """Test that a chunk longer than the limit is refused without reading it."""
+        self.release_first.set()
+        future = self.session.request_chunk(FILE_HASH, 1, MAX_CHUNK_LENGTH + 1)
+        with self.assertRaises(SessionError):
+            future.result(5)
+        self.assertEqual(self.reads, [])
+        self.assertEqual(self.session.request_chunk(FILE_HASH, 2, 1).result(5), b'\x02')
+
+    def test_stat_file(self):
+        """Test asking for the size of a shared file."""
+        self.assertEqual(self.session.stat_file(FILE_HASH).result(5), 1234)
+        with self.assertRaises(SessionError):
+            self.session.stat_file('cd' * 32).result(5)
+
+    def test_bitfield_and_have(self):
+        """Test asking for a bitfield and receiving HAVE announcements for the file."""
+        announced = []
+        received = threading.Event()
+
+        def on_have(file_hash, index):
+            announced.append((file_hash, index))
+            received.set()
+
+        self.session.on_have = on_have
+        self.server.send_have(FILE_HASH, 0)  # Not subscribed yet
+        bitfield = self.session.request_bitfield(FILE_HASH, 100).result(5)
+        self.assertEqual(bitfield.length, 13)
+        self.assertEqual(list(bitfield), [1])
+        self.server.send_have('cd' * 32, 5)  # Not subscribed
+        self.server.send_have(FILE_HASH, 4)
+        self.assertTrue(received.wait(5))
+        self.assertEqual(announced, [(FILE_HASH, 4)])
+        with self.assertRaises(SessionError):
+            self.session.request_bitfield('cd' * 32, 100).result(5)
+
+    def test_choked_requests_wait(self):
+        """Test that chunk requests wait while the client is choked and are answered after unchoke."""
+        self.release_first.set()
+        interested = threading.Event()
+        self.server.on_interested = lambda server: interested.set()
+        self.server.choke()
+        future = self.session.request_chunk(FILE_HASH, 3, 2)
+        self.assertTrue(interested.wait(5))
+        self.assertFalse(future.done())
+        self.assertTrue(self.session.choked)
+        self.assertEqual(self.server.waiting(), 1)
+        self.server.unchoke()
+        self.assertEqual(future.result(5), b'\x03' * 2)
+        self.assertFalse(self.session.choked)
+        self.assertEqual(self.server.uploaded, 2)
+
+    def test_uploaded_counts_concurrent_answers(self):
+        """Test that chunks answered by several executor threads at once are all counted."""
+        self.release_first.set()
+        futures = [self.session.request_chunk(FILE_HASH, offset, 3) for offset in range(1, 201)]
+        for future in futures:
+            future.result(5)
+        self.assertEqual(self.server.uploaded, 600)
+
+    def test_inflight_requests_limited(self):
+        """Test that requests past the limit wait unread until earlier answers are sent."""
+        self.server.max_inflight = 1
+        slow = self.session.request_chunk(FILE_HASH, 0, 2)
+        later = self.session.request_chunk(FILE_HASH, 5, 2)
+        self.assertEqual(self.session.stat_file(FILE_HASH).result(5), 1234)
+        self.assertEqual(self.reads, [(FILE_HASH, 0, 2)])
+        self.assertEqual(self.server.waiting(), 2)
+        self.release_first.set()
+        self.assertEqual(later.result(5), b'\x05' * 2)
+        self.assertEqual(slow.result(5), b'\x00' * 2)
+
+    def test_slow_client_doesnt_block_executor(self):
+        """Test that answers for a client that stops reading don't hold the shared executor threads."""
+        self.release_first.set()
+        client, server_socket = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(server_socket.close)
+        server = SessionServer(server_socket, lambda file_hash, offset, length: bytes(length), self.executor,
+                               max_inflight=32)
+        threading.Thread(target=server.serve, daemon=True).start()
+        for request_id in range(1, 33):
+            send_frame(client, REQUEST, request_id, REQUEST_PAYLOAD.pack(bytes.fromhex(FILE_HASH), 0, 256 * 1024))
+        # The client never reads, so its writer is stuck long before 8 MiB are sent
+        deadline = time.monotonic() + 5
+        while server._outgoing.qsize() < 20 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertGreaterEqual(server._outgoing.qsize(), 20)
+        self.assertEqual(self.executor.submit(lambda: 'free').result(5), 'free')
+        client.shutdown(socket.SHUT_RDWR)
+
+    def test_hello(self):
+        """Test that the client's serving port reaches the server."""
+        self.session.hello(4321)
+        self.session.stat_file(FILE_HASH).result(5)
+        self.assertEqual(self.server.peer_port, 4321)
+
+    def test_peer_disconnect_fails_pending(self):
+        """Test that outstanding requests fail when the peer goes away."""
+        future = self.session.request_chunk(FILE_HASH, 0, 4)
+        self.server_socket.shutdown(socket.SHUT_RDWR)
+        with self.assertRaises(ConnectionError):
+            future.result(5)
+        with self.assertRaises(ConnectionError):
+            self.session.request_chunk(FILE_HASH, 1, 4)
+
+
+class TestFrameReader(unittest.TestCase):
+
+    def test_send_chunk(self):
+        """Test sending a header together with its payload."""
+        connection = MagicMock()
+
+        send_chunk(connection, b'header', b'payload')
+
+        connection.sendall.assert_any_call(b'header', MSG_MORE)
+        connection.sendall.assert_called_with(b'payload')
+
+    def test_read_frame_with_initial_bytes(self):
+        """Test reading frames that start in already-received bytes."""
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            send_frame(sender, DATA, 7, b'payload')
+            frame = receiver.recv(3)
+            reader = FrameReader(receiver, initial=frame)
+            self.assertEqual(reader.read_frame(), (DATA, 7, bytearray(b'payload')))
+            sender.close()
+            self.assertIsNone(reader.read_frame())
+
+if __name__ == '__main__':
+    unittest.main()
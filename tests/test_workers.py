@@ -0,0 +1,117 @@
+import unittest
+import os
+import hashlib
+import sys
+import socket
+import tempfile
+import threading
+import time
+from unittest.mock import MagicMock
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.index import ShareIndex
+from src.network import Network
+from src.session import SessionError
+from src.workers import Supervisor, watch_snapshot
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        """Write a shared file and its snapshot, and pick a free port."""
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.temp_dir.name, 'shared.bin')
+        self.content = os.urandom(64 * 1024)
+        with open(self.file_path, 'wb') as f:
+            f.write(self.content)
+        self.snapshot_path = os.path.join(self.temp_dir.name, 'index.json')
+        ShareIndex(self.snapshot_path).index_paths([self.file_path])
+        self.file_hash = hashlib.sha256(self.content).hexdigest()
+
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+        self.supervisor = Supervisor(2, {
+            'discovery_port': 0,
+            'tcp_port': self.port,
+            'ip_address': '127.0.0.1',
+            'index_snapshot': self.snapshot_path,
+            'log_file': os.path.join(self.temp_dir.name, 'logs', 'worker.log'),
+        })
+        self.supervisor.HEALTH_INTERVAL = 0.1
+        self.supervisor.RESTART_DELAY = 0.1
+        self.client = Network(0, 0)
+
+    def tearDown(self):
+        self.client.close_connections()
+        self.supervisor.stop()
+        self.temp_dir.cleanup()
+
+    def wait_for(self, condition, timeout=20):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("Condition not met in time")
+            time.sleep(0.05)
+
+    def fetch(self):
+        """Fetch the shared file from whichever worker accepts the connection."""
+        while True:
+            try:
+                session = self.client.get_session('127.0.0.1', self.port)
+                return session.request_chunk(self.file_hash, 0, len(self.content)).result(10)
+            except (ConnectionError, SessionError):
+                # Workers restore the index right after binding; retry until one is serving
+                self.client.close_connections()
+                time.sleep(0.05)
+
+    def test_workers_log_to_file(self):
+        """Test that worker processes set up logging to the configured file."""
+        self.supervisor.start()
+        log_path = os.path.join(self.temp_dir.name, 'logs', 'worker.log')
+
+        def restored():
+            if not os.path.exists(log_path):
+                return False
+            with open(log_path) as f:
+                return 'restored 1 shared files' in f.read()
+
+        self.wait_for(restored)
+
+    def test_workers_serve_shared_files(self):
+        """Test that workers bind the shared port and serve from the snapshot."""
+        self.supervisor.start()
+        self.wait_for(lambda: self.supervisor.alive() == 2)
+        self.assertEqual(self.fetch(), self.content)
+
+    def test_dead_worker_is_restarted(self):
+        """Test that the supervisor replaces a worker that exits."""
+        self.supervisor.start()
+        self.wait_for(lambda: self.supervisor.alive() == 2)
+        first = self.supervisor.workers[0]
+        first.terminate()
+        first.join(5)
+        self.wait_for(lambda: self.supervisor.workers[0] is not first and self.supervisor.alive() == 2)
+        self.assertEqual(self.supervisor.restarts[0], 1)
+        self.assertEqual(self.fetch(), self.content)
+
+class TestWatchSnapshot(unittest.TestCase):
+
+    def test_failed_restore_keeps_watching(self):
+        """Test that a snapshot that can't be restored doesn't stop the worker picking up the next one."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            share_index = MagicMock()
+            share_index.snapshot_path = os.path.join(temp_dir, 'index.json')
+            with open(share_index.snapshot_path, 'w') as f:
+                f.write('{}')
+            share_index.restore.side_effect = [RuntimeError("bad snapshot"), 1]
+            threading.Thread(target=watch_snapshot, args=(share_index, 0.01), daemon=True).start()
+            deadline = time.monotonic() + 5
+            while share_index.restore.call_count < 1 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            os.utime(share_index.snapshot_path, ns=(0, 10**9))  # Rewritten by the main process
+            while share_index.restore.call_count < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(share_index.restore.call_count, 2)
+
+if __name__ == '__main__':
+    unittest.main()